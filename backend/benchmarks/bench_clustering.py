@@ -0,0 +1,72 @@
+# micro-benchmark of harmony.clustering.cluster_starts against the original loop over datetimes
+# usage: python -m benchmarks.bench_clustering [number of messages]
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+import numpy as np
+from harmony.analyzer import MAX_CUM_DIST, MAX_DIST
+from harmony.clustering import cluster_starts
+
+
+GAPS = [1, 5, 10, 30, 60, 90, 119, 120, 121, 300, 3600]  # seconds between consecutive messages
+
+
+# returns the iso timestamps of count synthetic messages from newest to oldest
+def generate_timestamps(count, seed=0):
+    rng = random.Random(seed)
+    time = datetime(2022, 1, 1)
+    timestamps = []
+
+    for _ in range(count):
+        time -= timedelta(seconds=rng.choice(GAPS), milliseconds=rng.randrange(1000))
+        timestamps.append(time.isoformat(timespec='milliseconds') + '+00:00')
+
+    return timestamps
+
+
+# the implementation of create_clusters before it was vectorized (without the database writes)
+def legacy_cluster_starts(timestamps):
+    starts = []
+    first_time = datetime.fromisoformat(timestamps[0])
+    last_time = first_time
+
+    for i, timestamp in enumerate(timestamps):
+        message_time = datetime.fromisoformat(timestamp)
+
+        if i == 0 or first_time - message_time > MAX_CUM_DIST or last_time - message_time > MAX_DIST:
+            starts.append(i)
+            first_time = message_time
+
+        last_time = message_time
+
+    return starts
+
+
+# the same conversion sqlite does with julianday
+def to_milliseconds(timestamps):
+    return np.array([datetime.fromisoformat(timestamp).timestamp() * 1000 for timestamp in timestamps]).round().astype(np.int64)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    timestamps = generate_timestamps(count)
+    times = to_milliseconds(timestamps)
+
+    start = time.perf_counter()
+    expected = legacy_cluster_starts(timestamps)
+    before = time.perf_counter() - start
+
+    start = time.perf_counter()
+    starts = cluster_starts(times, MAX_DIST // timedelta(milliseconds=1), MAX_CUM_DIST // timedelta(milliseconds=1))
+    after = time.perf_counter() - start
+
+    assert starts.tolist() == expected, "clusters differ from the original implementation"
+
+    print(f"{count} messages, {len(starts)} clusters")
+    print(f"before: {before:.2f}s")
+    print(f"after:  {after:.2f}s ({before / after:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
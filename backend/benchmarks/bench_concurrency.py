@@ -0,0 +1,195 @@
+# measures how the api reads an analyzed channel while a worker writes another one, with sqlite's own settings and with the production profile (see harmony.storage)
+# each profile runs in a fresh process on a database of its own: a writer process stores messages at full speed through MessageWriter
+# while threads of the api process call the read routes, counting the requests that failed (database is locked)
+# usage: python -m benchmarks.bench_concurrency [seconds] [readers]
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from benchmarks.discord_stub import USERNAMES, channel_id, synthetic_messages, username
+
+# the app is only imported by the processes of a profile, once its environment is set
+
+
+PROFILES = ['default', 'production']
+SEED_MESSAGES = int(os.getenv("BENCH_SEED_MESSAGES", 5000))  # messages of the channel read by the api
+READ_START = datetime(2022, 1, 1, tzinfo=timezone.utc)
+WRITE_START = datetime(2022, 6, 1, tzinfo=timezone.utc)
+READ_CHANNEL = channel_id(READ_START)
+WRITE_CHANNEL = channel_id(WRITE_START)
+ROUTES = ['pog', 'sentiments/users', 'sentiments/messages', 'sentiments/messages/extremes', 'sentiments/distribution', 'messages?limit=100']
+
+
+# returns the pth percentile of sorted values
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else None
+
+
+# stores the messages of the read channel and analyzes them (stage 4 gives every message its own content, as it needs the nlp pipeline)
+def seed():
+    from benchmarks.query_plans import resolve_without_nlp
+    from harmony import db
+    from harmony.analyzer import Analyzer
+    from harmony.migrations import upgrade_schema
+    from harmony.models import Channel
+    from harmony.writer import MessageWriter
+
+    upgrade_schema()
+    db.session.add(Channel(id=READ_CHANNEL, running=False, stage=3, progress=0, limit=SEED_MESSAGES))
+    db.session.commit()
+
+    writer = MessageWriter(READ_CHANNEL)
+    for n in range(len(USERNAMES)):
+        writer.add_user(str(n + 1), username(n))
+        writer.add_member(str(n + 1))
+    for message in synthetic_messages(SEED_MESSAGES, READ_START + timedelta(days=1)):
+        writer.add_message(message)
+    writer.flush()
+
+    Analyzer(READ_CHANNEL).start_analysis()
+    resolve_without_nlp()
+    Channel.query.get(READ_CHANNEL).stage = 5
+    db.session.commit()
+    Analyzer(READ_CHANNEL).start_analysis()
+
+
+# writes batches of messages to the write channel for seconds (a worker running stage 1) and prints its results as json
+def write(seconds):
+    from sqlalchemy.exc import OperationalError
+    from harmony import app, db
+    from harmony.models import Channel
+    from harmony.writer import MessageWriter
+
+    with app.app_context():
+        db.session.add(Channel(id=WRITE_CHANNEL, running=True, stage=1, progress=0, limit=0))
+        db.session.commit()
+
+        writer = MessageWriter(WRITE_CHANNEL)
+        for n in range(len(USERNAMES)):
+            writer.add_member(str(n + 1))  # the users were stored with the read channel
+        writer.flush()
+        print('ready', flush=True)
+
+        commits = []
+        errors = 0
+        start = time.perf_counter()
+        time_ = WRITE_START + timedelta(days=1)
+
+        while time.perf_counter() - start < seconds:
+            batch = synthetic_messages(writer.batch_size, time_, seed=len(commits) + errors)
+            time_ = datetime.fromisoformat(batch[-1]['timestamp']) + timedelta(minutes=1)  # the next batch has ids of its own
+            for message in batch:
+                writer.add_message(message)
+
+            started = time.perf_counter()
+            try:
+                writer.flush()
+                commits.append(time.perf_counter() - started)
+            except OperationalError:
+                db.session.rollback()
+                writer.discard()
+                errors += 1
+
+        elapsed = time.perf_counter() - start
+        print(json.dumps({'rows': writer.written, 'rows_per_sec': writer.written / elapsed, 'commit_p95_ms': percentile(sorted(commits), 95) * 1000 if commits else None,
+            'commit_max_ms': max(commits) * 1000 if commits else None, 'errors': errors}), flush=True)
+
+
+# calls the read routes from readers threads for seconds and returns the latency (seconds) of every successful request and the number of failed ones
+def read(seconds, readers):
+    from harmony import app
+
+    app.logger.disabled = True  # failed requests are counted, not logged
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def reader(offset):
+        nonlocal errors
+        client = app.test_client()
+        i = offset
+
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            try:
+                response = client.get(f'/api/channel/{READ_CHANNEL}/{ROUTES[i % len(ROUTES)]}')
+                response.get_data()  # runs the queries of streamed responses
+                ok = response.status_code == 200
+            except Exception:
+                ok = False
+            elapsed = time.perf_counter() - started
+
+            with lock:
+                if ok:
+                    latencies.append(elapsed)
+                else:
+                    errors += 1
+            i += 1
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(readers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return latencies, errors
+
+
+# runs the benchmark of the profile this process was started with and prints its results as json
+def run(seconds, readers):
+    from harmony import app
+    from harmony.storage import SQLITE_PROFILE
+
+    with app.app_context():
+        seed()
+
+    writer = subprocess.Popen([sys.executable, '-m', 'benchmarks.bench_concurrency', '--write', str(seconds)], stdout=subprocess.PIPE, text=True)
+    if writer.stdout.readline().strip() != 'ready':
+        raise RuntimeError(f"writer exited with status {writer.wait()}")
+
+    latencies, errors = read(seconds, readers)
+    written = json.loads(writer.stdout.readline())
+    writer.wait()
+
+    latencies.sort()
+    print(json.dumps({
+        'profile': SQLITE_PROFILE,
+        'reads': len(latencies),
+        'reads_per_sec': len(latencies) / seconds,
+        'read_p50_ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'read_p95_ms': percentile(latencies, 95) * 1000 if latencies else None,
+        'read_max_ms': latencies[-1] * 1000 if latencies else None,
+        'read_errors': errors,
+        'writer': written
+    }), flush=True)
+
+
+def main():
+    if sys.argv[1:2] == ['--write']:
+        return write(float(sys.argv[2]))
+    if sys.argv[1:2] == ['--run']:
+        return run(float(sys.argv[2]), int(sys.argv[3]))
+
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    readers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    print(f"{readers} readers and one writer for {seconds:.0f}s, reading a channel of {SEED_MESSAGES} messages")
+
+    for profile in PROFILES:
+        env = dict(os.environ, SQLITE_PROFILE=profile, DATABASE_URL=f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'bench_concurrency.db')}",
+            PROGRESS_STORE='memory', LANGUAGE_CLIENT='fake', LANGUAGE_CACHE_SIZE='0', COREF_CACHE_SIZE='0')
+        output = subprocess.run([sys.executable, '-m', 'benchmarks.bench_concurrency', '--run', str(seconds), str(readers)], env=env, stdout=subprocess.PIPE, text=True, check=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        writer = result['writer']
+
+        print(f"{profile}: {result['reads_per_sec']:.0f} reads/sec, p50 {result['read_p50_ms'] or 0:.1f}ms, p95 {result['read_p95_ms'] or 0:.1f}ms, max {result['read_max_ms'] or 0:.1f}ms, "
+              f"{result['read_errors']} failed reads | writer {writer['rows_per_sec']:.0f} rows/sec, commit p95 {writer['commit_p95_ms'] or 0:.1f}ms, max {writer['commit_max_ms'] or 0:.1f}ms, {writer['errors']} failed batches")
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
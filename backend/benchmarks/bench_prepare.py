@@ -0,0 +1,98 @@
+# micro-benchmark of Helper.prepare_message against the original implementation
+# usage: python -m benchmarks.bench_prepare [number of messages]
+import copy
+import random
+import re
+import sys
+import time
+from harmony.helpers import Helper
+
+
+WORDS = ["hey", "what", "is", "up", "lol", "that's", "so", "good", "i", "think", "you", "are", "right", "no", "way", "gg", "nice", "\"quote\"", "ok!!", "wow...", ":)", "bruh"]
+EXTRAS = ["https://example.com/a?b=c", "www.example.org", "```py\nprint(1)\n```", "<@123456789012345678>", "<@!223456789012345678>", "\n", "  ", "#general", "😀"]
+
+
+# returns a list of synthetic Discord message objects
+def generate_messages(count, seed=0):
+    rng = random.Random(seed)
+    messages = []
+
+    for i in range(count):
+        words = rng.choices(WORDS, k=rng.randint(1, 14))
+        if rng.random() < 0.3:
+            words.insert(rng.randrange(len(words) + 1), rng.choice(EXTRAS))
+
+        messages.append({
+            'id': str(i),
+            'type': 0 if rng.random() < 0.95 else 19,
+            'attachments': [] if rng.random() < 0.95 else [{'id': '1'}],
+            'content': ' '.join(words),
+            'author': {'id': str(rng.randrange(50)), 'username': 'user'},
+        })
+
+    return messages
+
+
+# the implementation of prepare_message before patterns were compiled once
+def legacy_prepare_message(message, add_user):
+    min_size = 10
+    max_size = 50
+
+    link_regex = r"(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
+    mention_regex = r"<@!?(\d+)>"
+    code_regex = r"```.+\n.*\n```"
+    special_chars_regex = r"[^A-Za-z0-9\'\" ]+"
+
+    if message['type'] != 0:
+        return
+    if message['attachments']:
+        return
+    if len(re.findall(code_regex, message['content'])) != 0:
+        return
+    if len(re.findall(link_regex, message['content'])) != 0:
+        return
+
+    message['content'] = re.sub(mention_regex, lambda match: add_user(match.group(1)), message['content'])
+    message['content'] = re.sub(special_chars_regex, '', message['content'])
+    message['content'] = ' '.join(message['content'].split())
+
+    if len(message['content']) < min_size or len(message['content']) > max_size:
+        return
+
+    return message
+
+
+# returns the username used for mentioned users (no database or discord needed)
+def add_user(user_id):
+    return 'user_' + user_id[-4:]
+
+
+# returns (seconds, prepared messages) of prepare over a copy of messages
+def run(prepare, messages):
+    messages = copy.deepcopy(messages)
+
+    start = time.perf_counter()
+    prepared = [message for message in map(prepare, messages) if message is not None]
+    return time.perf_counter() - start, prepared
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    messages = generate_messages(count)
+
+    # a helper that resolves mentions without touching the database
+    helper = Helper.__new__(Helper)
+    helper.add_user = add_user
+
+    before, expected = run(lambda message: legacy_prepare_message(message, add_user), messages)
+    after, prepared = run(helper.prepare_message, messages)
+
+    assert prepared == expected, "prepared messages differ from the original implementation"
+
+    print(f"{count} messages, {len(prepared)} accepted")
+    print(f"before: {count / before:,.0f} messages/sec")
+    print(f"after:  {count / after:,.0f} messages/sec ({before / after:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+# measures the throughput of analyzing several channels at once (stages 1 to 5 of each)
+# with a single worker consuming every queue (before) and with a worker pool per queue (after, see worker.py)
+# runs real celery workers against a local broker, a stub of the discord api and the fake language client,
+# with a latency on every discord request and language call so io stages compete with coref for the slots of a single pool
+# the stub broker polls, which adds about a second per task to both runs (set CELERY_BROKER_URL to measure with the real one)
+# channels are written by the same users unless BENCH_SHARED_USERS is 0, so channels gathered at the same time store the same users
+# stage 4 runs the nlp pipeline of harmony.coref, so spacy and neuralcoref must be installed: with a stand-in for them the coref pool
+# only spends the cpu time the stand-in takes, and neither loads a model when it starts nor holds one in every process,
+# so the run measures how the pools share the machine and says nothing about coref throughput or how many coref processes fit in memory
+# usage: python -m benchmarks.bench_queues [channels] [messages per channel]
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# must be set before the app is imported
+directory = tempfile.mkdtemp()
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(directory, 'bench_queues.db')}")
+os.environ.setdefault("CELERY_BROKER_URL", f"sqla+sqlite:///{os.path.join(directory, 'broker.db')}")
+os.environ.setdefault("CELERY_RESULT_BACKEND", f"db+sqlite:///{os.path.join(directory, 'results.db')}")
+os.environ.setdefault("PROGRESS_PATH", os.path.join(directory, 'progress.db'))
+os.environ.setdefault("LANGUAGE_CLIENT", "fake")
+os.environ.setdefault("FAKE_LANGUAGE_LATENCY", "0.2")
+os.environ.setdefault("LANGUAGE_CACHE_SIZE", "0")
+os.environ.setdefault("COREF_CACHE_SIZE", "0")
+
+from benchmarks.discord_stub import DiscordStub, synthetic_channels
+from harmony import app, db
+from harmony.migrations import upgrade_schema
+from harmony.models import Channel
+
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PAGE_LATENCY = float(os.getenv("BENCH_PAGE_LATENCY", 0.2))  # seconds the discord stub takes per request
+TIMEOUT = float(os.getenv("BENCH_TIMEOUT", 1800))  # seconds a run may take before it is given up
+SHARED_USERS = bool(int(os.getenv("BENCH_SHARED_USERS", 1)))  # whether every channel is written by the same users
+RUNS = [
+    ('before', 'one prefork pool for every queue', ['all']),
+    ('after', 'a pool per queue', ['io', 'cpu', 'coref']),
+]
+
+
+# starts the workers of pools (see worker.py) and returns their processes once every one is ready
+def start_workers(pools):
+    workers = []
+    for pool in pools:
+        process = subprocess.Popen([sys.executable, 'worker.py', pool, '--without-heartbeat', '--without-gossip', '--without-mingle'],
+            cwd=BACKEND, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+        ready = threading.Event()
+
+        # celery logs a line ending in "ready." once the worker consumes its queues
+        def watch(process=process, ready=ready):
+            for line in process.stdout:
+                if line.rstrip().endswith('ready.'):
+                    ready.set()
+
+        threading.Thread(target=watch, daemon=True).start()
+        workers.append((pool, process, ready))
+
+    for pool, process, ready in workers:
+        while not ready.wait(1):
+            if process.poll() is not None:
+                raise RuntimeError(f"{pool} worker exited with status {process.returncode}")
+
+    return [process for _, process, _ in workers]
+
+
+def stop_workers(workers):
+    for process in workers:
+        process.terminate()
+    for process in workers:
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+# returns how many of channel_ids have authors in common with another of them
+def overlapping(data, channel_ids):
+    authors = {channel_id: {message['author']['id'] for message in data[channel_id]} for channel_id in channel_ids}
+    return sum(any(authors[channel_id] & authors[other] for other in channel_ids if other != channel_id) for channel_id in channel_ids)
+
+
+# starts each stage of every channel once the previous one is done and returns the seconds until all of them finished
+def analyze(channel_ids):
+    from harmony.tasks import start_analysis_task
+
+    started = {}  # channel id -> stage its task was sent for
+    start = time.perf_counter()
+
+    while time.perf_counter() - start < TIMEOUT:
+        channels = Channel.query.filter(Channel.id.in_(channel_ids)).all()
+        finished = 0
+
+        for channel in channels:
+            if channel.stage > 5:
+                finished += 1
+            elif channel.running or started.get(channel.id) == channel.stage:
+                continue
+            elif channel.stage == 2:
+                channel.stage = 3  # no alternate names
+            else:
+                start_analysis_task.delay(channel.id)
+                started[channel.id] = channel.stage
+
+        db.session.commit()
+        if finished == len(channel_ids):
+            return time.perf_counter() - start
+
+        time.sleep(0.2)
+
+    raise RuntimeError(f"channels did not finish within {TIMEOUT}s: {[(channel.id, channel.stage, channel.running) for channel in channels]}")
+
+
+def main():
+    channels = int(sys.argv[1]) if len(sys.argv) > 1 else 2 * (os.cpu_count() or 1) + 2
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+
+    # each run analyzes channels of its own
+    data = synthetic_channels(channels * len(RUNS), messages, shared_users=SHARED_USERS)
+    stub = DiscordStub(data, PAGE_LATENCY)
+    os.environ["DISCORD_API_URL"] = stub.start()  # read by the workers
+
+    with app.app_context():
+        upgrade_schema()
+        channel_ids = list(data)
+        for channel_id in channel_ids:
+            db.session.add(Channel(id=channel_id, running=False, stage=1, progress=0, limit=messages))
+        db.session.commit()
+
+        print(f"{channels} channels of {messages} messages, {PAGE_LATENCY}s per discord request, {os.environ['FAKE_LANGUAGE_LATENCY']}s per language call")
+        baseline = None
+        for i, (name, description, pools) in enumerate(RUNS):
+            run_ids = channel_ids[i * channels:(i + 1) * channels]
+            workers = start_workers(pools)
+            try:
+                elapsed = analyze(run_ids)
+            finally:
+                stop_workers(workers)
+
+            rate = channels * messages / elapsed
+            baseline = baseline or rate
+            print(f"{name} ({description}): {elapsed:.1f}s, {rate:.0f} messages/sec ({rate / baseline:.2f}x), {overlapping(data, run_ids)} of {channels} channels sharing users")
+
+    stub.stop()
+
+
+if __name__ == '__main__':
+    main()
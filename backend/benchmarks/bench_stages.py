@@ -0,0 +1,197 @@
+# runs stages 1 to 5 of the analyzer end to end on a synthetic channel, offline:
+# messages are fetched from a local stub of the discord api (with its rate limits and 429s) and analyzed by the fake language client
+# stage 4 runs the real nlp pipeline, so spacy and neuralcoref must be installed
+# prints the rows written per second, peak rss and database size after each stage as json on stdout (the analyzer logs to stderr),
+# so runs can be saved and compared to track regressions
+# usage: python -m benchmarks.bench_stages [--messages N] [--users N] [--mention-rate R] [--burstiness B] ... > results.json
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+# the app is only imported once the environment is set from the arguments
+
+
+# returns the options of the run
+def parse_args():
+    parser = argparse.ArgumentParser(description="Runs stages 1 to 5 on a synthetic channel and reports their throughput as json")
+    parser.add_argument('--messages', type=int, default=5000, help="messages in the channel")
+    parser.add_argument('--users', type=int, default=8, help="users sending them")
+    parser.add_argument('--mention-rate', type=float, default=0.1, help="share of the messages mentioning another user")
+    parser.add_argument('--burstiness', type=float, default=0.5, help="share of the messages sent within a burst (0 to 1)")
+    parser.add_argument('--gap', type=float, default=60, help="average seconds between two messages")
+    parser.add_argument('--latency', type=float, default=0.05, help="seconds the discord stub takes per request")
+    parser.add_argument('--rate-limit', default='50/1', help="requests/seconds allowed per route by the discord stub (none to disable)")
+    parser.add_argument('--language-latency', type=float, default=0, help="seconds the fake language client takes per call")
+    parser.add_argument('--output', help="also write the results to this file")
+    parser.add_argument('--verbose', action='store_true', help="show the analyzer logs")
+    return parser.parse_args()
+
+
+# returns a port nothing listens on
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+# returns the commit the benchmark ran on (None outside a git checkout)
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# returns the size in bytes of the sqlite database at path, with its wal
+def database_size(path):
+    return sum(os.path.getsize(file) for file in (path, f'{path}-wal') if os.path.exists(file))
+
+
+# returns the peak resident memory (KiB) of this process and of its finished children (the coref processes)
+def peak_rss():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+
+# returns {table: rows} of the rows each stage writes for the channel
+def count_rows(channel_id):
+    from harmony.models import ClusterMessage, CorefMessage, Message, MessageCluster, MessageSentiment, UserAlternate, UserSentiment
+
+    return {
+        'message': Message.query.filter(Message.channel_id == channel_id).count(),
+        'user_alternate': UserAlternate.query.filter(UserAlternate.channel_id == channel_id).count(),
+        'message_cluster': MessageCluster.query.filter(MessageCluster.channel_id == channel_id).count(),
+        'cluster_message': ClusterMessage.query.join(Message, ClusterMessage.message).filter(Message.channel_id == channel_id).count(),
+        'coref_message': CorefMessage.query.join(Message, CorefMessage.message).filter(Message.channel_id == channel_id).count(),
+        'message_sentiment': MessageSentiment.query.filter(MessageSentiment.channel_id == channel_id).count(),
+        'user_sentiment': UserSentiment.query.join(Message, UserSentiment.message).filter(Message.channel_id == channel_id).count(),
+    }
+
+
+# table whose rows are the output of each stage
+STAGE_TABLES = {1: 'message', 2: 'user_alternate', 3: 'cluster_message', 4: 'coref_message', 5: 'message_sentiment'}
+
+
+# runs every stage of the channel and returns the results of each
+def run_stages(channel_id, path, verbose):
+    from harmony import db
+    from harmony.analyzer import Analyzer
+    from harmony.models import Channel
+
+    results = []
+    for stage in range(1, 6):
+        logs = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(sys.stderr)
+
+        start = time.perf_counter()
+        with logs:
+            Analyzer(channel_id).start_analysis()
+        elapsed = time.perf_counter() - start
+
+        db.session.remove()  # the next stage reads the channel as a new task would
+        channel = Channel.query.get(channel_id)
+        if channel.stage != stage + 1:
+            raise RuntimeError(f"stage {stage} did not finish (channel is at stage {channel.stage})")
+
+        tables = count_rows(channel_id)
+        rows = tables[STAGE_TABLES[stage]]
+        rss, children_rss = peak_rss()
+        results.append({
+            'stage': stage,
+            'seconds': elapsed,
+            'rows': rows,
+            'rows_per_sec': rows / elapsed if elapsed > 0 else None,
+            'peak_rss_kib': rss,
+            'children_peak_rss_kib': children_rss,
+            'db_bytes': database_size(path),
+            'tables': tables,
+        })
+
+    return results
+
+
+def main():
+    args = parse_args()
+    rate_limit = None
+    if args.rate_limit != 'none':
+        requests, seconds = args.rate_limit.split('/')
+        rate_limit = (int(requests), float(seconds))
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'bench_stages.db')
+    port = free_port()
+    os.environ["DATABASE_URL"] = f"sqlite:///{path}"
+    os.environ["DISCORD_API_URL"] = f"http://127.0.0.1:{port}"  # read when the app is imported
+    os.environ.setdefault("DISCORD_TOKEN", "benchmark")
+    os.environ["LANGUAGE_CLIENT"] = "fake"
+    os.environ["FAKE_LANGUAGE_LATENCY"] = str(args.language_latency)
+    os.environ.setdefault("PROGRESS_STORE", "memory")
+    os.environ.setdefault("LANGUAGE_CACHE_SIZE", "0")
+    os.environ.setdefault("COREF_CACHE_SIZE", "0")
+
+    from benchmarks.discord_stub import DiscordStub, synthetic_channels
+    from harmony import app, db
+    from harmony.migrations import upgrade_schema
+    from harmony.models import Channel
+    from harmony.storage import SQLITE_PROFILE
+
+    data = synthetic_channels(1, args.messages, users=args.users, gap=args.gap, mention_rate=args.mention_rate, burstiness=args.burstiness)
+    channel_id = next(iter(data))
+    stub = DiscordStub(data, args.latency, rate_limit)
+    stub.start(port)
+
+    try:
+        with app.app_context():
+            upgrade_schema()
+            db.session.add(Channel(id=channel_id, running=False, stage=1, progress=0, limit=args.messages))
+            db.session.commit()
+
+            start = time.perf_counter()
+            stages = run_stages(channel_id, path, args.verbose)
+            elapsed = time.perf_counter() - start
+    finally:
+        stub.stop()
+
+    results = {
+        'benchmark': 'stages',
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'config': {
+            'messages': args.messages,
+            'users': args.users,
+            'mention_rate': args.mention_rate,
+            'burstiness': args.burstiness,
+            'gap': args.gap,
+            'latency': args.latency,
+            'rate_limit': list(rate_limit) if rate_limit else None,
+            'language_latency': args.language_latency,
+            'sqlite_profile': SQLITE_PROFILE,
+        },
+        'discord': {'requests': stub.requests, 'rate_limited': stub.limited},
+        'stages': stages,
+        'total_seconds': elapsed,
+        'peak_rss_kib': max(stage['peak_rss_kib'] for stage in stages),
+        'db_bytes': database_size(path),
+    }
+
+    for stage in stages:
+        print(f"stage {stage['stage']}: {stage['rows']} rows in {stage['seconds']:.2f}s ({stage['rows_per_sec'] or 0:.0f} rows/sec), "
+              f"peak rss {stage['peak_rss_kib'] / 1024:.0f}MB, database {stage['db_bytes'] / 2 ** 20:.1f}MB", file=sys.stderr)
+    print(f"{stub.requests} discord requests ({stub.limited} rate limited)", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+# measures how long a fresh process takes to import the app, with and without loading the nlp pipeline and google client
+# usage: python -m benchmarks.bench_startup [number of runs]
+import statistics
+import subprocess
+import sys
+import time
+
+
+# code run in each fresh process
+LAZY = "import harmony"
+EAGER = "import harmony; from harmony import resources; resources.warm()"
+
+
+# returns the median wall time of running code in a fresh interpreter
+def cold_start(code, runs):
+    times = []
+
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True)
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    lazy = cold_start(LAZY, runs)
+    print(f"web tier (resources loaded on first use): {lazy:.2f}s")
+
+    eager = cold_start(EAGER, runs)
+    print(f"with resources loaded at startup:        {eager:.2f}s ({eager / lazy:.1f}x)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# checks the history fetcher against a local stub of the discord api (see discord_stub.py)
+# fetches a synthetic channel whole, up to a limit and from a before cursor, checking that every message arrives once and newest first,
+# and that it sends no more requests than it needs (see fetch)
+# exits with status 1 if any check fails
+# usage: python -m benchmarks.check_fetcher
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+
+# must be set before the app is imported
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'check_fetcher.db')}")
+
+from benchmarks.discord_stub import DiscordStub, synthetic_channels, synthetic_messages
+from benchmarks.discord_stub import channel_id as channel_id_at
+from harmony.fetcher import FETCH_WORKERS, PAGE_SIZE, DiscordSession, MessageFetcher
+
+
+MESSAGES = 5000
+LATENCY = 0.01  # seconds the stub takes per request
+PAGE_TIME = 0.02  # seconds the consumer spends on each page (as the analyzer prepares and stores it)
+
+
+# fetches the pages of the channel until limit messages were read and returns (messages, requests sent, max requests it should take)
+# a fetch takes a request per page and per segment (for the page crossing its end), and with a limit a segment may fetch ahead
+# at most as many pages as the limit needs
+def fetch(stub, session, channel_id, limit=None, before=None):
+    stub.requests = 0
+    segments = None if limit is None else max(1, min(FETCH_WORKERS * 4, -(-limit // PAGE_SIZE)))  # as the analyzer does
+    fetcher = MessageFetcher(session, channel_id, before=before, segments=segments, limit=limit)
+
+    messages = []
+    pages = fetcher.pages()
+    for page in pages:
+        messages += page
+        time.sleep(PAGE_TIME)
+        if limit is not None and len(messages) >= limit:
+            break
+    pages.close()
+
+    time.sleep(10 * LATENCY)  # let the requests in flight finish, so they are counted
+    pages = -(-len(messages[:limit]) // PAGE_SIZE)
+    return messages, stub.requests, (2 if limit else 1) * pages + fetcher.segments + 1
+
+
+def main():
+    data = synthetic_channels(2, MESSAGES)
+    channel_id, empty_id = list(data)
+    data[empty_id] = []
+
+    # a longer history than the limit needs, sent until about now like the history of a live channel
+    created = datetime.now(timezone.utc) - timedelta(days=40)
+    long_id = channel_id_at(created)
+    data[long_id] = synthetic_messages(10 * MESSAGES, created + timedelta(days=4))
+
+    stub = DiscordStub(data, LATENCY)
+    session = DiscordSession('stub', api_url=stub.start())
+    newest_first = [message['id'] for message in reversed(data[channel_id])]
+    failures = 0
+
+    cases = [
+        ('whole history', channel_id, None, None, newest_first),
+        ('limit of 500', channel_id, 500, None, newest_first[:500]),
+        ('limit of 5000', channel_id, MESSAGES, None, newest_first),
+        ('limit of 500 in a long history', long_id, 500, None, [message['id'] for message in reversed(data[long_id])][:500]),
+        ('before a cursor', channel_id, None, newest_first[1234], newest_first[1235:]),
+        ('empty channel', empty_id, None, None, []),
+    ]
+    for name, fetched_id, limit, before, expected in cases:
+        messages, requests, max_requests = fetch(stub, session, fetched_id, limit, before)
+        ids = [message['id'] for message in messages]
+        if limit is not None:
+            ids = ids[:limit]
+
+        ok = ids == expected and requests <= max_requests
+        failures += not ok
+        print(f"{'ok' if ok else 'FAILED'}: {name}, {len(ids)} messages in {requests} requests ({-(-len(ids) // PAGE_SIZE)} pages, at most {max_requests} requests)")
+
+    stub.stop()
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
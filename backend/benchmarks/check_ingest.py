@@ -0,0 +1,83 @@
+# checks that channels sharing users can gather their messages (stage 1) at the same time
+# each channel runs in a thread of its own against a local stub of the discord api (see discord_stub.py), as io workers run them,
+# so their writers store the same users around the same time
+# exits with status 1 if a channel did not finish stage 1 with all of its messages and members
+# usage: python -m benchmarks.check_ingest [channels] [messages per channel]
+import os
+import sys
+import tempfile
+import threading
+import traceback
+
+# must be set before the app is imported
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'check_ingest.db')}")
+os.environ.setdefault("PROGRESS_STORE", "memory")
+os.environ.setdefault("LANGUAGE_CLIENT", "fake")
+
+from benchmarks.bench_stages import free_port
+
+PORT = free_port()
+os.environ["DISCORD_API_URL"] = f"http://127.0.0.1:{PORT}"  # read when the app is imported
+
+from benchmarks.discord_stub import DiscordStub, synthetic_channels
+from harmony import app, db
+from harmony.analyzer import Analyzer
+from harmony.migrations import upgrade_schema
+from harmony.models import Channel, Message, user_bridge_association
+
+
+LATENCY = 0.01  # seconds the stub takes per request
+
+
+# runs stage 1 of the channel, keeping the error it failed with (if any) in errors
+def gather(channel_id, errors):
+    with app.app_context():
+        try:
+            Analyzer(channel_id).start_analysis()
+        except Exception:
+            errors[channel_id] = traceback.format_exc()
+        finally:
+            db.session.remove()
+
+
+def main():
+    channels = int(sys.argv[1]) if len(sys.argv) > 1 else 2
+    messages = int(sys.argv[2]) if len(sys.argv) > 2 else 3000
+
+    data = synthetic_channels(channels, messages)  # every channel is written by the same users
+    stub = DiscordStub(data, LATENCY)
+    stub.start(PORT)
+
+    with app.app_context():
+        upgrade_schema()
+        for channel_id in data:
+            db.session.add(Channel(id=channel_id, running=False, stage=1, progress=0, limit=messages))
+        db.session.commit()
+
+    errors = {}
+    threads = [threading.Thread(target=gather, args=(channel_id, errors)) for channel_id in data]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stub.stop()
+
+    failures = 0
+    with app.app_context():
+        for channel_id, channel_messages in data.items():
+            channel = Channel.query.get(channel_id)
+            stored = Message.query.filter(Message.channel_id == channel_id).count()
+            members = db.session.query(user_bridge_association).filter(user_bridge_association.c.channel_id == channel_id).count()
+            authors = len({message['author']['id'] for message in channel_messages})
+
+            ok = channel_id not in errors and channel.stage == 2 and not channel.running and stored == len(channel_messages) and members == authors
+            failures += not ok
+            print(f"{'ok' if ok else 'FAILED'}: channel {channel_id}, stage {channel.stage}, running {channel.running}, {stored} of {len(channel_messages)} messages, {members} of {authors} members")
+            if channel_id in errors:
+                print(errors[channel_id])
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,176 @@
+# a local stand-in for the parts of the discord api used by the analyzer, serving synthetic channels
+# lets benchmarks fetch real pages over http without a bot token
+import bisect
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+from harmony.fetcher import snowflake
+
+
+USERNAMES = ['alice', 'bob', 'carol', 'dave', 'erin', 'frank', 'grace', 'heidi']
+TEMPLATES = ["{name} is really nice today", "{name} was not great at all", "i love this server so much", "{name} you are so funny",
+             "that was a terrible idea {name}", "thanks {name} that helped", "i am not sure about this", "{name} is always late"]
+
+
+# returns the username of the nth user
+def username(n):
+    return USERNAMES[n] if n < len(USERNAMES) else f'user{n}'
+
+
+# returns count messages (oldest first) of a channel created at start, sent about gap seconds apart by users authors
+# (the users from first_user on, so channels can have users of their own)
+# mention_rate of the messages mention another user, and with burstiness (0 to 1) that share of the messages follow the previous one within a burst
+# (20 times closer than gap) while the pauses between bursts grow, so the channel spans the same time
+def synthetic_messages(count, start, users=len(USERNAMES), gap=60, seed=0, mention_rate=0, burstiness=0, first_user=0):
+    rng = random.Random(seed)
+    time_ = start
+    messages = []
+    burst_gap = gap / 20
+    pause_gap = (gap - burstiness * burst_gap) / (1 - burstiness) if burstiness < 1 else gap
+
+    for i in range(count):
+        if burstiness and rng.random() < burstiness:
+            time_ += timedelta(seconds=rng.expovariate(1 / burst_gap))
+        else:
+            time_ += timedelta(seconds=rng.expovariate(1 / pause_gap))
+        author = first_user + rng.randrange(users)
+        content = rng.choice(TEMPLATES).format(name=username(first_user + rng.randrange(users)))
+        mentions = []
+
+        if mention_rate and rng.random() < mention_rate:
+            mentioned = first_user + rng.randrange(users)
+            mentions.append({'id': str(mentioned + 1), 'username': username(mentioned)})
+            content = f"<@{mentioned + 1}> {content}"
+
+        messages.append({
+            'id': str(snowflake(time_.timestamp()) + i % (1 << 22)),
+            'type': 0,
+            'content': content,
+            'author': {'id': str(author + 1), 'username': username(author)},
+            'timestamp': time_.isoformat(),
+            'mentions': mentions,
+            'attachments': [],
+        })
+
+    return messages
+
+
+# returns the id of a channel created at start
+def channel_id(start):
+    return str(snowflake(start.timestamp()))
+
+
+# serves the messages of channels ({channel id: messages oldest first}) like discord, taking latency seconds per request
+# with rate_limit (requests, seconds), each route allows that many requests per window, sends discord's rate limit headers
+# and answers the requests over the limit with a 429 like discord does
+class DiscordStub:
+    def __init__(self, channels, latency=0, rate_limit=None):
+        self.channels = channels
+        self.ids = {channel: [int(message['id']) for message in messages] for channel, messages in channels.items()}
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.requests = 0
+        self.limited = 0  # number of requests answered with a 429
+        self.lock = threading.Lock()
+        self.buckets = {}  # route -> [requests left, time the window resets]
+        self.server = None
+
+    # counts a request to the route of path against its bucket and returns (status, rate limit headers)
+    def limit(self, path):
+        if self.rate_limit is None:
+            return 200, {}
+
+        parts = urlparse(path).path.strip('/').split('/')
+        route = 'users' if parts[-2] == 'users' else parts[-2]  # discord buckets routes by their major parameter (the channel)
+        requests, window = self.rate_limit
+        now = time.monotonic()
+
+        with self.lock:
+            bucket = self.buckets.get(route)
+            if bucket is None or now >= bucket[1]:
+                bucket = self.buckets[route] = [requests, now + window]
+
+            status = 200
+            if bucket[0] > 0:
+                bucket[0] -= 1
+            else:
+                status = 429
+                self.limited += 1
+
+            headers = {'X-RateLimit-Limit': str(requests), 'X-RateLimit-Remaining': str(bucket[0]), 'X-RateLimit-Reset-After': f'{bucket[1] - now:.3f}', 'X-RateLimit-Bucket': route}
+
+        return status, headers
+
+    # returns the body of a get request to path
+    def respond(self, path):
+        url = urlparse(path)
+        parts = url.path.strip('/').split('/')
+        query = parse_qs(url.query)
+
+        if parts[-2] == 'users':
+            return {'id': parts[-1], 'username': username(int(parts[-1]) - 1)}  # authors have ids from 1
+
+        messages = self.channels.get(parts[-2], [])
+        ids = self.ids.get(parts[-2], [])
+        limit = int(query.get('limit', ['50'])[0])
+
+        # pages are always returned newest first
+        if 'after' in query:
+            first = bisect.bisect_right(ids, int(query['after'][0]))
+            return messages[first:first + limit][::-1]
+
+        end = bisect.bisect_left(ids, int(query['before'][0])) if 'before' in query else len(ids)
+        return messages[max(0, end - limit):end][::-1]
+
+    # starts serving in the background (on port, or any free port) and returns the url of the api
+    def start(self, port=0):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with stub.lock:
+                    stub.requests += 1
+                time.sleep(stub.latency)
+
+                status, headers = stub.limit(self.path)
+                if status == 429:
+                    body = json.dumps({'message': 'You are being rate limited.', 'retry_after': float(headers['X-RateLimit-Reset-After']), 'global': False}).encode('utf-8')
+                else:
+                    body = json.dumps(stub.respond(self.path)).encode('utf-8')
+
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f'http://127.0.0.1:{self.server.server_port}'
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# returns {channel id: messages} of count channels with messages messages each, all created at the same time
+# every channel is written by the same users if shared_users, and by users of its own otherwise
+# options (users, gap, mention_rate, burstiness) are passed on to synthetic_messages
+def synthetic_channels(count, messages, start=datetime(2022, 1, 1, tzinfo=timezone.utc), shared_users=True, **options):
+    users = options.get('users', len(USERNAMES))
+    channels = {}
+    for i in range(count):
+        created = start + timedelta(milliseconds=i)
+        channels[channel_id(created)] = synthetic_messages(messages, created + timedelta(days=1), seed=i, first_user=0 if shared_users else i * users, **options)
+
+    return channels
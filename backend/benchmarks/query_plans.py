@@ -0,0 +1,193 @@
+# checks that the hot queries of the analyzer, helpers and routes are answered with indexes
+# runs each code path on a small synthetic channel in a scratch database, captures the sql it sends to sqlite
+# and prints the EXPLAIN QUERY PLAN of every statement, along with the lookups sqlite does to cascade deletes
+# exits with status 1 if any of them scans a whole table (tests/test_query_plans.py runs the same check under pytest)
+# usage: python -m benchmarks.query_plans [-v]
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta, timezone
+
+# must be set before the app is imported
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'query_plans.db')}")
+os.environ.setdefault("LANGUAGE_CLIENT", "fake")
+os.environ.setdefault("LANGUAGE_CACHE_SIZE", "0")
+os.environ.setdefault("COREF_CACHE_SIZE", "0")
+os.environ.setdefault("PROGRESS_STORE", "memory")
+
+from sqlalchemy import event, text
+from harmony import app, db, summary
+from harmony.analyzer import Analyzer
+from harmony.helpers import Helper
+from harmony.models import Channel, Message, User, UserAlternate
+from harmony.progress import ProgressTracker
+from harmony.resolver import EntityResolver
+
+
+CHANNEL_ID = '1'
+USERNAMES = ['alice', 'bob', 'carol']
+CONTENTS = ["alice is really nice today", "bob was not great at all", "i love this server", "carol you are so funny"]
+IGNORED = ('PRAGMA', 'BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE', 'CREATE', 'EXPLAIN')
+
+statements = {}  # sql -> parameters of the first execution, in the order they were first sent
+capturing = False
+
+
+# remembers every statement sent while capturing
+def capture(connection, cursor, statement, parameters, context, executemany):
+    if capturing and not statement.lstrip().upper().startswith(IGNORED):
+        statements.setdefault(statement, parameters[0] if executemany else parameters)
+
+
+# adds the channel, its users and count messages sent a minute apart (with longer gaps now and then) after start
+def add_messages(count, start, first_id=0):
+    messages = []
+    for i in range(count):
+        timestamp = start + timedelta(minutes=i + 5 * (i // 7))
+        messages.append(Message(id=str(first_id + i), channel_id=CHANNEL_ID, user_id=str(i % len(USERNAMES)), content=CONTENTS[i % len(CONTENTS)], timestamp=timestamp.isoformat()))
+
+    db.session.add_all(messages)
+    db.session.commit()
+    return start + timedelta(minutes=count + 5 * (count // 7))
+
+
+# gives every clustered message without a coref message its own content, instead of running the nlp pipeline
+def resolve_without_nlp():
+    db.session.execute(text('''
+        INSERT INTO coref_message (cluster_message_id, content)
+        SELECT cluster_message.id, message.content FROM cluster_message JOIN message ON message.id = cluster_message.message_id
+        WHERE cluster_message.id NOT IN (SELECT cluster_message_id FROM coref_message)
+    '''))
+    db.session.commit()
+
+
+# runs the code paths whose queries are checked
+def run_code_paths():
+    global capturing
+
+    channel = Channel(id=CHANNEL_ID, running=False, stage=3, progress=0, limit=1000)
+    db.session.add(channel)
+    for i, username in enumerate(USERNAMES):
+        channel.users.append(User(id=str(i), username=username))
+    db.session.add(UserAlternate(channel_id=CHANNEL_ID, user_id='0', name='al'))
+    db.session.commit()
+    end = add_messages(200, datetime(2022, 1, 1, tzinfo=timezone.utc))
+
+    capturing = True
+
+    # stages 3 and 5 (stage 4 only runs its clearing queries, as it needs the nlp pipeline)
+    Analyzer(CHANNEL_ID).start_analysis()
+    channel = Channel.query.get(CHANNEL_ID)
+    channel.stage = 5
+    db.session.commit()
+    capturing = False
+    resolve_without_nlp()
+    capturing = True
+    Analyzer(CHANNEL_ID).start_analysis()
+
+    # refresh
+    capturing = False
+    add_messages(20, end, first_id=200)
+    capturing = True
+    analyzer = Analyzer(CHANNEL_ID)
+    analyzer.channel.running = True
+    analyzer.tracker = ProgressTracker(CHANNEL_ID, 6)
+    analyzer.recluster_tail()
+    capturing = False
+    resolve_without_nlp()
+    capturing = True
+    analyzer.resolve_coreferences(pending=True)  # only looks for pending clusters, as there are none left
+    analyzer.analyze_sentiments(pending=True)
+    analyzer.channel.running = False
+    db.session.commit()
+
+    # planning the shards of stages 3 to 5
+    for stage in (3, 4, 5):
+        analyzer.plan_shards(stage)
+
+    # helpers
+    helper = Helper(CHANNEL_ID)
+    helper.min_max_sentiments()
+    helper.top_sentiments(10, user_id='0')
+    helper.user_extremes()
+    helper.score_percentiles([0, 50, 100])
+    helper.score_histogram(20)
+    helper.avg_sentiment('0', '1')
+    helper.sentiment_matrix()
+    helper.sentiment_matrix(18993, 18994)
+    EntityResolver(CHANNEL_ID)
+    summary.pair_totals(CHANNEL_ID)
+
+    # routes
+    client = app.test_client()
+    for url in ['stage', 'limit', 'clustering', 'alts', 'pog', 'progress', 'sentiments/users', 'sentiments/messages', 'sentiments/messages/extremes', 'sentiments/distribution',
+            'messages', f'messages?limit=10&cursor={2 ** 41}_{10 ** 18}']:
+        response = client.get(f'/api/channel/{CHANNEL_ID}/{url}')
+        response.get_data()  # runs the queries of streamed responses
+        assert response.status_code == 200, url
+
+    capturing = False
+
+
+# returns (table, foreign key column) of every foreign key, which sqlite looks up when a parent row is deleted
+def foreign_keys():
+    return [(table.name, column.name) for table in db.metadata.sorted_tables for column in table.columns if column.foreign_keys]
+
+
+# returns the details of the query plan of statement
+def query_plan(connection, statement, parameters):
+    return [row[3] for row in connection.execute(f"EXPLAIN QUERY PLAN {statement}", parameters or ())]
+
+
+# returns whether a step of a query plan reads every row of a table (or of an index of it)
+def is_full_scan(detail, tables):
+    words = detail.split()
+    return len(words) > 1 and words[0] == 'SCAN' and words[1] in tables
+
+
+# runs the code paths on a fresh database and returns (statement, query plan, whether the plan scans a whole table)
+# of every statement they sent and of the lookups sqlite does to cascade deletes
+def check_plans():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        for engine in (db.engine, db.read_engine):  # read-only routes use connections of their own (see harmony.storage)
+            if engine is not None:
+                event.listen(engine, 'before_cursor_execute', capture)
+        run_code_paths()
+
+        checks = list(statements.items())
+        checks += [(f'SELECT 1 FROM "{table}" WHERE "{column}" = ?', ('1',)) for table, column in foreign_keys()]
+
+        tables = {table.name for table in db.metadata.sorted_tables}
+        connection = db.engine.raw_connection()
+        results = []
+
+        for statement, parameters in checks:
+            plan = query_plan(connection, statement, parameters)
+            results.append((statement, plan, any(is_full_scan(detail, tables) for detail in plan)))
+
+        connection.close()
+
+    return results
+
+
+def main():
+    verbose = '-v' in sys.argv[1:]
+    results = check_plans()
+    failures = 0
+
+    for statement, plan, full_scan in results:
+        failures += full_scan
+
+        if full_scan or verbose:
+            print(f"{'FULL SCAN' if full_scan else 'ok'}: {' '.join(statement.split())}")
+            for detail in plan:
+                print(f"    {detail}")
+
+    print(f"{len(results)} statements checked, {failures} with full table scans")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,34 +1,42 @@
+import os
 from celery import Celery
 from dotenv import load_dotenv
 from flask import Flask
 from flask_cors import CORS
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import event
 
 
 # load variables from .env
 load_dotenv()
+from harmony.storage import PRAGMAS, SQLITE_PROFILE, RoutingSQLAlchemy, engine_options, read_only_engine, set_pragmas  # configured from the environment, so imported once .env is loaded
 
 app = Flask(__name__)
 CORS(app)
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///database.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv("DATABASE_URL", 'sqlite:///database.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db = SQLAlchemy(app)
+SQLITE = 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']
+if SQLITE:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+db = RoutingSQLAlchemy(app)
 
-# enable foreign key support if using sqlite
-if 'sqlite' in app.config['SQLALCHEMY_DATABASE_URI']:
-    def enable_fk(dbapi_con, _):
-        dbapi_con.execute('PRAGMA foreign_keys=ON')
-    
+# enable foreign key support (and the pragmas of the profile) if using sqlite
+if SQLITE:
     with app.app_context():
-        from sqlalchemy import event
-        event.listen(db.engine, 'connect', enable_fk)
+        set_pragmas(db.engine, PRAGMAS[SQLITE_PROFILE])
 
-celery = Celery('harmony', broker='amqp://', include=['harmony.tasks'])
+# results are only needed to join the shards of a stage (see Analyzer.start_shards), which needs a backend shared by every worker
+celery = Celery('harmony', broker=os.getenv("CELERY_BROKER_URL", 'amqp://'), backend=os.getenv("CELERY_RESULT_BACKEND", 'db+sqlite:///celery-results.db'), include=['harmony.tasks'])
 
 from harmony import routes
+from harmony import migrations  # the schema is upgraded by flask upgrade-db, not when the app is imported
+
+with app.app_context():
+    # the api reads through read-only connections (the database must exist, see harmony.migrations)
+    if SQLITE and SQLITE_PROFILE == 'production' and db.engine.url.database not in (None, '', ':memory:'):
+        db.read_engine = read_only_engine(db.engine)
+    db.engine.dispose()  # pooled connections are not shared with forked processes (celery prefork workers)
 # from harmony import models
-# celery -A harmony.celery worker -l INFO
+# FLASK_APP=app flask upgrade-db  (once before the api and the workers start)
+# celery -A harmony.celery worker -l INFO  (or python worker.py io|cpu|coref for the pool of one queue)
 # celery -A harmony.celery purge
 # sudo rabbitmq-server
 # sudo rabbitmqctl stop
\ No newline at end of file
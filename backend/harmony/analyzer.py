@@ -1,28 +1,44 @@
-import neuralcoref
-import re
-import spacy
-from datetime import datetime, timedelta
-from harmony import db
-from harmony.helpers import Helper, send_request
-from harmony.models import Channel, CorefMessage, ClusterMessage, Message, MessageCluster, MessageSentiment, User, UserAlternate, UserSentiment
-from google.cloud import language_v1
+import os
+import numpy as np
+from collections import deque
+from contextlib import contextmanager
+from datetime import timedelta
+from itertools import groupby
+from sqlalchemy import func
+from harmony import checkpoints, db, progress, resources, summary
+from harmony.clustering import MESSAGE_TIME, cluster_bounds
+from harmony.coref import CHUNK_SIZE, CorefEngine
+from harmony.directory import QUERY_CHUNK
+from harmony.documents import pack_documents
+from harmony.fetcher import FETCH_WORKERS, PAGE_SIZE, MessageFetcher
+from harmony.helpers import Helper, discord
+from harmony.pipeline import Pipeline
+from harmony.progress import ProgressTracker, StopSignal
+from harmony.resolver import EntityResolver
+from harmony.shards import document_shards, id_shards, shard_count, time_shards
+from harmony.storage import take_write_lock
+from harmony.models import Channel, CorefMessage, ClusterMessage, Message, MessageCluster, MessageSentiment, User, UserSentiment
 
 
 # TODO: commit all db commands (not in loop but at very end so all commands get ran at once for maximum optimialness)
 
-# load nlp
-nlp = spacy.load('en_core_web_sm')
-neuralcoref.add_to_pipe(nlp, blacklist=False)  # disable blacklist to allow "i", "you", etc. to be resolved
-
-# instantiate google client
-client = language_v1.LanguageServiceClient()
-type_ = language_v1.types.Document.Type.PLAIN_TEXT
-language = "en"
-encoding_type = language_v1.EncodingType.UTF8
-
 # constants used by create_clusters
 MAX_CUM_DIST = timedelta(minutes=10)  # max amount of time between first and last message in the cluster
 MAX_DIST = timedelta(minutes=2)  # max amount of time between consecutive messages in the cluster
+CLUSTER_BATCH_SIZE = int(os.getenv("CLUSTER_BATCH_SIZE", 10000))  # number of clusters written per transaction
+TAIL_CHUNK = 1000  # number of messages read at a time while looking for the start of the tail to re-cluster
+SHARDED_STAGES = (3, 4, 5)  # stages that can be split into shards run by several workers at the same time
+
+
+# filters query to the rows whose column is within bounds ((since, until) with since inclusive, until exclusive and None for an open end)
+def within(query, column, bounds):
+    since, until = bounds or (None, None)
+    if since is not None:
+        query = query.filter(column >= since)
+    if until is not None:
+        query = query.filter(column < until)
+
+    return query
 
 
 class Analyzer:
@@ -30,10 +46,20 @@ class Analyzer:
         self.channel_id = channel_id
         self.channel = Channel.query.get(self.channel_id)
         self.helper = Helper(self.channel_id)
+        self.tracker = None  # counts the progress of the stage being run
+        self.signal = StopSignal(self.channel_id)  # tells the hot loops to stop without reading the channel
+
+    # returns whether analysis was asked to stop (cheap enough to call for every item)
+    def stopped(self):
+        return self.signal.is_set()
 
     # starts analyzing the messages
     # is idempotent as it does nothing if self.channel.running is True
-    def start_analysis(self):
+    # in pipeline mode, stages 1 to 5 run at the same time (from stage 1) instead of one stage per call
+    # (a channel without users yet only gathers its messages, as stage 2 can only set alternate names for stored users)
+    # in shards mode, stages 3 to 5 are split into shards run by every worker (see start_shards)
+    # a stage that was stopped continues from its checkpoint (see harmony.checkpoints) instead of starting over
+    def start_analysis(self, mode='stages'):
         print("starting analysis")
 
         # check if channel previously analyzed
@@ -51,69 +77,259 @@ class Analyzer:
         
         # set running to true so other instances cannot analyze until this instance finishes
         self.channel.running = True
+        progress.get_store().request_stop(self.channel_id, False)  # withdraw a request sent while the last run was being released
         
-        # reset progress
+        # reset progress (tracked out of band while the stage runs, see harmony.progress)
         self.channel.progress = 0
         db.session.commit()
 
-        if self.channel.stage == 0:
+        with self.release_on_failure():
+            self.run_current_stage(mode)
+
+    # runs the stage the channel is at, once start_analysis claimed the channel
+    def run_current_stage(self, mode):
+        stage = self.channel.stage
+        if mode == 'pipeline' and stage == 1 and self.channel.users.count() == 0:
+            print("channel has no users to set alternate names for yet, gathering messages without the pipeline")
+            mode = 'stages'
+
+        sharded = mode == 'shards' and stage in SHARDED_STAGES
+        resume = checkpoints.load(self.channel_id, stage) if mode != 'pipeline' and not sharded else None  # output of the stage kept from a stopped run
+        if resume is not None:
+            print(f"resuming stage {stage}")
+        elif 1 <= stage <= 5:
+            checkpoints.clear(self.channel_id, stage)  # later stages are redone from scratch too
+            db.session.commit()
+
+        if stage == 1 and resume is None:
+            progress.get_store().clear(self.channel_id)  # the progress of later stages is out of date once messages are gathered again
+        if 1 <= stage <= 5 and not (stage == 1 and mode == 'pipeline') and not sharded:
+            progress.get_store().clear(self.channel_id, stage)  # forget the shards of an earlier run
+            self.tracker = ProgressTracker(self.channel_id, stage)
+
+        if stage == 0:
             # stage 0: set limit
             pass
-        elif self.channel.stage == 1:
+        elif stage == 1:
             # stage 1: gather messages
-            self.channel.users = []  # remove user relationships
-            Message.query.filter(Message.channel_id == self.channel_id).delete()  # clear all messages
-            db.session.commit()
-
-            self.get_messages()
-        elif self.channel.stage == 2:
+            if resume is None:
+                self.channel.users = []  # remove user relationships
+                Message.query.filter(Message.channel_id == self.channel_id).delete()  # clear all messages
+                summary.clear(self.channel_id)  # clear user sentiment totals
+                db.session.commit()
+
+            if mode == 'pipeline':
+                self.run_pipeline()
+                return
+
+            self.get_messages(resume=resume)
+        elif stage == 2:
             # stage 2: establish user alternates
             self.channel.user_alternates.delete()  # clear all user alternates
             db.session.commit()
 
             pass
-        elif self.channel.stage == 3:
+        elif stage == 3:
             # stage 3: cluster messages
-            MessageCluster.query.filter(MessageCluster.channel_id == self.channel_id).delete()  # clear all message clusters
-            db.session.commit()
+            if resume is None:
+                MessageCluster.query.filter(MessageCluster.channel_id == self.channel_id).delete()  # clear all message clusters
+                db.session.commit()
+
+            if sharded:
+                self.start_shards()
+                return
 
-            self.create_clusters()
-        elif self.channel.stage == 4:
+            self.create_clusters(resume=resume, checkpoint=lambda value: checkpoints.save(self.channel_id, 3, value))
+        elif stage == 4:
             # stage 4: coreference resolution
-            coref_subquery = CorefMessage.query.join(Message, CorefMessage.message).filter(Message.channel_id == self.channel_id).with_entities(CorefMessage.id).subquery()
-            CorefMessage.query.filter(CorefMessage.id.in_(coref_subquery)).delete(synchronize_session=False)  # clear all coref messages
-            db.session.commit()
+            if resume is None:
+                coref_subquery = CorefMessage.query.join(Message, CorefMessage.message).filter(Message.channel_id == self.channel_id).with_entities(CorefMessage.id).subquery()
+                CorefMessage.query.filter(CorefMessage.id.in_(coref_subquery)).delete(synchronize_session=False)  # clear all coref messages
+                db.session.commit()
 
-            self.resolve_coreferences()
-        elif self.channel.stage == 5:
+            if sharded:
+                self.start_shards()
+                return
+
+            self.resolve_coreferences(resume=resume)
+        elif stage == 5:
             # stage 5: sentiment analysis
-            msg_sent_subquery = MessageSentiment.query.join(Message, MessageSentiment.message).filter(Message.channel_id == self.channel_id).with_entities(MessageSentiment.id).subquery()
-            user_sent_subquery = UserSentiment.query.join(Message, UserSentiment.message).filter(Message.channel_id == self.channel_id).with_entities(UserSentiment.id).subquery()
+            if resume is None:
+                msg_sent_subquery = MessageSentiment.query.join(Message, MessageSentiment.message).filter(Message.channel_id == self.channel_id).with_entities(MessageSentiment.id).subquery()
+                user_sent_subquery = UserSentiment.query.join(Message, UserSentiment.message).filter(Message.channel_id == self.channel_id).with_entities(UserSentiment.id).subquery()
 
-            MessageSentiment.query.filter(MessageSentiment.id.in_(msg_sent_subquery)).delete(synchronize_session=False)  # clear message sentiments
-            UserSentiment.query.filter(UserSentiment.id.in_(user_sent_subquery)).delete(synchronize_session=False)  # clear user sentiments
-            db.session.commit()
+                MessageSentiment.query.filter(MessageSentiment.id.in_(msg_sent_subquery)).delete(synchronize_session=False)  # clear message sentiments
+                UserSentiment.query.filter(UserSentiment.id.in_(user_sent_subquery)).delete(synchronize_session=False)  # clear user sentiments
+                summary.clear(self.channel_id)  # clear user sentiment totals
+                db.session.commit()
 
-            self.analyze_sentiments()
+            if sharded:
+                self.start_shards()
+                return
+
+            self.analyze_sentiments(resume=resume)
         else:
             # stage X: finished
-            self.channel.running = False
-            db.session.commit()
+            self.release()
             return
         
-        # move to the next stage if current stage wasnt aborted
+        # keep the final progress of the stage
+        if self.tracker is not None:
+            self.tracker.finish()
+            self.channel.progress = self.tracker.done
+
+        # move to the next stage if current stage wasnt aborted (a stopped stage keeps its checkpoint)
         print("about to upgrade stage")
-        if self.channel.running:
+        if not self.stopped():
             print("upgraded stage")
             self.channel.stage = Channel.stage + 1
-            self.channel.running = False
-            db.session.commit()
+            checkpoints.clear(self.channel_id, stage)
+        self.release()
     
+    # runs stages 1, 3, 4 and 5 at the same time, finishing the analysis (see harmony.pipeline)
+    # alternate names must be set before starting, as stage 2 is skipped (so only channels whose users were stored by an earlier run get here)
+    # the stages always start over, as they only keep checkpoints when run one at a time
+    def run_pipeline(self):
+        MessageCluster.query.filter(MessageCluster.channel_id == self.channel_id).delete()  # clear all message clusters
+        db.session.commit()
+
+        pipeline = Pipeline(self.channel_id)
+        finished = pipeline.run()
+
+        # the stages ran in their own sessions
+        db.session.refresh(self.channel)
+        self.channel.progress = pipeline.trackers[1].done if 1 in pipeline.trackers else 0  # number of messages gathered
+        if finished:
+            self.channel.stage = 6
+        checkpoints.clear(self.channel_id)
+        self.release()
+
+    # splits the current stage into shards and runs them as a celery chord, so idle workers share the stage
+    # the channel keeps running until finish_shards has merged the results of every shard
+    def start_shards(self):
+        from celery import chord
+        from harmony.tasks import SHARD_TASKS, finish_shards_task, stop_analysis_task  # imported here as the tasks import this module
+
+        stage = self.channel.stage
+        shards = self.plan_shards(stage)
+        progress.get_store().clear(self.channel_id, stage)  # forget the shards of an earlier run
+        print(f"running stage {stage} in {len(shards)} shards")
+
+        # a failed shard stops the others and the channel
+        finish = finish_shards_task.s(self.channel_id, stage).on_error(stop_analysis_task.si(self.channel_id, True))
+        chord(SHARD_TASKS[stage].s(self.channel_id, shard, bounds) for shard, bounds in enumerate(shards))(finish)
+
+    # returns the bounds of each shard of stage, splitting it where its shards give the same results as a single run
+    def plan_shards(self, stage):
+        if stage == 3:
+            # split the messages at gaps no cluster can span
+            times = [row[0] for row in db.session.connection().exec_driver_sql(
+                f"SELECT {MESSAGE_TIME} AS time FROM message WHERE channel_id = ? ORDER BY time", (self.channel_id,)
+            )]
+            return time_shards(times, self.cluster_distances()[0], shard_count(len(times)))
+        elif stage == 4:
+            # split the clusters by id
+            ids = [row.id for row in MessageCluster.query.filter(MessageCluster.channel_id == self.channel_id).with_entities(MessageCluster.id).order_by(MessageCluster.id)]
+            return id_shards(ids, shard_count(len(ids)))
+        else:
+            # split the resolved messages between the documents they are packed into
+            rows = db.session.query(CorefMessage.id, func.length(CorefMessage.content)).join(Message, CorefMessage.message)\
+                .filter(Message.channel_id == self.channel_id).order_by(CorefMessage.id).all()
+            return document_shards([row[0] for row in rows], [row[1] for row in rows], shard_count(len(rows)))
+
+    # runs a shard of stage (a task of start_shards) and returns the number of items it processed and whether it was stopped
+    def run_shard(self, stage, shard, bounds):
+        self.tracker = ProgressTracker(self.channel_id, stage, shard=shard)
+
+        # a failed shard fails the chord, whose errback releases the channel
+        try:
+            if stage == 3:
+                self.create_clusters(*bounds)
+            elif stage == 4:
+                self.resolve_coreferences(bounds=bounds)
+            elif stage == 5:
+                self.analyze_sentiments(bounds=bounds)
+        finally:
+            self.tracker.finish()
+        return {'done': self.tracker.done, 'stopped': self.stopped()}
+
+    # finishes stage once every shard has run (the body of the chord of start_shards)
+    # results are the results of run_shard
+    def finish_shards(self, stage, results):
+        with self.release_on_failure():
+            self.channel.progress = sum(result['done'] for result in results)
+
+            # move to the next stage if no shard was stopped
+            if not any(result['stopped'] for result in results) and not self.stopped():
+                print(f"finished stage {stage} in {len(results)} shards")
+                self.channel.stage = stage + 1
+        self.release()
+
+    # ends the run of the channel once it stopped writing, so the channel can be started again
+    # the request that stopped the run is withdrawn first, as the next run must never see it (nor lose a stop meant for it)
+    def release(self):
+        progress.get_store().request_stop(self.channel_id, False)
+        self.channel.running = False
+        db.session.commit()
+
+    # releases the channel if the run inside fails, so it can be started again instead of staying running
+    # the stage of the failed run is not advanced (and a stopped stage keeps its checkpoint)
+    @contextmanager
+    def release_on_failure(self):
+        try:
+            yield
+        except BaseException:
+            db.session.rollback()  # the failed transaction cannot be committed
+            if self.tracker is not None and self.tracker.running:
+                self.tracker.finish()
+            self.release()
+            raise
+
     # stops analysis (analysis may continue for a short time until a breaking condition is reached)
+    # runs in another process than the analysis, so the request to stop is stored where the analysis checks for it
+    # the channel keeps running until the stopped run releases it, so a new run cannot start while the stopped one still writes
+    # with release, the channel is released right away, for runs that cannot release it themselves (the shards of a failed chord)
     # is idempotent
-    def stop_analysis(self):
-        if self.channel is not None:
-            self.channel.running = False
+    def stop_analysis(self, release=False):
+        if self.channel is not None and self.channel.running:
+            progress.get_store().request_stop(self.channel_id)
+
+            if release:
+                self.channel.running = False
+                db.session.commit()
+
+    # analyzes the messages sent since the channel was analyzed, keeping the results of older messages
+    # only clusters that can change are recomputed, so a refresh costs about as much as the new messages
+    # can be stopped and started again, continuing where it stopped
+    def refresh_analysis(self):
+        print("refreshing analysis")
+
+        if self.channel is None or self.channel.stage <= 5 or self.channel.last_message_id is None:
+            # a refresh needs a finished analysis to build on
+            print("channel has not been analyzed")
+            return
+        elif self.channel.running:
+            print("channel is already running")
+            return
+
+        self.channel.running = True
+        progress.get_store().request_stop(self.channel_id, False)  # withdraw a request sent while the last run was being released
+        db.session.commit()
+
+        # each step is tracked as the stage it repeats
+        steps = [(1, self.get_new_messages), (3, self.recluster_tail), (4, lambda: self.resolve_coreferences(pending=True)), (5, lambda: self.analyze_sentiments(pending=True))]
+        with self.release_on_failure():
+            for stage, step in steps:
+                # make sure analysis is running
+                if self.stopped():
+                    break
+
+                progress.get_store().clear(self.channel_id, stage)  # forget the shards of an earlier run
+                self.tracker = ProgressTracker(self.channel_id, stage)
+                step()
+                self.tracker.finish()
+
+        self.release()
 
     # # sets the max number of messages to analyze
     # def set_limit(self, limit):
@@ -124,43 +340,93 @@ class Analyzer:
     #         db.session.commit()
 
     # stores all messages in the channel in the database
-    def get_messages(self):
-        last_id = None  # stores id of the last gotten message
-        num_msgs = 0  # number of messages gotten
+    # emit is called with [(message, username)] of each page once the page has been stored
+    # continues after the pages stored by a stopped run if resume (the checkpoint of stage 1) is given
+    def get_messages(self, emit=None, resume=None):
+        writer = self.helper.writer  # messages are written in batches of whole pages
+        num_msgs = resume['count'] if resume else 0  # number of messages gotten
         limit = self.channel.limit  # max number of messages to get
+        newest = resume['newest'] if resume else None  # id of the newest message in the channel
+        self.tracker.total = limit
+        self.tracker.update(num_msgs)
+
+        # only fetch as many history segments concurrently as the limit could need, and no more pages ahead than it needs
+        fetcher = MessageFetcher(discord, self.channel_id, before=resume['before'] if resume else None, segments=max(1, min(FETCH_WORKERS * 4, -(-(limit - num_msgs) // PAGE_SIZE))), limit=limit - num_msgs)
+        pages = fetcher.pages()
+
+        # the next pages are fetched in the background while this page is being prepared
+        # (the fetching threads are stopped once pages is closed, also if storing a page fails)
+        try:
+            for data in pages:
+                # the first page holds the newest message, which later refreshes continue from
+                if newest is None:
+                    newest = max(data, key=lambda message: int(message['id']))['id']
+
+                # resolve every user on the page together instead of one at a time
+                self.helper.prefetch_users(data)
+
+                # prepare messages for analysis
+                page = []
+                for message in self.helper.prepare_messages(data):
+                    # stop once message limit has been reached
+                    if num_msgs >= limit:
+                        break
 
-        while True:
-            data = send_request(f"/channels/{self.channel_id}/messages?limit=100{f'&before={last_id}' if last_id else ''}")
+                    # store user and message in database
+                    page.append((message, self.helper.add_user(message['author']['id'])))
+                    writer.add_message(message)
+                    num_msgs += 1
 
-            # break out of loop once there are no more messages
-            if not data:
-                break
-            
-            for message in data:
-                # make sure analysis is running
-                if not self.channel.running:
-                    break
-                
-                # stop once message limit has been reached
-                if num_msgs >= limit:
-                    break
+                # pages are stored whole with the checkpoint of the last one, so a stopped run continues with the page after it
+                writer.checkpoint = {'before': data[-1]['id'], 'newest': newest, 'count': num_msgs}
+                self.tracker.update(num_msgs)
 
-                # prepare message for analysis
-                message = self.helper.prepare_message(message)
-                if message is not None:
-                    # store user and message in database
-                    self.helper.add_user(message['author']['id'])
+                if emit is not None:
+                    # messages must be stored before later stages can refer to them
+                    writer.flush()
+                    emit(page)
+                else:
+                    writer.flush_full()
 
-                    db.session.add(Message(id=message['id'], channel_id=self.channel_id, user_id=message['author']['id'], content=message['content'], timestamp=message['timestamp']))
-                    num_msgs += 1
-                    self.channel.progress = num_msgs  # update progress
-                    db.session.commit()
-            
-            # update id of last message
-            last_id = data[-1]['id']
-        
-        db.session.commit()
+                # stop fetching pages once analysis is stopped or the limit is reached
+                if self.stopped() or num_msgs >= limit:
+                    break
+        finally:
+            pages.close()
+
+        # write the last batch (even if analysis was stopped, as it only holds whole pages)
+        if not self.stopped():
+            writer.last_message_id = newest
+        writer.flush()
     
+    # stores the messages sent after the newest stored message, oldest first
+    # the high-water mark moves forward with every batch, so a stopped refresh never leaves a gap
+    def get_new_messages(self):
+        writer = self.helper.writer  # messages are written in batches of whole pages
+        fetcher = MessageFetcher(discord, self.channel_id)
+
+        for data in fetcher.pages_after(self.channel.last_message_id):
+            # resolve every user on the page together instead of one at a time
+            self.helper.prefetch_users(data)
+
+            # prepare messages for analysis
+            for message in self.helper.prepare_messages(data):
+                # store user and message in database
+                self.helper.add_user(message['author']['id'])
+                writer.add_message(message)
+                self.tracker.add()
+
+            # messages that were not prepared do not need to be fetched again either
+            writer.last_message_id = data[-1]['id']
+            writer.flush_full()
+
+            # make sure analysis is running
+            if self.stopped():
+                break
+
+        # the messages written so far are kept even if the refresh was stopped
+        writer.flush()
+
     # # sets alternate names for each user
     # # each alternate is formatted as ("user_id", "alternate name") | (string, string)
     # def set_alternates(self, alternates):
@@ -181,162 +447,288 @@ class Analyzer:
     #     self.channel.running = False
     #     db.session.commit()
 
+    # returns (max_dist, max_cum_dist) of the channel in milliseconds
+    def cluster_distances(self):
+        max_dist = timedelta(seconds=self.channel.max_dist) if self.channel.max_dist is not None else MAX_DIST
+        max_cum_dist = timedelta(seconds=self.channel.max_cum_dist) if self.channel.max_cum_dist is not None else MAX_CUM_DIST
+        return max_dist // timedelta(milliseconds=1), max_cum_dist // timedelta(milliseconds=1)
+
     # creates message clusters based on time frame to prepare for coreference resolution
-    def create_clusters(self):
-        # get all messages
-        messages = self.channel.messages
-        messages_to_add = []  # messages that are going to be added to the current cluster
-
-        # add all messages in messages_to_add to cluster
-        def add_cluster():
-            nonlocal messages_to_add
-
-            # find id for this cluster
-            cluster = MessageCluster(channel_id=self.channel_id)
-            db.session.add(cluster)
-            db.session.flush()
-            db.session.refresh(cluster)  # refresh so cluster.id is available
-
-            # add all messages to cluster
-            for message_to_add in messages_to_add:
-                db.session.add(ClusterMessage(message_id=message_to_add.id, message_cluster_id=cluster.id))
-            
-            self.channel.progress = Channel.progress + 1  # update progress
-            messages_to_add = []
-
-        # store times of first and last message in cluster
-        first_time = datetime.fromisoformat(messages[0].timestamp)
-        last_time = first_time
-
-        for message in messages:
+    # only clusters messages sent at or after since and before until (milliseconds) if given
+    # continues after the clusters stored by a stopped run if resume (the checkpoint of stage 3) is given
+    # checkpoint is called with the checkpoint of each batch of clusters, in the transaction storing them
+    def create_clusters(self, since=None, until=None, resume=None, checkpoint=None):
+        # get the id and time (computed by sqlite) of all messages from newest to oldest
+        # (plain sql, as building a million rows through the orm takes longer than clustering them)
+        query = f"SELECT id, {MESSAGE_TIME} AS time FROM message WHERE channel_id = ? AND time >= ? AND time < ?"
+        params = [self.channel_id, since if since is not None else float('-inf'), until if until is not None else float('inf')]
+        if resume:
+            # a cluster always starts at the message after the last stored cluster, so clustering the older messages gives the same clusters
+            query += " AND time <= ? AND (time, id) < (?, ?)"
+            params += [resume['time'], resume['time'], resume['id']]
+
+        rows = db.session.connection().exec_driver_sql(query + " ORDER BY time DESC, id DESC", tuple(params)).fetchall()
+        message_ids = [row[0] for row in rows]
+        times = np.fromiter((row[1] for row in rows), dtype=np.int64, count=len(rows))
+
+        # find every cluster at once
+        starts, ends = cluster_bounds(times, *self.cluster_distances())
+        self.tracker.total = len(starts) + (resume['clusters'] if resume else 0)
+        self.tracker.update(resume['clusters'] if resume else 0)
+
+        for i in range(0, len(starts), CLUSTER_BATCH_SIZE):
             # make sure analysis is running
-            if not self.channel.running:
+            if self.stopped():
                 break
 
-            message_time = datetime.fromisoformat(message.timestamp)
+            batch = list(zip(starts[i:i + CLUSTER_BATCH_SIZE].tolist(), ends[i:i + CLUSTER_BATCH_SIZE].tolist()))
+            self.write_clusters([message_ids[start:end] for start, end in batch], self.tracker)
 
-            # check if message is not within the bounds of the current cluster
-            if first_time - message_time > MAX_CUM_DIST or last_time - message_time > MAX_DIST:
-                add_cluster()
-                first_time = message_time
-            
-            messages_to_add.append(message)
-            last_time = message_time
-        
-        # add last cluster
-        if len(messages_to_add) > 0 and self.channel.running:
-            add_cluster()
-        
-        db.session.commit()
+            # the oldest message of the batch
+            if checkpoint is not None:
+                last = batch[-1][1] - 1
+                checkpoint({'time': int(times[last]), 'id': message_ids[last], 'clusters': self.tracker.done})
+            db.session.commit()
 
-    # resolves coreferences in message clusters
-    def resolve_coreferences(self):
-        user_pattern = re.compile(r"^.+ said $")  # pattern matches "username said "
+    # adds clusters (lists of message ids) and returns the ids of their cluster messages
+    # counts the clusters on tracker if given
+    def write_clusters(self, clusters, tracker=None):
+        # no other process can take the ids given to the rows below before they are inserted
+        take_write_lock(db.session.connection())
+        first_cluster_id = (db.session.query(func.max(MessageCluster.id)).scalar() or 0) + 1
+        first_cluster_message_id = (db.session.query(func.max(ClusterMessage.id)).scalar() or 0) + 1
+
+        # add all clusters and their messages
+        cluster_messages = []
+        cluster_message_ids = []
+        for j, message_ids in enumerate(clusters):
+            cluster_message_ids.append(list(range(first_cluster_message_id + len(cluster_messages), first_cluster_message_id + len(cluster_messages) + len(message_ids))))
+            cluster_messages += [(cluster_message_ids[-1][k], message_id, first_cluster_id + j) for k, message_id in enumerate(message_ids)]
+
+        db.session.execute(MessageCluster.__table__.insert(), [{'id': first_cluster_id + j, 'channel_id': self.channel_id} for j in range(len(clusters))])
+        db.session.connection().exec_driver_sql("INSERT INTO cluster_message (id, message_id, message_cluster_id) VALUES (?, ?, ?)", cluster_messages)
+
+        if tracker is not None:
+            tracker.add(len(clusters))
+
+        return cluster_message_ids
+
+    # re-clusters the newest messages after new messages were stored
+    # clusters never span a gap longer than max_dist, so only the clusters after the last such gap before the new messages can change
+    def recluster_tail(self):
+        connection = db.session.connection()
+        max_dist, _ = self.cluster_distances()
+
+        # time of the oldest message that is not in a cluster yet
+        oldest_new = connection.exec_driver_sql(
+            f"SELECT min({MESSAGE_TIME}) FROM message LEFT JOIN cluster_message ON cluster_message.message_id = message.id WHERE message.channel_id = ? AND cluster_message.id IS NULL",
+            (self.channel_id,)
+        ).scalar()
+        if oldest_new is None:
+            return
 
-        # get all clusters for this channel
-        clusters = self.channel.clusters
-        for cluster in clusters:
-            # make sure analysis is running
-            if not self.channel.running:
+        # walk back from the oldest new message until a gap longer than max_dist (or the first message) is found
+        since = oldest_new
+        while True:
+            times = [row[0] for row in connection.exec_driver_sql(
+                f"SELECT {MESSAGE_TIME} AS time FROM message WHERE channel_id = ? AND time < ? ORDER BY time DESC LIMIT ?",
+                (self.channel_id, since, TAIL_CHUNK)
+            )]
+            if not times:
+                since = None  # every message is in the tail
                 break
 
-            # combine all messages in cluster to assist with coreference resolution
-            combined_message = u""
+            newer = np.array([since] + times[:-1])
+            gaps = np.flatnonzero(newer - np.array(times) > max_dist)
+            if len(gaps) > 0:
+                since = int(newer[gaps[0]])
+                break
 
-            for message in cluster.messages:
-                # prepare message by surrounding in quotes and prepending it with "(username) said"
-                combined_message += message.message.user.username  + ' said "' + message.message.content.replace('"', '\'') + '." '
+            since = times[-1]
+
+        # find the messages in the tail and the clusters they are in
+        message_ids = [row[0] for row in connection.exec_driver_sql(
+            f"SELECT id, {MESSAGE_TIME} AS time FROM message WHERE channel_id = ? AND time >= ?",
+            (self.channel_id, since if since is not None else float('-inf'))
+        )]
+        cluster_ids = set()
+        for i in range(0, len(message_ids), QUERY_CHUNK):
+            cluster_ids.update(row.message_cluster_id for row in ClusterMessage.query.filter(ClusterMessage.message_id.in_(message_ids[i:i + QUERY_CHUNK])).with_entities(ClusterMessage.message_cluster_id))
+        cluster_ids = list(cluster_ids)
+
+        # clear the results of the tail
+        summary.remove_messages(self.channel_id, message_ids)
+        for i in range(0, len(message_ids), QUERY_CHUNK):
+            MessageSentiment.query.filter(MessageSentiment.message_id.in_(message_ids[i:i + QUERY_CHUNK])).delete(synchronize_session=False)
+            UserSentiment.query.filter(UserSentiment.message_id.in_(message_ids[i:i + QUERY_CHUNK])).delete(synchronize_session=False)
+        for i in range(0, len(cluster_ids), QUERY_CHUNK):
+            cluster_message_ids = db.session.query(ClusterMessage.id).filter(ClusterMessage.message_cluster_id.in_(cluster_ids[i:i + QUERY_CHUNK]))
+            CorefMessage.query.filter(CorefMessage.cluster_message_id.in_(cluster_message_ids)).delete(synchronize_session=False)
+            ClusterMessage.query.filter(ClusterMessage.message_cluster_id.in_(cluster_ids[i:i + QUERY_CHUNK])).delete(synchronize_session=False)
+            MessageCluster.query.filter(MessageCluster.id.in_(cluster_ids[i:i + QUERY_CHUNK])).delete(synchronize_session=False)
+        db.session.commit()
 
-            # resolve coreferences
-            doc = nlp(combined_message)
+        print(f"re-clustering {len(message_ids)} messages ({len(cluster_ids)} old clusters)")
+        self.create_clusters(since)
 
-            # dissolve combined message
-            coref_contents = [i[:-1] for i in doc._.coref_resolved.split('"') if not user_pattern.match(i)]
-            del coref_contents[-1]
+    # resolves coreferences in message clusters
+    # only resolves clusters that have not been resolved yet if pending is True
+    # otherwise continues after the clusters resolved by a stopped run if resume (the checkpoint of stage 4) is given
+    # only resolves clusters with ids within bounds (see within) if given
+    def resolve_coreferences(self, pending=False, resume=None, bounds=None):
+        # get ids of all clusters for this channel
+        query = MessageCluster.query.filter(MessageCluster.channel_id == self.channel_id).with_entities(MessageCluster.id).order_by(MessageCluster.id)
+        query = within(query, MessageCluster.id, bounds)
+        if pending:
+            # looks up the cluster messages of each cluster of the channel, instead of every unresolved cluster message
+            unresolved = db.session.query(ClusterMessage.id).outerjoin(CorefMessage, CorefMessage.cluster_message_id == ClusterMessage.id)\
+                .filter(ClusterMessage.message_cluster_id == MessageCluster.id).filter(CorefMessage.id.is_(None))
+            query = query.filter(unresolved.exists())
+        cluster_ids = [cluster.id for cluster in query]
+        self.tracker.total = db.session.query(func.count(ClusterMessage.id)).filter(ClusterMessage.message_cluster_id.in_(query.order_by(None))).scalar()
+
+        checkpoint = None
+        if not pending and bounds is None:
+            # clusters are resolved in order, so the first ones were resolved by the stopped run
+            resolved = resume or {'clusters': 0, 'messages': 0}
+            cluster_ids = cluster_ids[resolved['clusters']:]
+            self.tracker.update(resolved['messages'])
+
+            def checkpoint(clusters, messages):
+                resolved['clusters'] += clusters
+                resolved['messages'] += messages
+                checkpoints.save(self.channel_id, 4, resolved)
+
+        # yields (cluster message ids, [(username, content)]) of each cluster, loading a chunk of clusters and their usernames per query
+        def load_clusters():
+            for i in range(0, len(cluster_ids), CHUNK_SIZE):
+                chunk_ids = cluster_ids[i:i + CHUNK_SIZE]
+                rows = db.session.query(ClusterMessage.message_cluster_id, ClusterMessage.id, User.username, Message.content)\
+                    .join(Message, ClusterMessage.message).join(User, Message.user)\
+                    .filter(Message.channel_id == self.channel_id)\
+                    .filter(ClusterMessage.message_cluster_id.in_(chunk_ids))\
+                    .order_by(ClusterMessage.message_cluster_id, ClusterMessage.id).all()
+
+                for _, cluster in groupby(rows, key=lambda row: row.message_cluster_id):
+                    cluster = list(cluster)
+                    yield [row.id for row in cluster], [(row.username, row.content) for row in cluster]
+
+        for _ in self.resolve_clusters(load_clusters(), self.tracker, checkpoint):
+            pass
 
-            # create coref messages
-            for (i, message) in enumerate(cluster.messages):
-                db.session.add(CorefMessage(cluster_message_id=message.id, content=coref_contents[i]))
-                self.channel.progress = Channel.progress + 1  # update progress
-        
-        db.session.commit()
+    # resolves and stores the coreferences of clusters given as (cluster message ids, [(username, content)])
+    # clusters is consumed lazily, and the coref messages stored for each chunk of clusters are yielded
+    # counts the resolved messages on tracker if given
+    # checkpoint is called with the number of clusters and messages of each chunk, in the transaction storing them
+    def resolve_clusters(self, clusters, tracker=None, checkpoint=None):
+        with CorefEngine() as engine:
+            for chunk in engine.resolve_clusters(clusters):
+                # make sure analysis is running
+                if self.stopped():
+                    break
+
+                # create coref messages
+                coref_messages = [{'cluster_message_id': cluster_message_id, 'content': content} for cluster_message_ids, coref_contents in chunk for cluster_message_id, content in zip(cluster_message_ids, coref_contents)]
+                db.session.bulk_insert_mappings(CorefMessage, coref_messages)
+                if checkpoint is not None:
+                    checkpoint(len(chunk), len(coref_messages))
+                db.session.commit()
+                if tracker is not None:
+                    tracker.add(len(coref_messages))
+
+                yield coref_messages
 
     # stores result of sentiment analysis
-    def analyze_sentiments(self):
-        # get all messages for this channel
-        messages = CorefMessage.query.join(Message, CorefMessage.message).filter(Message.channel_id == self.channel_id)
-
-        # finds the message in the database associated with the mention analyzed by the api
-        def find_message(mention):
-            offset = mention.text.begin_offset
-            dist = 2  # distance between two messages in the "content" string (each message is separated with 2 characters, ". ")
-
-            for message in messages:
-                # if the mention is contained within the current message, return its id
-                if len(message.content) > offset:
-                    return message.message.id
-
-                # move to next message
-                offset -= len(message.content) + dist
-        
-        # returns the user associated with the alternate name
-        def find_user_alternate(name):
-            user_alternate = self.channel.user_alternates.filter(UserAlternate.name.ilike(name)).first()
-            if user_alternate is None:
-                return None
-            else:
-                return user_alternate.user
-
-        # computes user and message sentiments for content
-        def compute_sentiments(content):
-            print("COMPUTING SENTIMNENTS")
-            # ensure that content is contained in a single unit (one API unit is < 1000 characters)
-            assert len(content) < 1000
-
-            # create document
-            document = {'content': content, 'type_': type_, 'language': language}
-
-            # calculate message sentiments
-            sentiment_response = client.analyze_sentiment(request={'document': document, 'encoding_type': encoding_type})
-            for sentence in sentiment_response.sentences:
-                # find message using span of sentence
-                message_id = find_message(sentence)
-
-                # add message sentiment to database
-                db.session.add(MessageSentiment(message_id=message_id, score=sentence.sentiment.score, magnitude=sentence.sentiment.magnitude))
-            
-            # calculate user sentiments
-            entity_response = client.analyze_entity_sentiment(request={'document': document, 'encoding_type': encoding_type})
-            for entity in entity_response.entities:
+    # only analyzes messages without a sentiment if pending is True
+    # otherwise continues after the messages analyzed by a stopped run if resume (the checkpoint of stage 5) is given
+    # only analyzes messages with coref message ids within bounds (see within) if given
+    def analyze_sentiments(self, pending=False, resume=None, bounds=None):
+        # get the id, author, time and resolved content of all messages for this channel
+        query = db.session.query(Message.id, Message.user_id, Message.timestamp, CorefMessage.content).join(Message, CorefMessage.message)\
+            .filter(Message.channel_id == self.channel_id).order_by(CorefMessage.id)
+        query = within(query, CorefMessage.id, bounds)
+
+        checkpoint = None
+        analyzed = 0  # number of messages analyzed by a stopped run
+        if pending:
+            query = query.filter(Message.id.notin_(db.session.query(MessageSentiment.message_id)))
+        elif bounds is None:
+            # messages are analyzed in order, so the first ones were analyzed by the stopped run
+            analyzed = resume['messages'] if resume else 0
+            query = query.offset(analyzed)
+
+            def checkpoint(count):
+                nonlocal analyzed
+                analyzed += count
+                checkpoints.save(self.channel_id, 5, {'messages': analyzed})
+
+        messages = query.all()
+        self.tracker.total = analyzed + len(messages)
+        self.tracker.update(analyzed)
+        self.analyze_messages(messages, EntityResolver(self.channel_id), self.tracker, checkpoint)
+
+    # analyzes and stores the sentiments of messages given as (id, user id, timestamp, resolved content), consuming them lazily
+    # resolver maps entity names to users without querying the database
+    # counts the analyzed messages on tracker if given
+    # checkpoint is called with the number of messages of each document, in the transaction storing their sentiments
+    def analyze_messages(self, messages, resolver, tracker=None, checkpoint=None):
+        client = resources.get('language_client')
+        authors = {}  # message id -> (id of the user who sent it, timestamp) of the messages being analyzed
+
+        # stores the user and message sentiments computed for document
+        def store_sentiments(document, sentiment_response, entity_response):
+            # add message sentiments (finding each message using the span of the sentence)
+            message_sentiments = []
+            for sentence in sentiment_response['sentences']:
+                message_id = document.find_message(sentence['begin_offset'])
+                message_sentiments.append({'message_id': message_id, 'channel_id': self.channel_id, 'user_id': authors[message_id][0], 'score': sentence['score'], 'magnitude': sentence['magnitude']})
+
+            # add user sentiments
+            user_sentiments = []
+            for entity in entity_response['entities']:
                 # skip if user with name or alternate name does not exist
-                subject_user = self.channel.users.filter(User.username.ilike(entity.name)).first() or find_user_alternate(entity.name)
-                if subject_user is not None:
-                    for mention in entity.mentions:
+                subject_user_id = resolver.resolve(entity['name'])
+                if subject_user_id is not None:
+                    for mention in entity['mentions']:
                         # find message using span of entity
-                        message_id = find_message(mention)
-                        object_user = Message.query.get(message_id).user
+                        message_id = document.find_message(mention['begin_offset'])
+                        user_sentiments.append({'message_id': message_id, 'object_user_id': authors[message_id][0], 'subject_user_id': subject_user_id, 'score': mention['score'], 'magnitude': mention['magnitude']})
+
+            db.session.bulk_insert_mappings(MessageSentiment, message_sentiments)
+            db.session.bulk_insert_mappings(UserSentiment, user_sentiments)
 
-                        # add user sentiment to database
-                        db.session.add(UserSentiment(message_id=message_id, object_user_id=object_user.id, subject_user_id=subject_user.id, score=mention.sentiment.score, magnitude=mention.sentiment.magnitude))
-            
-            self.channel.progress = Channel.progress + 1  # update progress
+            # keep the totals of each pair of users up to date in the same transaction
+            summary.add_sentiments(self.channel_id, [(sentiment['object_user_id'], sentiment['subject_user_id'], authors[sentiment['message_id']][1], sentiment['score'], sentiment['magnitude']) for sentiment in user_sentiments])
+            if checkpoint is not None:
+                checkpoint(len(document.message_ids))
             db.session.commit()
-        
-        # stores content of document
-        content = ""
-        
-        for message in messages:
+            if tracker is not None:
+                tracker.add(len(document.message_ids))
+
+            for message_id in document.message_ids:
+                del authors[message_id]
+
+        documents = deque()  # documents being analyzed, in order
+
+        # yields (id, content) of each message, remembering its author
+        def contents():
+            for message_id, user_id, timestamp, content in messages:
+                authors[message_id] = (user_id, timestamp)
+                yield message_id, content
+
+        # packs messages into documents, remembering each document so its spans can be mapped back to messages
+        def pack():
+            for document in pack_documents(contents()):
+                documents.append(document)
+                yield document.content
+
+        # documents are analyzed concurrently, but their sentiments are stored here in order
+        results = client.analyze_stream(pack())
+        for _, (sentiment_response, entity_response) in results:
             # make sure analysis is running
-            if not self.channel.running:
+            if self.stopped():
                 break
 
-            if len(message.content) + len(content) < 1000:
-                # add message to current group if character limit not reached
-                content += message.content + ". "
-            else:
-                compute_sentiments(content)
-                content = ""
+            store_sentiments(documents.popleft(), sentiment_response, entity_response)
 
-        # compute last unit of messages
-        if len(content) > 0 and self.channel.running:
-            compute_sentiments(content)
+        results.close()
@@ -0,0 +1,106 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# results are cached in their own sqlite file so they survive stage resets and re-runs
+CACHE_PATH = os.getenv("CACHE_PATH", 'cache.db')  # relative to the working directory (like celery-results.db), as the package may be read-only
+QUERY_CHUNK = 500  # max number of keys per IN query (sqlite limits the number of variables)
+
+
+# returns the content address of parts (a sha256 of all parts)
+def content_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part.encode('utf-8'))
+        digest.update(b'\0')
+
+    return digest.hexdigest()
+
+
+# a persistent json cache with least recently used eviction and optional expiry
+# each namespace is bounded and evicted separately, so several caches can share one file
+class ResultCache:
+    def __init__(self, namespace, max_entries, ttl=None, path=CACHE_PATH):
+        self.namespace = namespace
+        self.max_entries = max_entries
+        self.ttl = ttl  # seconds an entry stays valid (None keeps entries until they are evicted)
+
+        self.hits = 0
+        self.misses = 0
+
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('CREATE TABLE IF NOT EXISTS result (namespace TEXT, key TEXT, value TEXT NOT NULL, created REAL NOT NULL, used REAL NOT NULL, PRIMARY KEY (namespace, key))')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS ix_result_used ON result (namespace, used)')
+
+        # approximate number of entries, used to only evict once the cache is over its bound
+        self.size = self.connection.execute('SELECT count(*) FROM result WHERE namespace = ?', (namespace,)).fetchone()[0]
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    # returns {key: value} of all keys that are cached
+    def get_many(self, keys):
+        keys = list(set(keys))
+        found = {}
+        now = time.time()
+
+        with self.lock, self.connection:
+            for i in range(0, len(keys), QUERY_CHUNK):
+                chunk = keys[i:i + QUERY_CHUNK]
+                rows = self.connection.execute(f"SELECT key, value, created FROM result WHERE namespace = ? AND key IN ({','.join('?' * len(chunk))})", [self.namespace] + chunk)
+
+                for key, value, created in rows:
+                    if self.ttl is None or now - created < self.ttl:
+                        found[key] = json.loads(value)
+
+            # mark entries as recently used
+            self.connection.executemany('UPDATE result SET used = ? WHERE namespace = ? AND key = ?', [(now, self.namespace, key) for key in found])
+
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+
+        return found
+
+    # returns the cached value of key or None
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    # caches every {key: value} in items, evicting the least recently used entries if the cache is full
+    def set_many(self, items):
+        if not items:
+            return
+
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany('INSERT OR REPLACE INTO result (namespace, key, value, created, used) VALUES (?, ?, ?, ?, ?)', [(self.namespace, key, json.dumps(value), now, now) for key, value in items.items()])
+            self.size += len(items)
+
+            # evict in bulk once the cache grows a tenth past its bound
+            if self.size > self.max_entries * 1.1:
+                self.evict()
+
+    # caches value under key
+    def set(self, key, value):
+        self.set_many({key: value})
+
+    # removes expired entries and every entry past the max_entries most recently used
+    def evict(self):
+        if self.ttl is not None:
+            self.connection.execute('DELETE FROM result WHERE namespace = ? AND created < ?', (self.namespace, time.time() - self.ttl))
+
+        self.connection.execute('DELETE FROM result WHERE namespace = ? AND key IN (SELECT key FROM result WHERE namespace = ? ORDER BY used DESC LIMIT -1 OFFSET ?)', (self.namespace, self.namespace, self.max_entries))
+        self.size = self.connection.execute('SELECT count(*) FROM result WHERE namespace = ?', (self.namespace,)).fetchone()[0]
+
+    # removes every entry in this namespace
+    def clear(self):
+        with self.lock, self.connection:
+            self.connection.execute('DELETE FROM result WHERE namespace = ?', (self.namespace,))
+            self.size = 0
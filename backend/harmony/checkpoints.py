@@ -0,0 +1,32 @@
+import json
+from sqlalchemy import text
+from harmony import db
+from harmony.models import StageCheckpoint
+
+
+# replaces the checkpoint of a stage
+upsert = text('''
+    INSERT INTO stage_checkpoint (channel_id, stage, value) VALUES (:channel_id, :stage, :value)
+    ON CONFLICT (channel_id, stage) DO UPDATE SET value = excluded.value
+''')
+
+
+# returns the checkpoint of a stage of the channel or None if the stage has no output to continue from
+def load(channel_id, stage):
+    checkpoint = StageCheckpoint.query.filter(StageCheckpoint.channel_id == channel_id).filter(StageCheckpoint.stage == stage).first()
+    return json.loads(checkpoint.value) if checkpoint is not None else None
+
+
+# stores the checkpoint (anything json can encode) of a stage of the channel
+# is part of the caller's transaction, so it is stored with the output it describes
+def save(channel_id, stage, value):
+    db.session.execute(upsert, {'channel_id': channel_id, 'stage': stage, 'value': json.dumps(value)})
+
+
+# removes the checkpoints of the channel (of stages at or after first_stage if given), so those stages start over
+def clear(channel_id, first_stage=None):
+    query = StageCheckpoint.query.filter(StageCheckpoint.channel_id == channel_id)
+    if first_stage is not None:
+        query = query.filter(StageCheckpoint.stage >= first_stage)
+
+    query.delete(synchronize_session=False)
@@ -0,0 +1,81 @@
+import numpy as np
+from datetime import datetime, timezone
+
+
+MESSAGE_TIME = "round((julianday(timestamp) - 2440587.5) * 86400000)"  # sql computing the time of a message in milliseconds since 1970 (indexed)
+
+
+# returns the time of an iso timestamp in milliseconds since 1970 (the same time sqlite computes with julianday)
+def message_time(timestamp):
+    time = datetime.fromisoformat(timestamp)
+    if time.tzinfo is None:
+        time = time.replace(tzinfo=timezone.utc)
+
+    return round(time.timestamp() * 1000)
+
+
+# returns the index of the first message of each cluster
+# times are the timestamps of the messages (in milliseconds) from newest to oldest
+# a message starts a new cluster if it was sent more than max_dist before the previous message
+# or more than max_cum_dist before the first message of the cluster
+def cluster_starts(times, max_dist, max_cum_dist):
+    times = np.asarray(times, dtype=np.int64)
+    if len(times) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    elapsed = times[0] - times  # time between the newest message and each message (increasing)
+
+    # gaps longer than max_dist always end a cluster, splitting the messages into independent segments
+    gaps = np.flatnonzero(np.diff(elapsed) > max_dist) + 1
+    segment_starts = np.concatenate(([0], gaps))
+    segment_ends = np.concatenate((gaps, [len(times)]))
+
+    # most segments span less than max_cum_dist, making them a single cluster
+    long = np.flatnonzero(elapsed[segment_ends - 1] - elapsed[segment_starts] > max_cum_dist)
+    starts = [segment_starts]
+
+    for start, end in zip(segment_starts[long].tolist(), segment_ends[long].tolist()):
+        # within a long segment, a cluster ends before the first message more than max_cum_dist after its first message
+        start = int(np.searchsorted(elapsed, elapsed[start] + max_cum_dist, side='right'))
+        while start < end:
+            starts.append([start])
+            start = int(np.searchsorted(elapsed, elapsed[start] + max_cum_dist, side='right'))
+
+    return np.sort(np.concatenate(starts)).astype(np.int64)
+
+
+# returns the index of the first and end of each cluster (see cluster_starts)
+def cluster_bounds(times, max_dist, max_cum_dist):
+    starts = cluster_starts(times, max_dist, max_cum_dist)
+    return starts, np.append(starts[1:], len(times)).astype(np.int64)
+
+
+# groups messages arriving from newest to oldest into the same clusters as cluster_starts
+# a cluster is returned as soon as a message that cannot join it arrives, as older messages can no longer change it
+class OnlineClusterer:
+    def __init__(self, max_dist, max_cum_dist):
+        self.max_dist = max_dist
+        self.max_cum_dist = max_cum_dist
+
+        self.cluster = []  # items of the open cluster
+        self.first_time = None  # time of the first (newest) message of the open cluster
+        self.last_time = None  # time of the last (oldest) message of the open cluster
+
+    # adds the item of a message sent at time (milliseconds), returning the items of the cluster it closed or None
+    def add(self, item, time):
+        closed = None
+        if self.cluster and (self.first_time - time > self.max_cum_dist or self.last_time - time > self.max_dist):
+            closed = self.close()
+
+        if not self.cluster:
+            self.first_time = time
+
+        self.cluster.append(item)
+        self.last_time = time
+        return closed
+
+    # returns the items of the open cluster (the last cluster once every message was added) and starts a new one
+    def close(self):
+        cluster = self.cluster
+        self.cluster = []
+        return cluster
@@ -0,0 +1,149 @@
+import os
+import re
+from collections import deque
+from billiard import Pool  # celery's multiprocessing, whose processes may start their own (the prefork workers of the coref queue are daemonic)
+from harmony import resources
+from harmony.cache import ResultCache, content_key
+
+
+COREF_BATCH_SIZE = int(os.getenv("COREF_BATCH_SIZE", 32))  # number of texts spacy processes together
+COREF_PROCESSES = int(os.getenv("COREF_PROCESSES", 1))  # number of processes resolving coreferences for each task (1 resolves in the task's process)
+# each loads its own nlp pipeline, so a coref worker runs COREF_CONCURRENCY * COREF_PROCESSES pipelines (see worker.py)
+CHUNK_SIZE = COREF_BATCH_SIZE * 4  # number of clusters sent to a process at once
+COREF_CACHE_SIZE = int(os.getenv("COREF_CACHE_SIZE", 200000))  # max number of clusters kept in the cache (0 disables the cache)
+
+user_pattern = re.compile(r"^.+ said $")  # pattern matches "username said "
+
+
+# combines all messages of a cluster ([(username, content)]) to assist with coreference resolution
+def combine(messages):
+    combined_message = u""
+
+    for username, content in messages:
+        # prepare message by surrounding in quotes and prepending it with "(username) said"
+        combined_message += username + ' said "' + content.replace('"', '\'') + '." '
+
+    return combined_message
+
+
+# dissolves a resolved combined message into the resolved content of each message
+def dissolve(resolved):
+    coref_contents = [i[:-1] for i in resolved.split('"') if not user_pattern.match(i)]
+    del coref_contents[-1]
+    return coref_contents
+
+
+# resolves coreferences in each combined message, returning the resolved contents of each
+def resolve(texts, batch_size=COREF_BATCH_SIZE):
+    nlp = resources.get('nlp')
+    return [dissolve(doc._.coref_resolved) for doc in nlp.pipe(texts, batch_size=batch_size)]
+
+
+# returns a string identifying the coreference model, so cached results are not reused after the model changes
+def model_version():
+    import pkg_resources
+
+    versions = []
+    for package in ['spacy', 'neuralcoref', resources.NLP_MODEL]:
+        try:
+            versions.append(f"{package}=={pkg_resources.get_distribution(package).version}")
+        except pkg_resources.DistributionNotFound:
+            versions.append(package)
+
+    return ' '.join(versions)
+
+
+# loads the nlp pipeline once in each pool process
+def init_process():
+    resources.warm(['nlp'])
+
+
+# a chunk resolved in this process (same interface as the AsyncResult of a chunk resolved in the pool)
+class Resolved:
+    def __init__(self, value):
+        self.value = value
+
+    def ready(self):
+        return True
+
+    def get(self):
+        return self.value
+
+
+# resolves coreferences of clusters in batches, spread over a pool of processes when processes > 1
+class CorefEngine:
+    def __init__(self, processes=COREF_PROCESSES, batch_size=COREF_BATCH_SIZE, chunk_size=CHUNK_SIZE, cache_size=COREF_CACHE_SIZE):
+        self.processes = processes
+        self.batch_size = batch_size
+        self.chunk_size = chunk_size
+        self.pool = None
+
+        # resolved contents of previously seen clusters, keyed by their combined text and the model version
+        self.cache = ResultCache('coref', cache_size) if cache_size > 0 else None
+        self.version = model_version()
+
+    def __enter__(self):
+        if self.processes > 1:
+            self.pool = Pool(self.processes, initializer=init_process)
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+        if self.cache is not None:
+            print(f"coref cache: {self.cache.hits} hits, {self.cache.misses} misses ({self.cache.hit_rate:.0%} hit rate)")
+
+    # splits clusters into lists of at most chunk_size clusters
+    def chunks(self, clusters):
+        chunk = []
+        for cluster in clusters:
+            chunk.append(cluster)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+
+        if chunk:
+            yield chunk
+
+    # returns the resolved contents of texts, computing only the ones missing from the cache
+    # returns (texts still to resolve, function merging their resolved contents with the cached ones)
+    def lookup(self, texts):
+        if self.cache is None:
+            return texts, lambda resolved: resolved
+
+        keys = [content_key(self.version, text) for text in texts]
+        cached = self.cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+
+        def merge(resolved):
+            self.cache.set_many({keys[i]: contents for i, contents in zip(missing, resolved)})
+            cached.update({keys[i]: contents for i, contents in zip(missing, resolved)})
+            return [cached[key] for key in keys]
+
+        return [texts[i] for i in missing], merge
+
+    # takes clusters as (key, [(username, content)]) and yields lists of (key, [resolved content]), one list per chunk, in order
+    # clusters is consumed lazily, keeping at most two chunks per process in flight
+    def resolve_clusters(self, clusters):
+        pending = deque()  # (keys, merge, result) of chunks being resolved
+
+        for chunk in self.chunks(clusters):
+            keys = [key for key, _ in chunk]
+            texts, merge = self.lookup([combine(messages) for _, messages in chunk])
+
+            if self.pool is None or not texts:
+                result = Resolved(resolve(texts, self.batch_size) if texts else [])
+            else:
+                result = self.pool.apply_async(resolve, (texts, self.batch_size))
+            pending.append((keys, merge, result))
+
+            # yield finished chunks in order, only waiting on a process once too many chunks are in flight
+            while pending and (pending[0][2].ready() or len(pending) >= self.processes * 2):
+                keys, merge, result = pending.popleft()
+                yield list(zip(keys, merge(result.get())))
+
+        while pending:
+            keys, merge, result = pending.popleft()
+            yield list(zip(keys, merge(result.get())))
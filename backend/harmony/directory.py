@@ -0,0 +1,93 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from harmony import db
+from harmony.models import User, user_bridge_association
+
+
+DIRECTORY_SIZE = int(os.getenv("USER_DIRECTORY_SIZE", 50000))  # max number of usernames kept in memory
+LOOKUP_WORKERS = 8  # number of users looked up on discord at once
+QUERY_CHUNK = 500  # max number of ids per IN query (sqlite limits the number of variables)
+
+
+# keeps the users of a channel in memory for the length of a run so ingestion does not need the database or discord for every message
+# users are written through writer, so users that are still buffered are treated as stored
+class UserDirectory:
+    def __init__(self, channel_id, writer, fetch_username, max_size=DIRECTORY_SIZE):
+        self.channel_id = channel_id
+        self.writer = writer
+        self.fetch_username = fetch_username  # looks up the username of a user id on discord
+        self.max_size = max_size
+
+        self.users = OrderedDict()  # least recently used id -> (username, whether the user is stored)
+        self.members = None  # ids of users that are members of the channel (only ids, so this stays small even for large guilds)
+
+    # caches the user, evicting the least recently used user if the directory is full
+    def remember(self, user_id, username, stored):
+        self.users[user_id] = (username, stored)
+        self.users.move_to_end(user_id)
+
+        if len(self.users) > self.max_size:
+            self.users.popitem(last=False)
+
+    # returns (username, stored) of a cached user or None
+    def recall(self, user_id):
+        user = self.users.get(user_id)
+        if user is not None:
+            self.users.move_to_end(user_id)
+        elif user_id in self.writer.users:
+            # evicted but still waiting to be written
+            user = (self.writer.users[user_id]['username'], True)
+            self.remember(user_id, *user)
+
+        return user
+
+    # resolves the usernames of all user_ids at once
+    # known maps ids to usernames already present in the messages, so discord is only asked about the rest
+    def prefetch(self, user_ids, known=None):
+        known = known or {}
+        missing = [user_id for user_id in set(user_ids) if self.recall(user_id) is None]
+
+        # look up stored users in as few queries as possible
+        for i in range(0, len(missing), QUERY_CHUNK):
+            for user in User.query.filter(User.id.in_(missing[i:i + QUERY_CHUNK])).with_entities(User.id, User.username):
+                self.remember(user.id, user.username, True)
+
+        missing = [user_id for user_id in missing if user_id not in self.users]
+
+        # use usernames sent along with the messages
+        for user_id in missing:
+            if user_id in known:
+                self.remember(user_id, known[user_id], False)
+
+        # look up the remaining users on discord concurrently
+        missing = [user_id for user_id in missing if user_id not in self.users]
+        if missing:
+            with ThreadPoolExecutor(max_workers=LOOKUP_WORKERS) as executor:
+                for user_id, username in zip(missing, executor.map(self.fetch_username, missing)):
+                    self.remember(user_id, username, False)
+
+    # adds user to the channel (storing the user if needed) and returns their username
+    def add_user(self, user_id):
+        user = self.recall(user_id)
+        if user is None:
+            self.prefetch([user_id])
+            user = self.users[user_id]
+
+        username, stored = user
+
+        if not stored:
+            # add user to database if it doesnt exist
+            self.writer.add_user(user_id, username)
+            self.remember(user_id, username, True)
+
+        # load the members of the channel the first time they are needed
+        if self.members is None:
+            self.members = {row.user_id for row in db.session.query(user_bridge_association.c.user_id).filter(user_bridge_association.c.channel_id == self.channel_id)}
+
+        if user_id not in self.members:
+            # create relationship between channel and user
+            self.writer.add_member(user_id)
+            self.members.add(user_id)
+
+        return username
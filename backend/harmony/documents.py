@@ -0,0 +1,72 @@
+from bisect import bisect_right
+
+
+MAX_DOCUMENT_SIZE = 1000  # max number of characters in a document (one billing unit of the natural language api)
+SEPARATOR = ". "  # separates messages in a document
+
+
+# a group of messages sent to the natural language api as one document
+# keeps the offset of every message so spans returned by the api can be mapped back to their message
+class Document:
+    def __init__(self):
+        self.parts = []
+        self.length = 0  # length of the content in characters
+        self.size = 0  # length of the content in utf-8 bytes (the unit of the offsets returned by the api)
+
+        self.message_ids = []  # ids of the messages in the document, in order
+        self.offsets = []  # utf-8 byte offset at which each message starts (prefix sums of the message sizes)
+
+    @property
+    def content(self):
+        return ''.join(self.parts)
+
+    # returns whether content can be added without going over the size of a document
+    def fits(self, content):
+        return self.length + len(content) + len(SEPARATOR) <= MAX_DOCUMENT_SIZE
+
+    # appends a message to the document
+    def add(self, message_id, content):
+        self.message_ids.append(message_id)
+        self.offsets.append(self.size)
+
+        self.parts.append(content + SEPARATOR)
+        self.length += len(content) + len(SEPARATOR)
+        self.size += len(content.encode('utf-8')) + len(SEPARATOR)
+
+    # returns the id of the message containing the byte offset
+    def find_message(self, offset):
+        return self.message_ids[max(bisect_right(self.offsets, offset) - 1, 0)]
+
+
+# packs messages ((id, content) in order) into as few documents as possible
+def pack_documents(messages):
+    document = Document()
+
+    for message_id, content in messages:
+        if not document.fits(content) and document.message_ids:
+            yield document
+            document = Document()
+
+        document.add(message_id, content)
+
+    # last unit of messages
+    if document.message_ids:
+        yield document
+
+
+# returns the index of the first message of each document pack_documents makes of messages with these lengths (in characters)
+# lets documents be planned from the lengths of the messages alone
+def document_starts(lengths):
+    starts = []
+    length = 0  # length of the current document
+
+    for i, content_length in enumerate(lengths):
+        if starts and length + content_length + len(SEPARATOR) > MAX_DOCUMENT_SIZE:
+            starts.append(i)
+            length = 0
+        elif not starts:
+            starts.append(i)
+
+        length += content_length + len(SEPARATOR)
+
+    return starts
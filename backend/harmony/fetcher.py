@@ -0,0 +1,350 @@
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.adapters import HTTPAdapter
+
+
+# base url of the discord api (point this at a local stub server for testing)
+API_URL = os.getenv("DISCORD_API_URL", "https://discord.com/api")
+
+FETCH_WORKERS = int(os.getenv("FETCH_WORKERS", 4))  # number of threads fetching pages concurrently
+FETCH_TASKS = int(os.getenv("FETCH_TASKS", 1))  # number of tasks of a process fetching at once, each with its own FETCH_WORKERS threads (worker.py sets it for thread pools)
+PREFETCH_PAGES = int(os.getenv("PREFETCH_PAGES", 32))  # max number of pages buffered ahead of the consumer for each segment
+PAGE_SIZE = 100  # max number of messages discord returns per page
+REQUEST_TIMEOUT = 30  # seconds to wait for a response before giving up
+
+DISCORD_EPOCH = 1420070400000  # first millisecond of 2015, the epoch used by snowflakes
+
+# ids in these positions are major parameters and get their own rate limit bucket
+major_pattern = re.compile(r"/(?:channels|guilds|webhooks)/(\d+)")
+id_pattern = re.compile(r"\d{15,}")
+
+
+# returns the snowflake of the first possible id created at time (seconds since unix epoch)
+def snowflake(time_):
+    return (int(time_ * 1000) - DISCORD_EPOCH) << 22
+
+
+# returns the rate limit route of the request (path with minor ids removed and major ids kept)
+def route_key(method, url):
+    path = url.split('?', 1)[0]
+    majors = major_pattern.findall(path)
+    return method + ' ' + id_pattern.sub('{id}', path) + ' ' + ' '.join(majors)
+
+
+# tracks discord's per-route rate limit buckets so requests wait before being limited instead of after
+class RateLimiter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}  # route -> bucket hash returned by discord
+        self.buckets = {}  # bucket hash (or route if hash unknown) -> [remaining, time at which the bucket resets]
+        self.global_reset = 0  # time at which the global rate limit resets
+
+    # blocks until a request can be made on route without hitting a rate limit
+    def acquire(self, route):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                delay = self.global_reset - now
+                bucket = self.buckets.get(self.routes.get(route, route))
+
+                if bucket is not None:
+                    if bucket[1] <= now:
+                        # bucket has reset, let discord tell us the new remaining count
+                        del self.buckets[self.routes.get(route, route)]
+                    elif bucket[0] > 0:
+                        # reserve a request in the bucket
+                        bucket[0] -= 1
+                    else:
+                        delay = max(delay, bucket[1] - now)
+
+                if delay <= 0:
+                    return
+
+            time.sleep(delay)
+
+    # updates the bucket of route using the rate limit headers of response
+    def update(self, route, response):
+        headers = response.headers
+        now = time.monotonic()
+
+        with self.lock:
+            bucket_hash = headers.get('x-ratelimit-bucket')
+            if bucket_hash is not None:
+                self.routes[route] = bucket_hash
+            key = self.routes.get(route, route)
+
+            if 'x-ratelimit-remaining' in headers and 'x-ratelimit-reset-after' in headers:
+                self.buckets[key] = [int(headers['x-ratelimit-remaining']), now + float(headers['x-ratelimit-reset-after'])]
+
+            if response.status_code == 429:
+                # prefer retry_after in the body (seconds), fall back to the header
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = {}
+                retry_after = float(body.get('retry_after', headers.get('retry-after', 1)))
+
+                if body.get('global') or headers.get('x-ratelimit-global'):
+                    self.global_reset = now + retry_after
+                else:
+                    self.buckets[key] = [0, now + retry_after]
+
+
+# a pooled http session to the discord api that respects rate limit buckets and can be shared between threads
+class DiscordSession:
+    def __init__(self, token, api_url=API_URL, pool_size=FETCH_WORKERS * FETCH_TASKS):
+        self.api_url = api_url
+        self.limiter = RateLimiter()
+
+        # reuse connections across requests and threads
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers['Authorization'] = f'Bot {token}'
+
+    # returns json associated with get request to url
+    def get(self, url):
+        route = route_key('GET', url)
+
+        while True:
+            self.limiter.acquire(route)
+            response = self.session.get(f"{self.api_url}{url}", timeout=REQUEST_TIMEOUT)
+            self.limiter.update(route, response)
+
+            if response.status_code != 429:
+                return response.json()
+
+            print("Sleeping because of rate limit.")
+
+
+# state shared by the segments of a call to MessageFetcher.pages
+# counts the messages fetched ahead of the consumer, so that with a limit a segment only fetches while the segments newer than it
+# (and its own unread pages) do not hold every message the consumer still needs,
+# and keeps the ranges of the history that pages showed to be empty, so segments skip them instead of requesting them
+# (older segments wait for the first page of the newest one, which shows where the channel's newest message is)
+class FetchState:
+    def __init__(self, segments, limit):
+        self.limit = limit  # number of messages the consumer expects to read (None for the whole history)
+        self.fetched = [0] * segments  # messages fetched by each segment that were not read yet
+        self.current = 0  # segment being read
+        self.read = 0  # messages read
+        self.empty = []  # (low, high) ranges without messages between low and high (exclusive)
+        self.probed = False  # whether the newest segment got its first page (or gave up)
+        self.condition = threading.Condition()
+
+    # returns whether segment should fetch its next page
+    def needed(self, segment):
+        if segment > 0 and not self.probed:
+            return False
+        if self.limit is None:
+            return True
+
+        ahead = sum(self.fetched[self.current:segment + 1])
+        if segment == self.current and ahead == 0:
+            return True  # the consumer waits for this page (it may need more messages than expected, as some are not prepared)
+
+        return ahead < self.limit - self.read
+
+    # waits until segment should fetch its next page and returns True, or returns False once stop is set
+    def wait(self, segment, stop):
+        with self.condition:
+            while not stop.is_set() and not self.needed(segment):
+                self.condition.wait(0.1)
+
+        return not stop.is_set()
+
+    # counts count messages fetched by segment
+    def add(self, segment, count):
+        with self.condition:
+            self.fetched[segment] += count
+
+    # counts count messages of segment read by the consumer
+    def take(self, segment, count):
+        with self.condition:
+            self.current = segment
+            self.fetched[segment] -= count
+            self.read += count
+            self.condition.notify_all()
+
+    # moves the consumer on to segment
+    def reach(self, segment):
+        with self.condition:
+            self.current = segment
+            self.condition.notify_all()
+
+    # remembers that there are no messages between the newest message of a page fetched before before (0 if there was none) and before
+    def add_empty(self, data, before):
+        with self.condition:
+            self.empty.append((int(data[0]['id']) if data else 0, before))
+
+    # lets the older segments start once the newest one got its first page (or gave up)
+    def probe(self):
+        with self.condition:
+            self.probed = True
+            self.condition.notify_all()
+
+    # returns the before cursor that returns the same page as before, skipping the empty ranges below it
+    def skip_empty(self, before):
+        with self.condition:
+            skipped = True
+            while skipped:
+                skipped = False
+                for low, high in self.empty:
+                    if low + 1 < before <= high:
+                        before = low + 1
+                        skipped = True
+
+        return before
+
+
+# fetches the message history of a channel, newest first, with several pages in flight at once
+# the history is split into snowflake ranges which are fetched concurrently and yielded in order
+class MessageFetcher:
+    def __init__(self, session, channel_id, before=None, workers=FETCH_WORKERS, segments=None, prefetch=PREFETCH_PAGES, limit=None):
+        self.session = session
+        self.channel_id = channel_id
+        self.before = before  # only fetch messages older than this id
+        self.workers = workers
+        self.segments = segments or workers * 4
+        self.prefetch = prefetch
+        self.limit = limit  # number of messages the consumer expects to read (None for the whole history), which caps the pages fetched ahead of it
+
+        # statistics of the last call to pages
+        self.pages_fetched = 0
+        self.elapsed = 0
+
+    @property
+    def pages_per_second(self):
+        return self.pages_fetched / self.elapsed if self.elapsed else 0
+
+    # returns list of (before, after) snowflake ranges covering the history, newest first
+    def split_history(self):
+        upper = int(self.before) if self.before else snowflake(time.time())
+
+        try:
+            lower = int(self.channel_id)  # messages are always newer than their channel
+        except ValueError:
+            lower = 0
+
+        # split evenly by time (snowflakes grow linearly with time)
+        if self.segments <= 1 or lower <= 0 or upper <= lower:
+            return [(upper, 0)]
+
+        step = (upper - lower) // self.segments + 1
+        bounds = [max(upper - i * step, lower) for i in range(self.segments + 1)]
+        bounds[-1] = 0  # last segment takes everything that is left
+        return list(zip(bounds, bounds[1:]))
+
+    # fetches the pages in the (before, after) range of segment into buffer, as long as the consumer needs them (see FetchState)
+    def fetch_segment(self, segment, before, after, buffer, stop, state):
+        try:
+            while state.wait(segment, stop):
+                # stop without a request once the rest of the segment is known to be empty
+                before = state.skip_empty(int(before))
+                if before <= after + 1:
+                    break
+
+                data = self.session.get(f"/channels/{self.channel_id}/messages?limit={PAGE_SIZE}&before={before}")
+                if not isinstance(data, list):
+                    raise RuntimeError(f"Discord returned an error: {data}")
+                if not data or int(data[0]['id']) <= after:
+                    state.add_empty(data, before)  # only ranges reaching past the segment are of use to the others (at most one per segment)
+                if segment == 0:
+                    state.probe()
+
+                # keep only the messages inside this segment
+                page = [message for message in data if int(message['id']) > after]
+                if page:
+                    state.add(segment, len(page))
+                    self.put(buffer, page, stop)
+
+                # stop once the segment (or history) has been exhausted
+                if len(page) < len(data) or len(data) < PAGE_SIZE:
+                    break
+
+                before = data[-1]['id']
+        except Exception as e:
+            self.put(buffer, e, stop)
+        finally:
+            if segment == 0:
+                state.probe()
+            self.put(buffer, None, stop)
+
+    # puts item into buffer, giving up if the consumer has stopped
+    def put(self, buffer, item, stop):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    # yields pages of messages newer than the message after (oldest first) by following discord's after cursor
+    # pages are fetched one at a time, as only the messages sent since the last analysis are expected
+    def pages_after(self, after):
+        self.pages_fetched = 0
+        start = time.monotonic()
+
+        try:
+            while True:
+                data = self.session.get(f"/channels/{self.channel_id}/messages?limit={PAGE_SIZE}&after={after}")
+                if not isinstance(data, list):
+                    raise RuntimeError(f"Discord returned an error: {data}")
+                if not data:
+                    break
+
+                page = sorted(data, key=lambda message: int(message['id']))
+                self.pages_fetched += 1
+                self.elapsed = time.monotonic() - start
+                yield page
+
+                if len(data) < PAGE_SIZE:
+                    break
+
+                after = page[-1]['id']
+        finally:
+            self.elapsed = time.monotonic() - start
+            print(f"fetched {self.pages_fetched} new pages in {self.elapsed:.1f}s")
+
+    # yields pages of messages (newest first) while the next pages are fetched in the background
+    def pages(self):
+        segments = self.split_history()
+        buffers = [queue.Queue(maxsize=self.prefetch) for _ in segments]
+        stop = threading.Event()
+        state = FetchState(len(segments), self.limit)
+
+        self.pages_fetched = 0
+        start = time.monotonic()
+
+        # segments are started in order, so the newest ones are always fetched first
+        executor = ThreadPoolExecutor(max_workers=self.workers)
+        for segment, ((before, after), buffer) in enumerate(zip(segments, buffers)):
+            executor.submit(self.fetch_segment, segment, before, after, buffer, stop, state)
+
+        try:
+            for segment, buffer in enumerate(buffers):
+                state.reach(segment)
+                while True:
+                    page = buffer.get()
+                    if page is None:
+                        break
+                    if isinstance(page, Exception):
+                        raise page
+
+                    state.take(segment, len(page))
+                    self.pages_fetched += 1
+                    self.elapsed = time.monotonic() - start
+                    yield page
+        finally:
+            # stop the workers if the consumer finished early
+            stop.set()
+            executor.shutdown(wait=False)
+
+            self.elapsed = time.monotonic() - start
+            print(f"fetched {self.pages_fetched} pages in {self.elapsed:.1f}s ({self.pages_per_second:.1f} pages/sec)")
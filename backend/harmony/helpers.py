@@ -1,66 +1,70 @@
+import math
 import os
 import re
-import requests
-import time
-from harmony import db
-from harmony.models import User, Channel, MessageSentiment, Message, UserSentiment
+from sqlalchemy import Integer, cast, func, literal_column, tuple_
+from sqlalchemy.orm import contains_eager, joinedload
+from harmony import db, summary
+from harmony.clustering import MESSAGE_TIME
+from harmony.fetcher import DiscordSession
+from harmony.models import Channel, ClusterMessage, CorefMessage, MessageSentiment, Message, UserSentimentSummary, user_bridge_association
+from harmony.directory import QUERY_CHUNK, UserDirectory
+from harmony.writer import MessageWriter
 
 
 # load token from .env
 token = os.getenv("DISCORD_TOKEN")
 
+# pooled session shared by every request to the discord api (from every task of the process)
+discord = DiscordSession(token)
+
+# min and max length of prepared messages
+MIN_SIZE = 10
+MAX_SIZE = 50
+
+# regex to find links in messages (https://daringfireball.net/2010/07/improved_regex_for_matching_urls)
+link_pattern = re.compile(r"(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))")
+mention_pattern = re.compile(r"<@!?(\d+)>")  # regex to find mentions in messages
+code_pattern = re.compile(r"```.+\n.*\n```")  # regex to find code blocks
+special_chars_pattern = re.compile(r"[^A-Za-z0-9\'\" ]+")  # regex to find special characters (not alphanumeric, quotes, or space)
+
 
 # returns json associated with request to discord api
 def send_request(url):
-    request = requests.get(f"https://discord.com/api{url}", headers={'Authorization': f'Bot {token}'})
+    return discord.get(url)
 
-    # if rate limited, wait "retry_after" seconds
-    while request.status_code == 429:
-        print("Sleeping because of rate limit.")
-        time.sleep(float(request.headers["retry-after"]) / 1000)
-        request = requests.get(f"https://discord.com/api{url}", headers={'Authorization': f'Bot {token}'})
 
-    
-    return request.json()
+# returns the username of the user on discord
+def fetch_username(user_id):
+    return send_request(f"/users/{user_id}")['username']
 
 
 class Helper:
     def __init__(self, channel_id):
         self.channel_id = channel_id
         self.channel = Channel.query.get(self.channel_id)
+        self.writer = MessageWriter(self.channel_id)  # buffers rows created while gathering messages
+        self.users = UserDirectory(self.channel_id, self.writer, fetch_username)  # users of the channel known during this run
 
-    # adds user to database
+    # adds user to database and returns their username
     def add_user(self, user_id):
-        # check if user and channel exist in database
-        user = User.query.get(user_id)
+        return self.users.add_user(user_id)
+
+    # resolves all authors and mentioned users of a page of Discord message objects at once
+    def prefetch_users(self, messages):
+        user_ids = []
+        known = {}  # usernames included in the message objects
 
-        if user is None:
-            # add user to database if it doesnt exist
-            data = send_request(f"/users/{user_id}")
-            user = User(id=user_id, username=data['username'])
+        for message in messages:
+            user_ids.append(message['author']['id'])
+            user_ids += mention_pattern.findall(message['content'])
 
-            # create relationship between channel and user
-            user.channels.append(self.channel)
+            for user in [message['author']] + message.get('mentions', []):
+                known[user['id']] = user['username']
 
-            db.session.add(user)
-            db.session.commit()
-        elif self.channel not in user.channels:
-            # add channel to user if not yet a part of user
-            user.channels.append(self.channel)
-            db.session.commit()
+        self.users.prefetch(user_ids, known)
 
     # prepares Discord message object for analysis
     def prepare_message(self, message):
-        # min and max length of messages
-        min_size = 10
-        max_size = 50
-
-        # regex to find links in messages (https://daringfireball.net/2010/07/improved_regex_for_matching_urls)
-        link_regex = r"(?i)\b((?:[a-z][\w-]+:(?:/{1,3}|[a-z0-9%])|www\d{0,3}[.]|[a-z0-9.\-]+[.][a-z]{2,4}/)(?:[^\s()<>]+|\(([^\s()<>]+|(\([^\s()<>]+\)))*\))+(?:\(([^\s()<>]+|(\([^\s()<>]+\)))*\)|[^\s`!()\[\]{};:'\".,<>?«»“”‘’]))"
-        mention_regex = r"<@!?(\d+)>"  # regex to find mentions in messages
-        code_regex = r"```.+\n.*\n```"  # regex to find code blocks
-        special_chars_regex = r"[^A-Za-z0-9\'\" ]+"  # regex to find special characters (not alphanumeric, quotes, or space)
-
         # ensure message type is 0 (DEFAULT)
         if message['type'] != 0:
             return
@@ -69,57 +73,170 @@ class Helper:
         if message['attachments']:
             return
 
-        # ignore messages with code blocks
-        if len(re.findall(code_regex, message['content'])) != 0:
+        content = message['content']
+        has_mentions = '<@' in content
+
+        # without mentions the content can only get shorter, so short messages can be rejected before any regex runs
+        if not has_mentions and len(content) < MIN_SIZE:
             return
 
-        # ignore messages with links
-        if len(re.findall(link_regex, message['content'])) != 0:
+        # ignore messages with code blocks
+        if '```' in content and code_pattern.search(content):
             return
 
-        # return username of the mentioned user
-        def get_username_from_mention(match):
-            self.add_user(match.group(1))  # group(1) contains id of the mentioned user
-            return User.query.get(match.group(1)).username
+        # ignore messages with links (every link contains a ':' or a '.')
+        if ('.' in content or ':' in content) and link_pattern.search(content):
+            return
 
-        # replace mentions with respective user
-        message['content'] = re.sub(mention_regex, get_username_from_mention, message['content'])
+        if has_mentions:
+            # return username of the mentioned user
+            def get_username_from_mention(match):
+                return self.add_user(match.group(1))  # group(1) contains id of the mentioned user
 
-        # remove special characters
-        message['content'] = re.sub(special_chars_regex, '', message['content'])
+            # replace mentions with respective user
+            content = mention_pattern.sub(get_username_from_mention, content)
 
-        # at most one space between words
-        message['content'] = ' '.join(message['content'].split())
+        # remove special characters and leave at most one space between words
+        content = ' '.join(special_chars_pattern.sub('', content).split())
+        message['content'] = content
 
         # ensure message length is within min/max
-        if len(message['content']) < min_size or len(message['content']) > max_size:
+        if len(content) < MIN_SIZE or len(content) > MAX_SIZE:
             return
 
         return message
 
-    # returns messages with the most and least sentiment in the channel
-    def min_max_sentiments(self):
-        # get all message sentiments in channel
-        sentiments = MessageSentiment.query.join(Message, MessageSentiment.message).filter(Message.channel_id == self.channel_id)
-        min_sentiment = sentiments.first()
-        max_sentiment = min_sentiment
-
-        for sentiment in sentiments:
-            # update min/max sentiments based on score
-            if sentiment.score < min_sentiment.score:
-                min_sentiment = sentiment
-            elif sentiment.score > max_sentiment.score:
-                max_sentiment = sentiment
+    # prepares a page of Discord message objects, yielding the ones accepted for analysis
+    # messages are prepared lazily so the caller can stop partway through the page
+    def prepare_messages(self, messages):
+        for message in messages:
+            message = self.prepare_message(message)
+            if message is not None:
+                yield message
 
-        return min_sentiment, max_sentiment
+    # returns messages with the most and least sentiment in the channel (or None if there are none)
+    def min_max_sentiments(self):
+        min_sentiments = self.top_sentiments(1, ascending=True)
+        max_sentiments = self.top_sentiments(1)
+
+        return (min_sentiments[0] if min_sentiments else None), (max_sentiments[0] if max_sentiments else None)
+
+    # returns the k message sentiments with the highest (or lowest if ascending) score in the channel, or of the messages sent by user_id
+    # reads the sentiments in order of score from an index, so only k rows are read
+    def top_sentiments(self, k, ascending=False, user_id=None):
+        query = MessageSentiment.query.join(Message, MessageSentiment.message).options(contains_eager(MessageSentiment.message))\
+            .filter(MessageSentiment.channel_id == self.channel_id)
+        if user_id is not None:
+            query = query.filter(MessageSentiment.user_id == user_id)
+
+        if ascending:
+            query = query.order_by(MessageSentiment.score.asc(), MessageSentiment.id.asc())
+        else:
+            query = query.order_by(MessageSentiment.score.desc(), MessageSentiment.id.desc())
+
+        return query.limit(k).all()
+
+    # returns the message sentiments with the lowest and highest score of each user in the channel as {user id: (min sentiment, max sentiment)}
+    # users without sentiments are left out
+    def user_extremes(self):
+        # id of the sentiment of the user with the lowest (or highest) score, read from an index for each user
+        def extreme(*order):
+            return db.session.query(MessageSentiment.id).filter(MessageSentiment.channel_id == self.channel_id)\
+                .filter(MessageSentiment.user_id == user_bridge_association.c.user_id).order_by(*order).limit(1).scalar_subquery()
+
+        extremes = db.session.query(user_bridge_association.c.user_id,
+            extreme(MessageSentiment.score.asc(), MessageSentiment.id.asc()), extreme(MessageSentiment.score.desc(), MessageSentiment.id.desc()))\
+            .filter(user_bridge_association.c.channel_id == self.channel_id).all()
+        extremes = [(user_id, min_id, max_id) for user_id, min_id, max_id in extremes if min_id is not None]
+
+        # load the sentiments and their messages at once
+        ids = [sentiment_id for _, min_id, max_id in extremes for sentiment_id in (min_id, max_id)]
+        sentiments = {}
+        for i in range(0, len(ids), QUERY_CHUNK):
+            for sentiment in MessageSentiment.query.options(joinedload(MessageSentiment.message)).filter(MessageSentiment.id.in_(ids[i:i + QUERY_CHUNK])):
+                sentiments[sentiment.id] = sentiment
+
+        return {user_id: (sentiments[min_id], sentiments[max_id]) for user_id, min_id, max_id in extremes}
+
+    # returns the number of message sentiments in the channel and the score at each percentile (0 to 100) in percentiles
+    # each percentile is the score of the nearest sentiment in order of score, read from an index without loading the others
+    def score_percentiles(self, percentiles):
+        scores = db.session.query(MessageSentiment.score).filter(MessageSentiment.channel_id == self.channel_id)
+        count = scores.with_entities(func.count()).scalar()
+        if count == 0:
+            return 0, {percentile: None for percentile in percentiles}
+
+        return count, {percentile: scores.order_by(MessageSentiment.score).offset(round(percentile / 100 * (count - 1))).limit(1).scalar() for percentile in percentiles}
+
+    # returns the number of message sentiments in the channel with a score in each of bins equal ranges from -1 to 1
+    # the sentiments are counted by the database, so none are loaded
+    def score_histogram(self, bins):
+        bin = func.min(cast((MessageSentiment.score + 1) * bins / 2, Integer), bins - 1)
+        counts = dict(db.session.query(bin, func.count()).filter(MessageSentiment.channel_id == self.channel_id).group_by(bin).all())
+
+        return [{'min': -1 + 2 * i / bins, 'max': -1 + 2 * (i + 1) / bins, 'count': counts.get(i, 0)} for i in range(bins)]
+
+    # returns the messages of the channel from newest to oldest with their resolved content and sentiment (None until analyzed)
+    # before is the (time, id) of the last message of the previous page, so a page is read from an index however deep it is
+    # rows are streamed from the database instead of being loaded at once
+    def message_page(self, before=None, limit=100):
+        time = literal_column(MESSAGE_TIME)  # the indexed time of the message
+        query = db.session.query(time.label('time'), Message.id, Message.user_id, Message.timestamp, Message.content,
+                CorefMessage.content.label('coref_content'), MessageSentiment.score, MessageSentiment.magnitude)\
+            .select_from(Message)\
+            .outerjoin(ClusterMessage, ClusterMessage.message_id == Message.id)\
+            .outerjoin(CorefMessage, CorefMessage.cluster_message_id == ClusterMessage.id)\
+            .outerjoin(MessageSentiment, MessageSentiment.message_id == Message.id)\
+            .filter(Message.channel_id == self.channel_id)
+        if before is not None:
+            # the first condition lets sqlite seek to the cursor in the index (it does not for the comparison of (time, id) alone)
+            query = query.filter(time <= before[0]).filter(tuple_(time, Message.id) < tuple_(*before))
+
+        return query.order_by(time.desc(), Message.id.desc()).limit(limit).yield_per(QUERY_CHUNK)
+
+    # returns a string that changes whenever the analyzed messages of the channel may have changed
+    # only reads the channel, the newest row ids and the number of messages of the channel (counted in its index), so it never reads a table
+    # the messages are counted because stage 1 writes them in batches without updating the channel until its last one
+    def results_version(self):
+        channel = self.channel
+        messages = db.session.query(func.count(Message.id)).filter(Message.channel_id == self.channel_id).scalar()
+        coref_message_id = db.session.query(func.max(CorefMessage.id)).scalar()
+        message_sentiment_id = db.session.query(func.max(MessageSentiment.id)).scalar()
+
+        return f"{channel.stage} {channel.running} {channel.progress} {channel.last_message_id} {messages} {channel.max_dist} {channel.max_cum_dist} {coref_message_id} {message_sentiment_id}"
 
     # returns the average sentiment score and magnitude for the object user referring to the subject user
     def avg_sentiment(self, object_user_id, subject_user_id):
-        # get average score and magnitude for UserSentiments that fit the specified criteria
-        avg_score, avg_magnitude = UserSentiment.query.join(Message, UserSentiment.message)\
-            .filter(Message.channel_id == self.channel_id)\
-            .filter(UserSentiment.object_user_id == object_user_id)\
-            .filter(UserSentiment.subject_user_id == subject_user_id)\
-            .with_entities(db.func.avg(UserSentiment.score), db.func.avg(UserSentiment.magnitude)).first()
-
-        return avg_score, avg_magnitude
\ No newline at end of file
+        # read the totals kept for the pair instead of aggregating its UserSentiments
+        totals = UserSentimentSummary.query.filter(UserSentimentSummary.channel_id == self.channel_id)\
+            .filter(UserSentimentSummary.object_user_id == object_user_id)\
+            .filter(UserSentimentSummary.subject_user_id == subject_user_id)\
+            .filter(UserSentimentSummary.day == summary.ALL_DAYS).first()
+
+        if totals is None or totals.count == 0:
+            return None, None
+
+        return totals.score_sum / totals.count, totals.magnitude_sum / totals.count
+
+    # returns the sentiment of every object user referring to every subject user in the channel with a single query
+    # covers all messages, or the messages sent from first_day to last_day (days since 1970, inclusive) if either is given
+    def sentiment_matrix(self, first_day=None, last_day=None):
+        matrix = []
+
+        for object_user_id, subject_user_id, count, score_sum, score_squares, magnitude_sum, magnitude_squares in summary.pair_totals(self.channel_id, first_day, last_day):
+            if count <= 0:
+                continue
+
+            avg_score = score_sum / count
+            avg_magnitude = magnitude_sum / count
+            matrix.append({
+                'object_user_id': object_user_id,
+                'subject_user_id': subject_user_id,
+                'count': count,
+                'avg_score': avg_score,
+                'std_score': math.sqrt(max(score_squares / count - avg_score * avg_score, 0)),
+                'avg_magnitude': avg_magnitude,
+                'std_magnitude': math.sqrt(max(magnitude_squares / count - avg_magnitude * avg_magnitude, 0))
+            })
+
+        return matrix
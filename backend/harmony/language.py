@@ -0,0 +1,277 @@
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from harmony.cache import ResultCache, content_key
+
+
+LANGUAGE_CLIENT = os.getenv("LANGUAGE_CLIENT", "google")  # google, local (in-process lexicon scoring) or fake (offline, deterministic)
+LANGUAGE_CACHE_SIZE = int(os.getenv("LANGUAGE_CACHE_SIZE", 100000))  # max number of responses kept per call type (0 disables the cache)
+LANGUAGE_CACHE_TTL = float(os.getenv("LANGUAGE_CACHE_TTL", 30 * 24 * 60 * 60))  # seconds a cached response stays valid
+LANGUAGE_BATCH_SIZE = int(os.getenv("LANGUAGE_BATCH_SIZE", 64))  # number of documents analyzed together
+LANGUAGE_CONCURRENCY = int(os.getenv("LANGUAGE_CONCURRENCY", 16))  # max number of documents being analyzed by google at once
+LANGUAGE_QPS = float(os.getenv("LANGUAGE_QPS", 10))  # max requests per second sent to google (the default quota is 600 per minute)
+LANGUAGE_RETRIES = int(os.getenv("LANGUAGE_RETRIES", 5))  # number of times a request is retried when google is overloaded
+BACKOFF_BASE = 0.5  # seconds waited before the first retry (doubles every retry)
+BACKOFF_MAX = 30  # max seconds waited before a retry
+
+language = "en"
+
+# responses of every client are plain dicts (so they can be cached as json):
+# analyze_sentiment -> {'sentences': [{'begin_offset', 'score', 'magnitude'}]}
+# analyze_entity_sentiment -> {'entities': [{'name', 'mentions': [{'begin_offset', 'score', 'magnitude'}]}]}
+# offsets are in utf-8 bytes from the start of the document
+
+
+# interface of every language client (or local sentiment backend)
+class LanguageClient:
+    def analyze_sentiment(self, content):
+        raise NotImplementedError
+
+    def analyze_entity_sentiment(self, content):
+        raise NotImplementedError
+
+    # returns [(sentiment response, entity response)] for each content
+    # backends that can score many documents at once override this
+    def analyze_documents(self, contents):
+        return [(self.analyze_sentiment(content), self.analyze_entity_sentiment(content)) for content in contents]
+
+    # yields (content, (sentiment response, entity response)) for each content in order, analyzing batch_size documents at a time
+    # contents is consumed lazily
+    def analyze_stream(self, contents, batch_size=LANGUAGE_BATCH_SIZE):
+        batch = []
+        for content in contents:
+            batch.append(content)
+            if len(batch) >= batch_size:
+                yield from zip(batch, self.analyze_documents(batch))
+                batch = []
+
+        if batch:
+            yield from zip(batch, self.analyze_documents(batch))
+
+
+# limits the rate of requests shared by many threads (allows bursts of up to capacity requests)
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate  # requests per second
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    # blocks until a request can be made
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+
+                delay = (1 - self.tokens) / self.rate
+
+            time.sleep(delay)
+
+
+# sends documents to the google natural language api
+# requests are limited to LANGUAGE_QPS across all threads and retried with exponential backoff when google is overloaded
+class GoogleLanguageClient(LanguageClient):
+    def __init__(self, qps=LANGUAGE_QPS, retries=LANGUAGE_RETRIES):
+        from google.api_core import exceptions
+        from google.cloud import language_v1
+
+        self.client = language_v1.LanguageServiceClient()
+        self.type_ = language_v1.types.Document.Type.PLAIN_TEXT
+        self.encoding_type = language_v1.EncodingType.UTF8
+
+        self.limiter = TokenBucket(qps)
+        self.retries = retries
+        self.retryable = (exceptions.ResourceExhausted, exceptions.ServiceUnavailable, exceptions.DeadlineExceeded, exceptions.InternalServerError)
+
+    # returns the response of method for content
+    def call(self, method, content):
+        request = {'document': {'content': content, 'type_': self.type_, 'language': language}, 'encoding_type': self.encoding_type}
+
+        for attempt in range(self.retries + 1):
+            self.limiter.acquire()
+            try:
+                return getattr(self.client, method)(request=request)
+            except self.retryable as e:
+                if attempt == self.retries:
+                    raise
+
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1)
+                print(f"Retrying {method} in {delay:.1f}s: {e}")
+                time.sleep(delay)
+
+    def analyze_sentiment(self, content):
+        response = self.call('analyze_sentiment', content)
+        return {'sentences': [{'begin_offset': sentence.text.begin_offset, 'score': sentence.sentiment.score, 'magnitude': sentence.sentiment.magnitude} for sentence in response.sentences]}
+
+    def analyze_entity_sentiment(self, content):
+        response = self.call('analyze_entity_sentiment', content)
+        return {'entities': [{
+            'name': entity.name,
+            'mentions': [{'begin_offset': mention.text.begin_offset, 'score': mention.sentiment.score, 'magnitude': mention.sentiment.magnitude} for mention in entity.mentions]
+        } for entity in response.entities]}
+
+
+# an offline stand-in for the google client, for tests and benchmarks
+# scores are derived from a checksum of the text, so the same document always gets the same result
+class FakeLanguageClient(LanguageClient):
+    sentence_pattern = re.compile(r"[^.]+")  # sentences are separated by periods
+    word_pattern = re.compile(r"[A-Za-z]{3,}")  # every word of 3+ letters is treated as an entity
+
+    def __init__(self, latency=0):
+        self.latency = latency  # seconds each call takes, to simulate the round trip to google
+
+    # returns a deterministic (score, magnitude) for text
+    @staticmethod
+    def score(text):
+        checksum = zlib.crc32(text.encode('utf-8'))
+        score = (checksum % 2001) / 1000 - 1
+        return round(score, 3), round(abs(score) * (1 + checksum % 3), 3)
+
+    def analyze_sentiment(self, content):
+        time.sleep(self.latency)
+
+        sentences = []
+        for match in self.sentence_pattern.finditer(content):
+            text = match.group().strip()
+            if text:
+                start = match.start() + match.group().index(text)
+                score, magnitude = self.score(text)
+                sentences.append({'begin_offset': len(content[:start].encode('utf-8')), 'score': score, 'magnitude': magnitude})
+
+        return {'sentences': sentences}
+
+    def analyze_entity_sentiment(self, content):
+        time.sleep(self.latency)
+
+        entities = {}  # lowercase name -> entity
+        for match in self.word_pattern.finditer(content):
+            score, magnitude = self.score(match.group())
+            entity = entities.setdefault(match.group().lower(), {'name': match.group(), 'mentions': []})
+            entity['mentions'].append({'begin_offset': len(content[:match.start()].encode('utf-8')), 'score': score, 'magnitude': magnitude})
+
+        return {'entities': list(entities.values())}
+
+
+# serves responses of client from a persistent cache keyed by the content of the document
+class CachedLanguageClient(LanguageClient):
+    def __init__(self, client, max_entries=LANGUAGE_CACHE_SIZE, ttl=LANGUAGE_CACHE_TTL):
+        self.client = client
+        self.name = type(client).__name__  # responses of different clients are cached separately
+        self.caches = {
+            'analyze_sentiment': ResultCache('analyze_sentiment', max_entries, ttl),
+            'analyze_entity_sentiment': ResultCache('analyze_entity_sentiment', max_entries, ttl)
+        }
+
+    # returns the cached response of method for content, calling the client on a miss
+    def call(self, method, content):
+        cache = self.caches[method]
+        key = content_key(self.name, language, content)
+
+        response = cache.get(key)
+        if response is None:
+            response = getattr(self.client, method)(content)
+            cache.set(key, response)
+
+        return response
+
+    def analyze_sentiment(self, content):
+        return self.call('analyze_sentiment', content)
+
+    def analyze_documents(self, contents):
+        keys = [content_key(self.name, language, content) for content in contents]
+        sentiments = self.caches['analyze_sentiment'].get_many(keys)
+        entities = self.caches['analyze_entity_sentiment'].get_many(keys)
+
+        # analyze every document missing a response (each distinct document only once)
+        missing = list({key: content for key, content in zip(keys, contents) if key not in sentiments or key not in entities}.items())
+        if missing:
+            responses = self.client.analyze_documents([content for _, content in missing])
+            for (key, _), (sentiment_response, entity_response) in zip(missing, responses):
+                sentiments[key] = sentiment_response
+                entities[key] = entity_response
+
+            self.caches['analyze_sentiment'].set_many({key: sentiments[key] for key, _ in missing})
+            self.caches['analyze_entity_sentiment'].set_many({key: entities[key] for key, _ in missing})
+
+        return [(sentiments[key], entities[key]) for key in keys]
+
+    def analyze_entity_sentiment(self, content):
+        return self.call('analyze_entity_sentiment', content)
+
+    # returns {method: (hits, misses)}
+    def stats(self):
+        return {method: (cache.hits, cache.misses) for method, cache in self.caches.items()}
+
+
+# keeps up to concurrency documents in flight on a thread pool, both calls of each document running in parallel
+# results are still returned in order, so a single writer can apply them
+class ConcurrentLanguageClient(LanguageClient):
+    def __init__(self, client, concurrency=LANGUAGE_CONCURRENCY):
+        self.client = client
+        self.concurrency = concurrency
+
+    def analyze_sentiment(self, content):
+        return self.client.analyze_sentiment(content)
+
+    def analyze_entity_sentiment(self, content):
+        return self.client.analyze_entity_sentiment(content)
+
+    def analyze_documents(self, contents):
+        return [responses for _, responses in self.analyze_stream(contents)]
+
+    def analyze_stream(self, contents, batch_size=LANGUAGE_BATCH_SIZE):
+        executor = ThreadPoolExecutor(max_workers=self.concurrency * 2)
+        pending = deque()  # (content, sentiment future, entity future) of documents in flight
+
+        try:
+            for content in contents:
+                pending.append((content, executor.submit(self.client.analyze_sentiment, content), executor.submit(self.client.analyze_entity_sentiment, content)))
+
+                # wait for the oldest document once the window is full
+                if len(pending) >= self.concurrency:
+                    content, sentiment, entities = pending.popleft()
+                    yield content, (sentiment.result(), entities.result())
+
+            while pending:
+                content, sentiment, entities = pending.popleft()
+                yield content, (sentiment.result(), entities.result())
+        finally:
+            # drop requests that have not started if the caller stopped early
+            for _, sentiment, entities in pending:
+                sentiment.cancel()
+                entities.cancel()
+
+            executor.shutdown(wait=False)
+
+
+# returns the language client configured by LANGUAGE_CLIENT, behind the response cache
+def create_client(name=LANGUAGE_CLIENT, cache_size=LANGUAGE_CACHE_SIZE):
+    if name == 'google':
+        client = GoogleLanguageClient()
+    elif name == 'fake':
+        client = FakeLanguageClient(float(os.getenv("FAKE_LANGUAGE_LATENCY", 0)))
+    elif name == 'local':
+        from harmony.sentiment import LocalLanguageClient
+
+        # scoring locally is cheaper than a cache lookup
+        return LocalLanguageClient()
+    else:
+        raise ValueError(f"Unknown language client {name}")
+
+    if cache_size > 0:
+        client = CachedLanguageClient(client, cache_size)
+
+    # remote clients are called concurrently (cache lookups happen on the worker threads too)
+    return ConcurrentLanguageClient(client)
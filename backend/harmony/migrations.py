@@ -0,0 +1,50 @@
+from sqlalchemy import inspect, text
+from harmony import app, db
+
+
+# brings an existing database up to date with the models
+# creates missing tables and adds columns and indexes added to the models since the database was created
+def upgrade_schema():
+    db.create_all()
+
+    inspector = inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = {column['name'] for column in inspector.get_columns(table.name)}
+
+        for column in table.columns:
+            if column.name in existing:
+                continue
+
+            # sqlite can only add columns that are nullable or have a default
+            if not column.nullable and column.server_default is None:
+                print(f"cannot add column {table.name}.{column.name}, recreate the database")
+                continue
+
+            print(f"adding column {table.name}.{column.name}")
+            db.session.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column.type.compile(dialect=db.engine.dialect)}'))
+
+    # fill the channel and author of message sentiments stored before they were copied from the message
+    db.session.execute(text('''
+        UPDATE message_sentiment SET
+            channel_id = (SELECT channel_id FROM message WHERE message.id = message_sentiment.message_id),
+            user_id = (SELECT user_id FROM message WHERE message.id = message_sentiment.message_id)
+        WHERE channel_id IS NULL
+    '''))
+    db.session.commit()
+
+    # create indexes added to the models since the tables were created (by name, as expression indexes cannot be reflected)
+    existing = {row[0] for row in db.session.execute(text("SELECT name FROM sqlite_master WHERE type = 'index'"))}
+    db.session.commit()
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in existing:
+                print(f"creating index {index.name}")
+                index.create(db.engine)
+
+
+# run once per deployment before the api and the workers start, so they never race on the schema and importing the app stays cheap
+# usage: FLASK_APP=app flask upgrade-db
+@app.cli.command('upgrade-db')
+def upgrade_db():
+    upgrade_schema()
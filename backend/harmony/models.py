@@ -1,10 +1,12 @@
 from harmony import db
+from harmony.clustering import MESSAGE_TIME
 
 
 # bridge entity used for many-many relationship between channels and users
 user_bridge_association = db.Table('users',
     db.Column('user_id', db.String(32), db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True),
-    db.Column('channel_id', db.String(32), db.ForeignKey('channel.id', ondelete='CASCADE'), primary_key=True)
+    db.Column('channel_id', db.String(32), db.ForeignKey('channel.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_users_channel_id', 'channel_id')  # the primary key only finds the channels of a user
 )
 
 
@@ -16,6 +18,9 @@ class Channel(db.Model):
     stage = db.Column(db.Integer, nullable=False)  # the current analysis stage
     progress = db.Column(db.Integer, nullable=False)  # the progress in the current stage
     limit = db.Column(db.Integer, nullable=False)  # max number of messages to analyze
+    max_dist = db.Column(db.Float)  # max seconds between consecutive messages in a cluster (defaults to MAX_DIST)
+    max_cum_dist = db.Column(db.Float)  # max seconds between the first and last message in a cluster (defaults to MAX_CUM_DIST)
+    last_message_id = db.Column(db.String(32))  # id of the newest message fetched (messages after it are fetched by a refresh)
 
     users = db.relationship('User', secondary=user_bridge_association, back_populates='channels', lazy='dynamic', cascade='all, delete')
     messages = db.relationship('Message', back_populates='channel', cascade='all, delete', passive_deletes=True)
@@ -38,9 +43,11 @@ class User(db.Model):
 
 # an alternate name for the user
 class UserAlternate(db.Model):
+    __table_args__ = (db.Index('ix_user_alternate_channel_name', 'channel_id', 'name'),)
+
     id = db.Column(db.Integer, primary_key=True)
     channel_id = db.Column(db.String(32), db.ForeignKey('channel.id', ondelete='CASCADE'), nullable=False)
-    user_id = db.Column(db.String(32), db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.String(32), db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
 
     name = db.Column(db.Text, nullable=False)  # alternate name
 
@@ -57,7 +64,7 @@ class UserAlternate(db.Model):
 # a group of messages that share the same channel and were sent around the same time frame
 class MessageCluster(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    channel_id = db.Column(db.String(32), db.ForeignKey('channel.id', ondelete='CASCADE'), nullable=False)
+    channel_id = db.Column(db.String(32), db.ForeignKey('channel.id', ondelete='CASCADE'), nullable=False, index=True)
 
     channel = db.relationship('Channel', back_populates='clusters')
     messages = db.relationship('ClusterMessage', back_populates='cluster', cascade='all, delete', passive_deletes=True)
@@ -65,9 +72,12 @@ class MessageCluster(db.Model):
 
 # a Discord message
 class Message(db.Model):
+    # lets the messages of a channel be read in order of time (as computed by MESSAGE_TIME) and id without sorting them
+    __table_args__ = (db.Index('ix_message_channel_time_id', 'channel_id', db.text(MESSAGE_TIME), 'id'),)
+
     id = db.Column(db.String(32), primary_key=True)
     channel_id = db.Column(db.String(32), db.ForeignKey('channel.id', ondelete='CASCADE'), nullable=False)
-    user_id = db.Column(db.String(32), db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.String(32), db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
 
     content = db.Column(db.Text, nullable=False)
     timestamp = db.Column(db.Text, nullable=False)
@@ -82,8 +92,8 @@ class Message(db.Model):
 # a message that belongs to a cluster
 class ClusterMessage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    message_id = db.Column(db.String(32), db.ForeignKey('message.id', ondelete='CASCADE'), nullable=False)
-    message_cluster_id = db.Column(db.Integer, db.ForeignKey('message_cluster.id', ondelete='CASCADE'), nullable=False)
+    message_id = db.Column(db.String(32), db.ForeignKey('message.id', ondelete='CASCADE'), nullable=False, index=True)
+    message_cluster_id = db.Column(db.Integer, db.ForeignKey('message_cluster.id', ondelete='CASCADE'), nullable=False, index=True)
 
     message = db.relationship('Message', back_populates='cluster_message')
     coref_message = db.relationship('CorefMessage', back_populates='cluster_message', uselist=False, cascade='all, delete', passive_deletes=True)
@@ -93,7 +103,7 @@ class ClusterMessage(db.Model):
 # a message after it has had its coreferences resolved
 class CorefMessage(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    cluster_message_id = db.Column(db.Integer, db.ForeignKey('cluster_message.id', ondelete='CASCADE'), nullable=False)
+    cluster_message_id = db.Column(db.Integer, db.ForeignKey('cluster_message.id', ondelete='CASCADE'), nullable=False, index=True)
 
     content = db.Column(db.Text, nullable=False)  # content of the message after coreference resolution
 
@@ -104,25 +114,73 @@ class CorefMessage(db.Model):
 
 # the sentiment of a message
 class MessageSentiment(db.Model):
+    # lets the most positive and negative messages of a channel (or of one of its users) be read in order of score without a scan
+    __table_args__ = (
+        db.Index('ix_message_sentiment_channel_score', 'channel_id', 'score'),
+        db.Index('ix_message_sentiment_channel_user_score', 'channel_id', 'user_id', 'score'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    message_id = db.Column(db.String(32), db.ForeignKey('message.id', ondelete='CASCADE'), nullable=False)
+    message_id = db.Column(db.String(32), db.ForeignKey('message.id', ondelete='CASCADE'), nullable=False, index=True)
+    channel_id = db.Column(db.String(32), db.ForeignKey('channel.id', ondelete='CASCADE'))  # channel of the message (copied so sentiments can be ordered by score per channel)
+    user_id = db.Column(db.String(32), db.ForeignKey('user.id', ondelete='CASCADE'), index=True)  # author of the message (copied so sentiments can be ordered by score per user)
 
     score = db.Column(db.Float, nullable=False)
     magnitude = db.Column(db.Float, nullable=False)
 
     message = db.relationship('Message', back_populates='message_sentiment')
 
+    def to_json(self):
+        return {
+            'message_id': self.message_id,
+            'user_id': self.user_id,
+            'content': self.message.content,
+            'timestamp': self.message.timestamp,
+            'score': self.score,
+            'magnitude': self.magnitude
+        }
+
 
 # the sentiment of the users present in the message contents
 class UserSentiment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    message_id = db.Column(db.String(32), db.ForeignKey('message.id', ondelete='CASCADE'), nullable=False)
-    object_user_id = db.Column(db.String(32), db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
-    subject_user_id = db.Column(db.String(32), db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False)
+    message_id = db.Column(db.String(32), db.ForeignKey('message.id', ondelete='CASCADE'), nullable=False, index=True)
+    object_user_id = db.Column(db.String(32), db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    subject_user_id = db.Column(db.String(32), db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
 
     score = db.Column(db.Float, nullable=False)
     magnitude = db.Column(db.Float, nullable=False)
 
     message = db.relationship('Message', back_populates='user_sentiments')
     object_user = db.relationship('User', foreign_keys=[object_user_id], back_populates='object_sentiments')  # the user referring to subject_user
-    subject_user = db.relationship('User', foreign_keys=[subject_user_id], back_populates='subject_sentiments')  # the user being referred to
\ No newline at end of file
+    subject_user = db.relationship('User', foreign_keys=[subject_user_id], back_populates='subject_sentiments')  # the user being referred to
+
+
+# running totals of the user sentiments of every (object user, subject user) pair in a channel, kept up to date as user sentiments are stored
+# totals are kept for all messages (day ALL_DAYS) and, if enabled, for the messages of each day (days since 1970)
+class UserSentimentSummary(db.Model):
+    __table_args__ = (db.UniqueConstraint('channel_id', 'object_user_id', 'subject_user_id', 'day'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    channel_id = db.Column(db.String(32), db.ForeignKey('channel.id', ondelete='CASCADE'), nullable=False)
+    object_user_id = db.Column(db.String(32), db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    subject_user_id = db.Column(db.String(32), db.ForeignKey('user.id', ondelete='CASCADE'), nullable=False, index=True)
+    day = db.Column(db.Integer, nullable=False)
+
+    count = db.Column(db.Integer, nullable=False)
+    score_sum = db.Column(db.Float, nullable=False)
+    score_squares = db.Column(db.Float, nullable=False)  # sum of squared scores
+    magnitude_sum = db.Column(db.Float, nullable=False)
+    magnitude_squares = db.Column(db.Float, nullable=False)  # sum of squared magnitudes
+
+
+# how far a stopped stage got, so starting the stage again continues from there instead of redoing it
+# value is json written by the stage in the same transaction as its output (see harmony.checkpoints)
+class StageCheckpoint(db.Model):
+    __table_args__ = (db.UniqueConstraint('channel_id', 'stage'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    channel_id = db.Column(db.String(32), db.ForeignKey('channel.id', ondelete='CASCADE'), nullable=False)
+    stage = db.Column(db.Integer, nullable=False)
+
+    value = db.Column(db.Text, nullable=False)
@@ -0,0 +1,178 @@
+import os
+import queue
+import threading
+from harmony import app, db
+from harmony.clustering import OnlineClusterer, message_time
+from harmony.progress import ProgressTracker
+from harmony.resolver import EntityResolver
+
+
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 16))  # max number of pages (or chunks of clusters) waiting between two stages
+
+DONE = None  # put into a queue after the last item
+
+
+# runs stages 1, 3, 4 and 5 at the same time, each in its own thread with its own database session
+# pages of messages flow from ingestion to clustering and coreference resolution, and closed clusters flow on to sentiment analysis,
+# through bounded queues, so a fast stage waits for a slow one instead of buffering the whole channel
+class Pipeline:
+    def __init__(self, channel_id, queue_size=PIPELINE_QUEUE_SIZE):
+        self.channel_id = channel_id
+        self.pages = queue.Queue(maxsize=queue_size)  # pages of stored messages waiting to be clustered
+        self.resolved = queue.Queue(maxsize=queue_size)  # chunks of resolved messages waiting for sentiment analysis
+
+        self.stop = threading.Event()  # set when a stage stops early, so the other stages stop too
+        self.errors = []
+        self.users_added = 0  # number of times ingestion added users to the channel (so sentiment analysis knows to reload them)
+        self.trackers = {}  # stage -> tracker counting its progress
+
+    # runs every stage and returns whether all of them finished
+    def run(self):
+        stages = [(self.ingest, self.pages), (self.resolve, self.resolved), (self.analyze, None)]
+        threads = [threading.Thread(target=self.run_stage, args=(stage, output)) for stage, output in stages]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # stages finish their trackers, unless they failed
+        for tracker in self.trackers.values():
+            if tracker.running:
+                tracker.finish()
+
+        if self.errors:
+            raise self.errors[0]
+
+        return not self.stop.is_set()
+
+    # returns a tracker counting the progress of stage
+    def track(self, stage):
+        self.trackers[stage] = ProgressTracker(self.channel_id, stage)
+        return self.trackers[stage]
+
+    # runs stage in its own app context (and so with its own session), marking the end of its output
+    def run_stage(self, stage, output):
+        from harmony.analyzer import Analyzer  # imported here as the analyzer imports this module
+
+        with app.app_context():
+            try:
+                finished = stage(Analyzer(self.channel_id))
+            except Exception as e:
+                self.errors.append(e)
+                finished = False
+            finally:
+                db.session.remove()
+
+        if not finished:
+            self.stop.set()
+
+        if output is not None:
+            self.put(output, DONE)
+
+    # puts item into output, giving up if the pipeline has stopped
+    def put(self, output, item):
+        while not self.stop.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    # yields the items of input until the previous stage is done or the pipeline has stopped
+    def items(self, input):
+        while True:
+            try:
+                item = input.get(timeout=0.1)
+            except queue.Empty:
+                if self.stop.is_set():
+                    return
+                continue
+
+            if item is DONE:
+                return
+
+            yield item
+
+    # stage 1: stores the messages of the channel, passing on each page once it is stored
+    def ingest(self, analyzer):
+        members = 0
+
+        def emit(page):
+            nonlocal members
+
+            # stop fetching if a later stage stopped
+            if self.stop.is_set():
+                analyzer.signal.set()
+
+            if len(analyzer.helper.users.members or ()) != members:
+                members = len(analyzer.helper.users.members)
+                self.users_added += 1
+
+            self.put(self.pages, page)
+
+        analyzer.tracker = self.track(1)
+        analyzer.get_messages(emit)
+        analyzer.tracker.finish()
+        return not analyzer.stopped()
+
+    # stages 3 and 4: clusters the messages as they arrive and resolves the coreferences of each cluster once it is closed
+    def resolve(self, analyzer):
+        clusterer = OnlineClusterer(*analyzer.cluster_distances())
+        clusters_tracker = self.track(3)
+        coref_tracker = self.track(4)
+        authors = {}  # cluster message id -> (message id, user id, timestamp) of clusters being resolved
+
+        # stores the closed clusters and yields them as (cluster message ids, [(username, content)])
+        def store(clusters):
+            if not clusters:
+                return
+
+            cluster_message_ids = analyzer.write_clusters([[message['id'] for message, _ in cluster] for cluster in clusters], clusters_tracker)
+            db.session.commit()
+
+            for cluster, ids in zip(clusters, cluster_message_ids):
+                for cluster_message_id, (message, _) in zip(ids, cluster):
+                    authors[cluster_message_id] = (message['id'], message['author']['id'], message['timestamp'])
+
+                yield ids, [(username, message['content']) for message, username in cluster]
+
+        # yields the clusters closed by each page (pages arrive from newest to oldest, like the clusters)
+        def clusters():
+            for page in self.items(self.pages):
+                closed = [clusterer.add(item, message_time(item[0]['timestamp'])) for item in page]
+                yield from store([cluster for cluster in closed if cluster])
+
+            # the last cluster is only closed once every message has arrived
+            last = clusterer.close()
+            if last and not self.stop.is_set():
+                yield from store([last])
+            clusters_tracker.finish()
+
+        for coref_messages in analyzer.resolve_clusters(clusters(), coref_tracker):
+            self.put(self.resolved, [authors.pop(row['cluster_message_id']) + (row['content'],) for row in coref_messages])
+        coref_tracker.finish()
+
+        return not analyzer.stopped() and not self.stop.is_set()
+
+    # stage 5: analyzes the sentiments of the resolved messages as they arrive
+    def analyze(self, analyzer):
+        resolver = EntityResolver(self.channel_id)
+        users_added = 0
+
+        # yields (id, user id, timestamp, resolved content) of each message
+        def messages():
+            nonlocal users_added
+
+            for chunk in self.items(self.resolved):
+                # entities can only be matched to users that have been stored
+                if users_added != self.users_added:
+                    users_added = self.users_added
+                    resolver.load()
+
+                yield from chunk
+
+        tracker = self.track(5)
+        analyzer.analyze_messages(messages(), resolver, tracker)
+        tracker.finish()
+        return not analyzer.stopped() and not self.stop.is_set()
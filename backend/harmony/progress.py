@@ -0,0 +1,216 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+# progress (and requests to stop) are kept out of the main database, so counting rows never takes its write lock
+# and checking whether to stop never reads the channel
+PROGRESS_STORE = os.getenv("PROGRESS_STORE", "sqlite")  # sqlite (shared by the celery workers and the web tier) or memory (a single process)
+PROGRESS_PATH = os.getenv("PROGRESS_PATH", 'progress.db')  # relative to the working directory (like celery-results.db), as the package may be read-only
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", 0.5))  # min seconds between two updates of the store by a tracker
+STOP_CHECK_INTERVAL = float(os.getenv("STOP_CHECK_INTERVAL", 0.2))  # min seconds between two reads of the store by a stop signal
+
+
+# keeps the latest progress of every stage of every channel in memory (only visible to the process that tracks it)
+class MemoryProgressStore:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}  # channel id -> {stage: {shard: progress}}
+        self.stops = set()  # ids of the channels asked to stop
+
+    # stores the progress (a dict, see ProgressTracker.progress) of a shard of a stage of the channel (stages that are not sharded only have shard 0)
+    def publish(self, channel_id, stage, progress, shard=0):
+        with self.lock:
+            self.stages.setdefault(channel_id, {}).setdefault(stage, {})[shard] = progress
+
+    # returns {stage: [progress of each shard]} of every stage of the channel that was tracked
+    def get(self, channel_id):
+        with self.lock:
+            return {stage: list(shards.values()) for stage, shards in self.stages.get(channel_id, {}).items()}
+
+    # forgets the progress of the channel (or only of stage if given)
+    def clear(self, channel_id, stage=None):
+        with self.lock:
+            if stage is None:
+                self.stages.pop(channel_id, None)
+            else:
+                self.stages.get(channel_id, {}).pop(stage, None)
+
+    # asks the analysis of the channel to stop (or withdraws the request if stop is False)
+    def request_stop(self, channel_id, stop=True):
+        with self.lock:
+            if stop:
+                self.stops.add(channel_id)
+            else:
+                self.stops.discard(channel_id)
+
+    # returns whether the analysis of the channel was asked to stop
+    def stop_requested(self, channel_id):
+        with self.lock:
+            return channel_id in self.stops
+
+
+# keeps the latest progress of every stage of every channel in its own sqlite file, so every process sees it
+class SqliteProgressStore:
+    def __init__(self, path=PROGRESS_PATH):
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.connection:
+            self.connection.execute('PRAGMA journal_mode=WAL')  # readers of the progress never wait for the trackers
+
+            # progress is only kept while stages run, so a table without shards is replaced rather than upgraded
+            if 'shard' not in [column[1] for column in self.connection.execute('PRAGMA table_info(progress)')]:
+                self.connection.execute('DROP TABLE IF EXISTS progress')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS progress (channel_id TEXT, stage INTEGER, shard INTEGER, value TEXT NOT NULL, PRIMARY KEY (channel_id, stage, shard))')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS stop (channel_id TEXT PRIMARY KEY)')
+
+    def publish(self, channel_id, stage, progress, shard=0):
+        with self.lock, self.connection:
+            self.connection.execute('INSERT OR REPLACE INTO progress (channel_id, stage, shard, value) VALUES (?, ?, ?, ?)', (channel_id, stage, shard, json.dumps(progress)))
+
+    def get(self, channel_id):
+        stages = {}
+        with self.lock:
+            for stage, value in self.connection.execute('SELECT stage, value FROM progress WHERE channel_id = ? ORDER BY stage, shard', (channel_id,)):
+                stages.setdefault(stage, []).append(json.loads(value))
+
+        return stages
+
+    def clear(self, channel_id, stage=None):
+        with self.lock, self.connection:
+            if stage is None:
+                self.connection.execute('DELETE FROM progress WHERE channel_id = ?', (channel_id,))
+            else:
+                self.connection.execute('DELETE FROM progress WHERE channel_id = ? AND stage = ?', (channel_id, stage))
+
+    def request_stop(self, channel_id, stop=True):
+        with self.lock, self.connection:
+            if stop:
+                self.connection.execute('INSERT OR IGNORE INTO stop (channel_id) VALUES (?)', (channel_id,))
+            else:
+                self.connection.execute('DELETE FROM stop WHERE channel_id = ?', (channel_id,))
+
+    def stop_requested(self, channel_id):
+        with self.lock:
+            return self.connection.execute('SELECT 1 FROM stop WHERE channel_id = ?', (channel_id,)).fetchone() is not None
+
+
+store = None
+store_lock = threading.Lock()
+
+
+# returns the progress store of this process, creating it on first use
+def get_store():
+    global store
+
+    with store_lock:
+        if store is None:
+            if PROGRESS_STORE == 'sqlite':
+                store = SqliteProgressStore()
+            elif PROGRESS_STORE == 'memory':
+                store = MemoryProgressStore()
+            else:
+                raise ValueError(f"Unknown progress store {PROGRESS_STORE}")
+
+    return store
+
+
+# returns the progress of a stage from the progress of its shards
+# the stage runs until every shard finished, and has a total once every shard knows its own
+def merge_shards(shards):
+    if len(shards) == 1:
+        return dict(shards[0], shards=1)
+
+    totals = [shard['total'] for shard in shards]
+    return {
+        'stage': shards[0]['stage'],
+        'done': sum(shard['done'] for shard in shards),
+        'total': sum(totals) if None not in totals else None,
+        'running': any(shard['running'] for shard in shards),
+        'started': min(shard['started'] for shard in shards),
+        'updated': max(shard['updated'] for shard in shards),
+        'shards': len(shards)
+    }
+
+
+# returns the progress of every stage of the channel as {stage: progress}, with the rate (items per second) and eta (seconds, while running) of each
+def channel_progress(channel_id):
+    stages = {stage: merge_shards(shards) for stage, shards in get_store().get(channel_id).items()}
+
+    for progress in stages.values():
+        elapsed = progress['updated'] - progress['started']
+        progress['rate'] = progress['done'] / elapsed if elapsed > 0 else None
+
+        remaining = progress['total'] - progress['done'] if progress['total'] is not None and progress['running'] else None
+        progress['eta'] = remaining / progress['rate'] if remaining is not None and progress['rate'] else None
+
+    return stages
+
+
+# counts the items processed by a stage (or a shard of it), publishing the count to the store at most every interval seconds
+# counting is a few instructions, so it can be done for every item of a hot loop
+class ProgressTracker:
+    def __init__(self, channel_id, stage, total=None, interval=PROGRESS_INTERVAL, shard=0):
+        self.channel_id = channel_id
+        self.stage = stage
+        self.shard = shard
+        self.total = total  # number of items the stage will process (None if unknown)
+        self.interval = interval
+
+        self.done = 0
+        self.started = time.time()
+        self.published = 0  # time of the last publish
+        self.running = True
+
+        self.publish()
+
+    @property
+    def progress(self):
+        return {'stage': self.stage, 'done': self.done, 'total': self.total, 'running': self.running, 'started': self.started, 'updated': time.time()}
+
+    # counts count more items as processed
+    def add(self, count=1):
+        self.done += count
+        if time.time() - self.published >= self.interval:
+            self.publish()
+
+    # sets the number of items processed
+    def update(self, done):
+        self.done = done
+        if time.time() - self.published >= self.interval:
+            self.publish()
+
+    # publishes the progress now
+    def publish(self):
+        self.published = time.time()
+        get_store().publish(self.channel_id, self.stage, self.progress, self.shard)
+
+    # publishes the final progress once the stage finished or stopped
+    def finish(self):
+        self.running = False
+        self.publish()
+
+
+# tells a run whether it should stop, checking for a stop request at most every interval seconds
+# so hot loops can check it for every item
+class StopSignal:
+    def __init__(self, channel_id, interval=STOP_CHECK_INTERVAL):
+        self.channel_id = channel_id
+        self.interval = interval
+
+        self.stopped = False
+        self.checked = 0  # time of the last read of the store
+
+    # stops this run only (without asking other runs of the channel to stop)
+    def set(self):
+        self.stopped = True
+
+    # returns whether the run should stop
+    def is_set(self):
+        if not self.stopped and time.monotonic() - self.checked >= self.interval:
+            self.checked = time.monotonic()
+            self.stopped = get_store().stop_requested(self.channel_id)
+
+        return self.stopped
@@ -0,0 +1,71 @@
+import os
+import re
+import unicodedata
+from difflib import get_close_matches
+from harmony import db
+from harmony.models import User, UserAlternate, user_bridge_association
+
+
+# how entity names are matched to users: exact (case insensitive), normalized (also ignores accents, spaces and punctuation)
+# or fuzzy (also matches names similar to a username or alternate name)
+ENTITY_MATCHING = os.getenv("ENTITY_MATCHING", "exact")
+FUZZY_CUTOFF = float(os.getenv("FUZZY_CUTOFF", 0.85))  # min similarity (0 to 1) of a fuzzy match
+
+separator_pattern = re.compile(r"[\W_]+")
+
+
+# returns name without case, accents, spaces and punctuation ("José_Doe" -> "josedoe")
+def normalize(name):
+    name = unicodedata.normalize('NFKD', name.casefold())
+    return separator_pattern.sub('', ''.join(c for c in name if not unicodedata.combining(c)))
+
+
+# maps entity names returned by the natural language api to the ids of users in the channel
+# usernames and alternate names are loaded once, so resolving a name never touches the database
+class EntityResolver:
+    def __init__(self, channel_id, matching=ENTITY_MATCHING, cutoff=FUZZY_CUTOFF):
+        if matching not in ('exact', 'normalized', 'fuzzy'):
+            raise ValueError(f"Unknown entity matching {matching}")
+
+        self.channel_id = channel_id
+        self.matching = matching
+        self.cutoff = cutoff
+        self.load()
+
+    # loads the usernames and alternate names of the channel (again, if users were added since)
+    def load(self):
+        self.resolved = {}  # entity name -> user id (or None) of names already resolved
+
+        usernames = db.session.query(User.id, User.username).join(user_bridge_association, user_bridge_association.c.user_id == User.id)\
+            .filter(user_bridge_association.c.channel_id == self.channel_id).all()
+        alternates = db.session.query(UserAlternate.user_id, UserAlternate.name).filter(UserAlternate.channel_id == self.channel_id).all()
+
+        # usernames take priority over alternate names
+        self.names = {}  # casefolded name -> user id
+        for user_id, name in alternates + usernames:
+            self.names[name.casefold()] = user_id
+
+        self.normalized_names = {}  # normalized name -> user id
+        if self.matching != 'exact':
+            for user_id, name in alternates + usernames:
+                if normalize(name):
+                    self.normalized_names[normalize(name)] = user_id
+
+    # returns the id of the user called name or None
+    def resolve(self, name):
+        if name in self.resolved:
+            return self.resolved[name]
+
+        user_id = self.names.get(name.casefold())
+
+        if user_id is None and self.matching != 'exact':
+            key = normalize(name)
+            user_id = self.normalized_names.get(key)
+
+            if user_id is None and self.matching == 'fuzzy' and key:
+                matches = get_close_matches(key, self.normalized_names.keys(), n=1, cutoff=self.cutoff)
+                if matches:
+                    user_id = self.normalized_names[matches[0]]
+
+        self.resolved[name] = user_id
+        return user_id
@@ -0,0 +1,62 @@
+import os
+import threading
+
+
+# heavy resources (nlp models, cloud clients) are only loaded the first time they are used
+# so processes that never run analysis (the web tier) start quickly
+
+loaders = {}  # name -> function that loads the resource
+resources = {}  # name -> loaded resource
+lock = threading.Lock()
+
+NLP_MODEL = 'en_core_web_sm'  # spacy model used by the nlp pipeline
+
+# resources loaded when a celery worker process starts
+WARM_RESOURCES = [name for name in os.getenv("WARM_RESOURCES", "nlp,language_client").split(',') if name]
+
+
+# registers function as the loader of the resource called name
+def register(name):
+    def decorator(function):
+        loaders[name] = function
+        return function
+
+    return decorator
+
+
+# returns the resource called name, loading it if this is the first use in this process
+def get(name):
+    resource = resources.get(name)
+    if resource is None:
+        with lock:
+            # another thread may have loaded it while waiting for the lock
+            resource = resources.get(name)
+            if resource is None:
+                resource = resources[name] = loaders[name]()
+
+    return resource
+
+
+# loads all resources in names ahead of their first use
+def warm(names=WARM_RESOURCES):
+    for name in names:
+        get(name)
+
+
+# spacy pipeline with neuralcoref
+@register('nlp')
+def load_nlp():
+    import neuralcoref
+    import spacy
+
+    nlp = spacy.load(NLP_MODEL)
+    neuralcoref.add_to_pipe(nlp, blacklist=False)  # disable blacklist to allow "i", "you", etc. to be resolved
+    return nlp
+
+
+# natural language client (google by default, see harmony.language)
+@register('language_client')
+def load_language_client():
+    from harmony.language import create_client
+
+    return create_client()
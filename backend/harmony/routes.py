@@ -1,11 +1,26 @@
-from flask import request, jsonify
-from harmony import app, db
-from harmony.analyzer import Analyzer
+import json
+import time
+from datetime import date
+from functools import wraps
+from hashlib import sha1
+from flask import Response, request, jsonify, stream_with_context
+from harmony import app, checkpoints, db
+from harmony.analyzer import MAX_CUM_DIST, MAX_DIST, Analyzer
+from harmony.helpers import Helper
 from harmony.models import Channel, Message, UserAlternate
-from harmony.tasks import start_analysis_task, stop_analysis_task
+from harmony.progress import PROGRESS_INTERVAL, channel_progress
+from harmony.tasks import refresh_analysis_task, start_analysis_task, stop_analysis_task
 from jsonschema import validate
 
 
+EPOCH = date(1970, 1, 1)  # day 0 of the sentiment summaries
+MAX_TOP_SENTIMENTS = 100  # max number of messages returned by /sentiments/messages
+MAX_HISTOGRAM_BINS = 200  # max number of bins of the score histogram
+MAX_MESSAGES_PAGE = 5000  # max number of messages returned by /messages
+PROGRESS_HEARTBEAT = 15  # max seconds without sending anything on the progress stream (keeps proxies from closing it)
+PROGRESS_STREAM_GRACE = 10  # seconds a progress stream opened while nothing runs waits for the analysis to start (its task may still be queued) before ending
+
+
 # creates channel if it doesnt exist and returns it
 def channel(channel_id):
     channel = Channel.query.get(channel_id)
@@ -18,6 +33,30 @@ def channel(channel_id):
     return channel
 
 
+# sends the rest of the queries of the request to read-only connections (see harmony.storage), which never wait for the workers writing
+def use_read_only():
+    db.session.commit()  # ends the transaction of the main connection, if the request already used it
+    db.session.info['read_only'] = True
+
+
+# ends the read-only transaction once the request (and its streamed response) is done
+# the session outlives the request when the request runs in an app context that was already pushed
+@app.teardown_request
+def end_read_only(_):
+    if db.session.info.pop('read_only', None):
+        db.session.commit()
+
+
+# makes every query of a route that never writes read-only
+def read_only(route):
+    @wraps(route)
+    def wrapper(*args, **kwargs):
+        use_read_only()
+        return route(*args, **kwargs)
+
+    return wrapper
+
+
 # schema to validate /api/channel/<channel_id>/alts POST and DELETE jsons
 alt_schema = {
     "type": "array",
@@ -31,9 +70,26 @@ alt_schema = {
 }
 
 
+# schema to validate /api/channel/<channel_id>/clustering PUT jsons
+clustering_schema = {
+    "type": "object",
+    "properties": {
+        "max_dist": {"type": ["number", "null"], "minimum": 0, "exclusiveMinimum": True},
+        "max_cum_dist": {"type": ["number", "null"], "minimum": 0, "exclusiveMinimum": True}
+    },
+    "additionalProperties": False
+}
+
+
+# starts the current stage, or every remaining stage at once with ?mode=pipeline (once stage 1 has stored the users of the channel, so their alternate names can be set)
+# with ?mode=shards, stages 3 to 5 are split between every worker
 @app.route('/api/channel/<channel_id>/start', methods=['PUT'])
 def start(channel_id):
-    start_analysis_task.delay(channel_id)
+    mode = request.args.get('mode', default='stages')
+    if mode not in ('stages', 'pipeline', 'shards'):
+        return 'Mode must be stages, pipeline or shards', 422
+
+    start_analysis_task.delay(channel_id, mode)
     return '', 202
 
 
@@ -43,6 +99,13 @@ def stop(channel_id):
     return '', 202
 
 
+# analyzes the messages sent since a finished analysis
+@app.route('/api/channel/<channel_id>/refresh', methods=['PUT'])
+def refresh(channel_id):
+    refresh_analysis_task.delay(channel_id)
+    return '', 202
+
+
 # sets the current stage of the channel to stage
 @app.route('/api/channel/<channel_id>/stage', methods=['GET', 'PUT'])
 def stage(channel_id):
@@ -53,8 +116,9 @@ def stage(channel_id):
         if 0 > stage > 6:
             return 'Stage must be between 0 and 6', 422
         
-        # update stage
+        # update stage (stages run again start over)
         channel(channel_id).stage = stage
+        checkpoints.clear(channel_id)
         db.session.commit()
 
         return ''
@@ -83,6 +147,28 @@ def limit(channel_id):
         return {"limit": channel(channel_id).limit}
 
 
+# sets the max seconds between consecutive messages (max_dist) and between the first and last message (max_cum_dist) of a cluster
+# null resets a setting to its default
+@app.route('/api/channel/<channel_id>/clustering', methods=['GET', 'PUT'])
+def clustering(channel_id):
+    if request.method == 'PUT':
+        settings = request.json
+        validate(instance=settings, schema=clustering_schema)
+
+        # update settings
+        for name, seconds in settings.items():
+            setattr(channel(channel_id), name, seconds)
+        checkpoints.clear(channel_id, 3)  # clusters stored with the old settings cannot be continued
+        db.session.commit()
+
+        return ''
+    else:
+        return {
+            'max_dist': channel(channel_id).max_dist or MAX_DIST.total_seconds(),
+            'max_cum_dist': channel(channel_id).max_cum_dist or MAX_CUM_DIST.total_seconds()
+        }
+
+
 # specifies the user alternates
 @app.route('/api/channel/<channel_id>/alts', methods=['GET', 'DELETE', 'POST'])
 def alts(channel_id):
@@ -119,18 +205,189 @@ def alts(channel_id):
         return alts
 
 
-# returns the progress
+# returns the progress of the current stage (tracked out of band while it runs, stored in the channel once it stops)
 @app.route('/api/channel/<channel_id>/pog', methods=['GET'])
+@read_only
 def progress(channel_id):
-    return {'progress': channel(channel_id).progress}
+    channel = Channel.query.get(channel_id)  # reading progress never adds the channel
+    if channel is None:
+        return {'progress': 0}
+
+    stage = channel_progress(channel_id).get(channel.stage)
+    if channel.running and stage is not None:
+        return {'progress': stage['done']}
+
+    return {'progress': channel.progress}
+
+
+# returns the progress of every stage that was run, with its rate (items per second) and eta (seconds, if the total is known)
+@app.route('/api/channel/<channel_id>/progress', methods=['GET'])
+def stages_progress(channel_id):
+    return {'stages': channel_progress(channel_id)}
+
+
+# streams the progress of every stage as server-sent events, sending a progress event whenever it changes
+# and a done event (then closing the stream) once the analysis it saw running stopped, or if none started within PROGRESS_STREAM_GRACE seconds
+# reads the progress store while a stage runs, so clients do not need to poll the api or the database
+@app.route('/api/channel/<channel_id>/progress/stream', methods=['GET'])
+@read_only
+def progress_stream(channel_id):
+    def generate():
+        last = None
+        sent = opened = time.time()
+        seen_running = False
+
+        while True:
+            stages = channel_progress(channel_id)
+            data = json.dumps({'stages': stages})
+
+            if data != last:
+                yield f"event: progress\ndata: {data}\n\n"
+                last = data
+                sent = time.time()
+            elif time.time() - sent >= PROGRESS_HEARTBEAT:
+                yield ": keep-alive\n\n"
+                sent = time.time()
+
+            # the channel is only read once no stage is tracked as running (it still runs between two stages of a run)
+            if any(stage['running'] for stage in stages.values()):
+                seen_running = True
+            else:
+                running = db.session.query(Channel.running).filter(Channel.id == channel_id).scalar()
+                db.session.commit()  # the next check reads what the workers committed since
+                seen_running = seen_running or bool(running)
+                if not running and (seen_running or time.time() - opened >= PROGRESS_STREAM_GRACE):
+                    yield "event: done\ndata: {}\n\n"
+                    return
+
+            time.sleep(PROGRESS_INTERVAL)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+# returns the average sentiment of every user referring to every other user
+# from and to (YYYY-MM-DD, inclusive) limit the sentiments to the messages sent on those days
+@app.route('/api/channel/<channel_id>/sentiments/users', methods=['GET'])
+@read_only
+def user_sentiments(channel_id):
+    try:
+        days = [(date.fromisoformat(request.args[name]) - EPOCH).days if name in request.args else None for name in ('from', 'to')]
+    except ValueError:
+        return 'Dates must be formatted as YYYY-MM-DD', 400
+
+    return {'pairs': Helper(channel_id).sentiment_matrix(*days)}
+
+
+# returns the k most positive (or most negative with ?order=negative) messages in the channel, or sent by ?user_id
+@app.route('/api/channel/<channel_id>/sentiments/messages', methods=['GET'])
+@read_only
+def message_sentiments(channel_id):
+    k = request.args.get('k', default=10, type=int)
+    order = request.args.get('order', default='positive')
+
+    if not 0 < k <= MAX_TOP_SENTIMENTS:
+        return f'k must be between 1 and {MAX_TOP_SENTIMENTS}', 422
+    if order not in ('positive', 'negative'):
+        return 'Order must be positive or negative', 422
+
+    sentiments = Helper(channel_id).top_sentiments(k, ascending=order == 'negative', user_id=request.args.get('user_id'))
+    return {'messages': [sentiment.to_json() for sentiment in sentiments]}
+
+
+# returns the most negative and most positive message of each user in the channel
+@app.route('/api/channel/<channel_id>/sentiments/messages/extremes', methods=['GET'])
+@read_only
+def message_sentiment_extremes(channel_id):
+    extremes = Helper(channel_id).user_extremes()
+    return {'users': [{'user_id': user_id, 'min': min_sentiment.to_json(), 'max': max_sentiment.to_json()} for user_id, (min_sentiment, max_sentiment) in extremes.items()]}
+
+
+# returns the score percentiles (?percentiles=comma separated, 0 to 100) and histogram (?bins equal ranges from -1 to 1) of the message sentiments
+@app.route('/api/channel/<channel_id>/sentiments/distribution', methods=['GET'])
+@read_only
+def sentiment_distribution(channel_id):
+    bins = request.args.get('bins', default=20, type=int)
+    try:
+        percentiles = [float(percentile) for percentile in request.args.get('percentiles', default='0,25,50,75,100').split(',')]
+    except ValueError:
+        return 'Percentiles must be numbers', 400
+
+    if not 0 < bins <= MAX_HISTOGRAM_BINS:
+        return f'Bins must be between 1 and {MAX_HISTOGRAM_BINS}', 422
+    if any(not 0 <= percentile <= 100 for percentile in percentiles):
+        return 'Percentiles must be between 0 and 100', 422
+
+    helper = Helper(channel_id)
+    count, scores = helper.score_percentiles(percentiles)
+    return {
+        'count': count,
+        'percentiles': [{'percentile': percentile, 'score': score} for percentile, score in scores.items()],
+        'histogram': helper.score_histogram(bins)
+    }
+
 
+# returns the cursor of the page after message (its time and id)
+def message_cursor(message):
+    return f"{int(message.time)}_{message.id}"
 
+
+# returns the analyzed messages of the channel from newest to oldest, ?limit at a time
+# ?cursor (the next cursor of the previous page) continues after the previous page, so every page costs the same
+# pages are streamed and tagged with the state of the channel, so polling an unchanged page returns 304 without reading the messages
 @app.route('/api/channel/<channel_id>/messages', methods=['GET'])
 def messages(channel_id):
-    offset = request.args.get('offset', default=0, type=int)
     limit = request.args.get('limit', default=100, type=int)
+    cursor = request.args.get('cursor')
+
+    if not 0 < limit <= MAX_MESSAGES_PAGE:
+        return f'Limit must be between 1 and {MAX_MESSAGES_PAGE}', 422
 
-    return f"{offset} {limit} {channel_id}"
+    try:
+        before = None
+        if cursor is not None:
+            time, message_id = cursor.split('_')
+            before = (int(time), message_id)
+    except ValueError:
+        return 'Invalid cursor', 400
+
+    if Channel.query.get(channel_id) is None:  # reading messages never adds the channel
+        return 'Channel not found', 404
+
+    use_read_only()
+    helper = Helper(channel_id)
+    etag = sha1(f"{helper.results_version()} {cursor} {limit}".encode()).hexdigest()
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        # the page is written as it is read, reading one extra message to know if there is a next page
+        def generate():
+            yield '{"messages": ['
+
+            last = None
+            for i, message in enumerate(helper.message_page(before, limit + 1)):
+                if i == limit:
+                    yield f'], "next": {json.dumps(message_cursor(last))}}}'
+                    return
+
+                yield (', ' if i else '') + json.dumps({
+                    'id': message.id,
+                    'user_id': message.user_id,
+                    'timestamp': message.timestamp,
+                    'content': message.content,
+                    'coref_content': message.coref_content,
+                    'score': message.score,
+                    'magnitude': message.magnitude
+                })
+                last = message
+
+            yield '], "next": null}'
+
+        response = Response(stream_with_context(generate()), mimetype='application/json')
+
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'  # revalidate every poll
+    return response
 
 # # if the app is currently running
 # running = False
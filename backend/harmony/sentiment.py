@@ -0,0 +1,151 @@
+import os
+import re
+import numpy as np
+from harmony.language import LanguageClient
+
+
+# file with a lexicon in the vader format (word<TAB>valence<TAB>...), replaces the built in lexicon
+SENTIMENT_LEXICON = os.getenv("SENTIMENT_LEXICON")
+
+ALPHA = 15  # normalizes the sum of valences into (-1, 1) the same way vader does
+NEGATION_SCALAR = -0.74  # valence of words following a negation is flipped and dampened
+NEGATION_SCOPE = 3  # number of words after a negation that it applies to
+MAGNITUDE_SCALE = 4  # valences are in [-4, 4], magnitudes are sums of absolute valences in units of this
+MENTION_WINDOW = 3  # number of words on each side of a mention that make up its sentiment
+
+# built in lexicon (valences taken from vader, in [-4, 4])
+LEXICON = dict((word, float(valence)) for word, valence in (entry.split(':') for entry in '''
+    good:1.9 great:3.1 nice:1.8 love:3.2 loved:2.9 loves:2.7 like:1.5 likes:1.5 liked:1.8 best:3.2 better:1.9 awesome:3.1 amazing:2.8
+    cool:1.3 fun:2.3 funny:1.9 happy:2.7 glad:2.0 thanks:1.9 thank:1.5 kind:2.4 smart:1.7 friend:2.2 friends:2.1 beautiful:2.9
+    perfect:2.7 excellent:2.7 fantastic:2.6 wonderful:2.7 sweet:2.0 cute:2.0 yay:2.4 lol:1.8 lmao:2.0 haha:2.0 win:2.8 won:2.7
+    agree:1.5 right:0.9 wow:2.8 pog:2.0 gg:1.5 congrats:2.4 proud:2.1 respect:2.1 enjoy:2.2 enjoyed:2.3 helpful:1.8 welcome:2.0
+    bad:-2.5 worse:-2.1 worst:-3.1 hate:-2.7 hated:-3.2 hates:-1.9 awful:-2.0 terrible:-2.1 horrible:-2.5 stupid:-2.4 dumb:-2.3
+    idiot:-2.3 annoying:-1.7 angry:-2.3 mad:-2.2 sad:-2.1 sorry:-0.3 sucks:-1.5 suck:-1.9 boring:-1.3 ugly:-2.3 wrong:-2.1
+    lose:-1.3 lost:-1.3 fail:-2.5 failed:-2.3 kill:-3.7 dead:-3.3 die:-2.9 cry:-2.1 crying:-2.1 toxic:-2.3 trash:-1.8 cringe:-1.6
+    rude:-2.0 mean:-1.0 weird:-0.7 scared:-1.9 afraid:-2.0 tired:-1.9 sick:-2.3 hurt:-2.4 pain:-2.3 problem:-1.7 damn:-1.7
+    fuck:-2.5 shit:-2.6 wtf:-2.8 ugh:-1.8 bruh:-0.5 cringy:-1.6 lame:-1.8 useless:-1.8 hopeless:-2.0 disgusting:-2.4
+'''.split()))
+
+NEGATIONS = {"not", "no", "never", "dont", "don't", "cant", "can't", "wont", "won't", "isnt", "isn't", "aint", "ain't", "nothing", "nobody", "neither", "nor", "without"}
+
+sentence_pattern = re.compile(r"[^.!?]+")  # sentences are separated by periods (stage 5 joins messages with ". ")
+word_pattern = re.compile(r"\w[\w']*")
+name_pattern = re.compile(r"(?<![\w'])[A-Z][\w']*(?: [A-Z][\w']*)+")  # two or more capitalized words
+
+
+# returns the lexicon in path (vader format) or the built in lexicon
+def load_lexicon(path=SENTIMENT_LEXICON):
+    if path is None:
+        return LEXICON
+
+    lexicon = {}
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) >= 2:
+                lexicon[fields[0].lower()] = float(fields[1])
+
+    return lexicon
+
+
+# scores sentences and entity mentions in this process using a sentiment lexicon
+# a whole batch of documents is tokenized into flat arrays and scored together with numpy
+class LocalLanguageClient(LanguageClient):
+    def __init__(self, lexicon=None, window=MENTION_WINDOW):
+        self.lexicon = lexicon or load_lexicon()
+        self.window = window
+
+    def analyze_sentiment(self, content):
+        return self.analyze_documents([content])[0][0]
+
+    def analyze_entity_sentiment(self, content):
+        return self.analyze_documents([content])[0][1]
+
+    def analyze_documents(self, contents):
+        words = []  # lowercase word of every token in the batch
+        token_sentences = []  # sentence of every token
+        sentences = []  # (document, byte offset, first token, end token) of every sentence
+        mentions = []  # (document, name, byte offset, first token, end token, sentence) of every entity mention
+
+        # tokenize (the only part that is not vectorized)
+        for document, content in enumerate(contents):
+            # offsets are in utf-8 bytes
+            is_ascii = content.isascii()
+            def byte_offset(i):
+                return i if is_ascii else len(content[:i].encode('utf-8'))
+
+            for sentence_match in sentence_pattern.finditer(content):
+                tokens = list(word_pattern.finditer(sentence_match.group()))
+                if not tokens:
+                    continue
+
+                sentence = len(sentences)
+                first = len(words)
+                start = sentence_match.start()
+                token_indices = {}  # offset in the sentence -> index of the token starting there
+
+                for token in tokens:
+                    token_indices[token.start()] = len(words)
+                    words.append(token.group().lower())
+                    token_sentences.append(sentence)
+
+                    # every word is a candidate entity
+                    mentions.append((document, token.group(), byte_offset(start + token.start()), len(words) - 1, len(words), sentence))
+
+                # so is every run of capitalized words (multi word names)
+                for name in name_pattern.finditer(sentence_match.group()):
+                    end = token_indices[name.start() + name.group().rindex(' ') + 1] + 1
+                    mentions.append((document, name.group(), byte_offset(start + name.start()), token_indices[name.start()], end, sentence))
+
+                sentences.append((document, byte_offset(start + tokens[0].start()), first, len(words)))
+
+        responses = [({'sentences': []}, {'entities': []}) for _ in contents]
+        if not words:
+            return responses
+
+        # valence of every token, flipped when one of the previous words in the sentence is a negation
+        valences = np.fromiter((self.lexicon.get(word, 0.0) for word in words), dtype=float, count=len(words))
+        negations = np.fromiter((word in NEGATIONS for word in words), dtype=bool, count=len(words))
+        token_sentences = np.array(token_sentences)
+
+        negated = np.zeros(len(words), dtype=bool)
+        for distance in range(1, NEGATION_SCOPE + 1):
+            negated[distance:] |= negations[:-distance] & (token_sentences[distance:] == token_sentences[:-distance])
+        valences = np.where(negated, valences * NEGATION_SCALAR, valences)
+
+        # cumulative sums let any span of tokens be scored in constant time
+        cumulative = np.concatenate(([0.0], np.cumsum(valences)))
+        cumulative_abs = np.concatenate(([0.0], np.cumsum(np.abs(valences))))
+
+        # score every sentence
+        sentence_firsts = np.array([sentence[2] for sentence in sentences])
+        sentence_ends = np.array([sentence[3] for sentence in sentences])
+        sentence_scores, sentence_magnitudes = self.score(cumulative, cumulative_abs, sentence_firsts, sentence_ends)
+
+        for (document, offset, _, _), score, magnitude in zip(sentences, sentence_scores, sentence_magnitudes):
+            responses[document][0]['sentences'].append({'begin_offset': offset, 'score': float(score), 'magnitude': float(magnitude)})
+
+        # score every mention using the words around it (within its sentence)
+        if mentions:
+            mention_sentences = np.array([mention[5] for mention in mentions])
+            mention_firsts = np.maximum(np.array([mention[3] for mention in mentions]) - self.window, sentence_firsts[mention_sentences])
+            mention_ends = np.minimum(np.array([mention[4] for mention in mentions]) + self.window, sentence_ends[mention_sentences])
+            mention_scores, mention_magnitudes = self.score(cumulative, cumulative_abs, mention_firsts, mention_ends)
+
+            entities = [{} for _ in contents]  # lowercase name -> entity of each document
+            for (document, name, offset, _, _, _), score, magnitude in zip(mentions, mention_scores, mention_magnitudes):
+                entity = entities[document].setdefault(name.lower(), {'name': name, 'mentions': []})
+                entity['mentions'].append({'begin_offset': offset, 'score': float(score), 'magnitude': float(magnitude)})
+
+            for document, document_entities in enumerate(entities):
+                responses[document][1]['entities'] = list(document_entities.values())
+
+        return responses
+
+    # returns (scores, magnitudes) of the token spans [firsts, ends)
+    @staticmethod
+    def score(cumulative, cumulative_abs, firsts, ends):
+        sums = cumulative[ends] - cumulative[firsts]
+        scores = sums / np.sqrt(sums * sums + ALPHA)
+        magnitudes = (cumulative_abs[ends] - cumulative_abs[firsts]) / MAGNITUDE_SCALE
+        return np.round(scores, 3), np.round(magnitudes, 3)
@@ -0,0 +1,52 @@
+import os
+import numpy as np
+from harmony.documents import document_starts
+
+
+STAGE_SHARDS = int(os.getenv("STAGE_SHARDS", 8))  # max number of shards a stage is split into when run in shards mode
+MIN_SHARD_SIZE = int(os.getenv("MIN_SHARD_SIZE", 5000))  # min number of items in a shard (smaller stages use fewer shards)
+
+
+# returns the number of shards to split n items into
+def shard_count(n, shards=STAGE_SHARDS, min_size=MIN_SHARD_SIZE):
+    return max(1, min(shards, n // max(1, min_size)))
+
+
+# returns the indices at which to split n items into about count shards of the same size
+# starts are the sorted indices of the items a shard may start at
+def split_points(starts, n, count):
+    starts = np.asarray(starts, dtype=np.int64)
+    starts = starts[starts > 0]
+    if count <= 1 or len(starts) == 0:
+        return []
+
+    # the first allowed start at or after each ideal split
+    targets = np.arange(1, count) * n / count
+    positions = np.minimum(np.searchsorted(starts, targets), len(starts) - 1)
+    return sorted(set(starts[positions].tolist()))
+
+
+# returns the (since, until) bounds of each shard of sorted values split at the indices cuts
+# since is inclusive and until exclusive, with None for an open end, so the shards cover every value
+def bounds(values, cuts):
+    edges = [None] + [values[cut] for cut in cuts] + [None]
+    return list(zip(edges, edges[1:]))
+
+
+# splits messages (their times in milliseconds, oldest first) into shards that can be clustered on their own
+# clusters never span a gap longer than max_dist, so shards are only split at such gaps
+def time_shards(times, max_dist, count):
+    times = np.asarray(times, dtype=np.int64)
+    gaps = np.flatnonzero(np.diff(times) > max_dist) + 1
+    return bounds(times.tolist(), split_points(gaps, len(times), count))
+
+
+# splits sorted ids into count shards with the same number of ids
+def id_shards(ids, count):
+    return bounds(ids, split_points(np.arange(len(ids)), len(ids), count))
+
+
+# splits messages (their sorted ids and the lengths of their contents) into shards of whole documents
+# each shard packs the same documents as a single run over every message would
+def document_shards(ids, lengths, count):
+    return bounds(ids, split_points(document_starts(lengths), len(ids), count))
@@ -0,0 +1,86 @@
+import os
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+
+# how sqlite is set up for the workers writing the analysis and the api reading it at the same time
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "production")  # production (wal, tuned pragmas, pooled connections and read-only connections for the api) or default (sqlite's own settings)
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", 30000))  # ms a connection waits for the write lock of another one before failing
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", 64 * 1024))  # KiB of pages cached by each connection
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024))  # bytes of the database read through a memory map instead of read calls
+SQLITE_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", 5))  # connections kept open by each engine of a process (so they keep their page cache)
+
+# pragmas run on every new connection of each profile
+PRAGMAS = {
+    'production': [
+        'journal_mode=WAL',  # readers never wait for the writer, and the writer never waits for readers
+        'synchronous=NORMAL',  # the wal is only synced at checkpoints (a crash may lose the last commits, but never corrupts the database)
+        f'busy_timeout={SQLITE_BUSY_TIMEOUT}',
+        f'cache_size=-{SQLITE_CACHE_SIZE}',
+        f'mmap_size={SQLITE_MMAP_SIZE}',
+        'temp_store=MEMORY',
+        'journal_size_limit=67108864',  # the wal is truncated back to 64MB after checkpoints
+        'foreign_keys=ON',
+    ],
+    'default': ['foreign_keys=ON'],
+}
+# read-only connections cannot change the journal, and refuse to write even if asked to
+READ_ONLY_PRAGMAS = [pragma for pragma in PRAGMAS['production'] if not pragma.startswith('journal_')] + ['query_only=ON']
+
+
+# runs pragmas on every new connection of engine
+def set_pragmas(engine, pragmas):
+    def connect(dbapi_connection, _):
+        for pragma in pragmas:
+            dbapi_connection.execute(f'PRAGMA {pragma}')
+
+    event.listen(engine, 'connect', connect)
+
+
+# takes the write lock of the database for the rest of the transaction of connection, so no other connection writes until it ends
+# a transaction that already wrote holds the lock (and sqlite cannot begin another one inside it)
+def take_write_lock(connection):
+    if not connection.connection.in_transaction:
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+
+# returns the engine options of the database at uri in the profile
+def engine_options(uri, profile=SQLITE_PROFILE):
+    if profile != 'production' or make_url(uri).database in (None, '', ':memory:'):
+        return {}
+
+    # connections are pooled instead of opened for every session, and are used by one thread at a time but not always the one that opened them
+    # overflow connections are closed when returned, so a burst of threads never waits for the pool
+    return {'poolclass': QueuePool, 'pool_size': SQLITE_POOL_SIZE, 'max_overflow': -1, 'connect_args': {'check_same_thread': False}}
+
+
+# returns an engine opening the database of engine read-only, set up like it in the production profile
+def read_only_engine(engine):
+    url = engine.url.set(database=f'file:{engine.url.database}', query={'mode': 'ro', 'uri': 'true'})
+    read_engine = create_engine(url, **engine_options(str(engine.url), 'production'))
+    set_pragmas(read_engine, READ_ONLY_PRAGMAS)
+    return read_engine
+
+
+# a session that sends the queries of read-only requests (see harmony.routes.read_only) to the read-only engine
+# the wal lets those connections read a consistent snapshot while the workers write
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.database = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self.info.get('read_only') and self.database.read_engine is not None:
+            return self.database.read_engine
+
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+# flask-sqlalchemy with a second engine for read-only connections
+class RoutingSQLAlchemy(SQLAlchemy):
+    read_engine = None  # engine of the read-only connections (None sends every query to the main engine)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
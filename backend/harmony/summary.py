@@ -0,0 +1,94 @@
+import os
+from sqlalchemy import text
+from harmony import db
+from harmony.clustering import message_time
+from harmony.models import UserSentimentSummary
+
+
+SUMMARY_DAYS = os.getenv("SUMMARY_DAYS", "1") == "1"  # whether totals are also kept for each day (needed for time slices of the matrix)
+ALL_DAYS = -1  # day of the totals of all messages
+MILLISECONDS_PER_DAY = 86400000
+
+TOTALS = ['count', 'score_sum', 'score_squares', 'magnitude_sum', 'magnitude_squares']
+
+# adds totals to the summary of a pair, creating it if needed
+upsert = text(f'''
+    INSERT INTO user_sentiment_summary (channel_id, object_user_id, subject_user_id, day, {', '.join(TOTALS)})
+    VALUES (:channel_id, :object_user_id, :subject_user_id, :day, {', '.join(':' + total for total in TOTALS)})
+    ON CONFLICT (channel_id, object_user_id, subject_user_id, day) DO UPDATE SET {', '.join(f'{total} = {total} + excluded.{total}' for total in TOTALS)}
+''')
+
+# subtracts the totals of the user sentiments of some messages (selected by the caller) from the summaries
+subtract = f'''
+    INSERT INTO user_sentiment_summary (channel_id, object_user_id, subject_user_id, day, {', '.join(TOTALS)})
+    SELECT message.channel_id, object_user_id, subject_user_id, {{day}},
+        -count(*), -sum(score), -sum(score * score), -sum(magnitude), -sum(magnitude * magnitude)
+    FROM user_sentiment JOIN message ON message.id = user_sentiment.message_id
+    WHERE user_sentiment.message_id IN ({{message_ids}})
+    GROUP BY 1, 2, 3, 4
+    ON CONFLICT (channel_id, object_user_id, subject_user_id, day) DO UPDATE SET {', '.join(f'{total} = {total} + excluded.{total}' for total in TOTALS)}
+'''
+message_day = f"CAST(round((julianday(message.timestamp) - 2440587.5) * {MILLISECONDS_PER_DAY}) AS INTEGER) / {MILLISECONDS_PER_DAY}"  # same as day()
+
+
+# returns the day (days since 1970) of an iso timestamp
+def day(timestamp):
+    return message_time(timestamp) // MILLISECONDS_PER_DAY
+
+
+# adds user sentiments given as (object user id, subject user id, message timestamp, score, magnitude) to the summaries of the channel
+# is part of the caller's transaction, so the summaries are stored with the sentiments
+def add_sentiments(channel_id, sentiments):
+    totals = {}  # (object user id, subject user id, day) -> totals
+    for object_user_id, subject_user_id, timestamp, score, magnitude in sentiments:
+        days = [ALL_DAYS, day(timestamp)] if SUMMARY_DAYS else [ALL_DAYS]
+
+        for d in days:
+            pair = totals.setdefault((object_user_id, subject_user_id, d), [0, 0.0, 0.0, 0.0, 0.0])
+            pair[0] += 1
+            pair[1] += score
+            pair[2] += score * score
+            pair[3] += magnitude
+            pair[4] += magnitude * magnitude
+
+    if totals:
+        db.session.execute(upsert, [
+            dict(zip(TOTALS, pair), channel_id=channel_id, object_user_id=object_user_id, subject_user_id=subject_user_id, day=d)
+            for (object_user_id, subject_user_id, d), pair in totals.items()
+        ])
+
+
+# removes the user sentiments of messages from the summaries (must be called before the sentiments are deleted)
+def remove_messages(channel_id, message_ids, chunk_size=500):
+    for i in range(0, len(message_ids), chunk_size):
+        chunk = message_ids[i:i + chunk_size]
+        params = {f'id{j}': message_id for j, message_id in enumerate(chunk)}
+        placeholders = ', '.join(':' + name for name in params)
+
+        db.session.execute(text(subtract.format(day=ALL_DAYS, message_ids=placeholders)), params)
+        if SUMMARY_DAYS:
+            db.session.execute(text(subtract.format(day=message_day, message_ids=placeholders)), params)
+
+    # drop pairs without sentiments
+    UserSentimentSummary.query.filter(UserSentimentSummary.channel_id == channel_id).filter(UserSentimentSummary.count <= 0).delete(synchronize_session=False)
+
+
+# removes every summary of the channel
+def clear(channel_id):
+    UserSentimentSummary.query.filter(UserSentimentSummary.channel_id == channel_id).delete(synchronize_session=False)
+
+
+# returns the totals of every pair in the channel as [(object user id, subject user id, count, score sum, score squares, magnitude sum, magnitude squares)]
+# covers all messages, or the messages sent from first_day to last_day (inclusive) if either is given
+def pair_totals(channel_id, first_day=None, last_day=None):
+    query = db.session.query(UserSentimentSummary.object_user_id, UserSentimentSummary.subject_user_id)\
+        .filter(UserSentimentSummary.channel_id == channel_id)
+
+    if first_day is None and last_day is None:
+        return query.filter(UserSentimentSummary.day == ALL_DAYS)\
+            .add_columns(*[getattr(UserSentimentSummary, total) for total in TOTALS]).all()
+
+    # sum the totals of each day in the range
+    return query.filter(UserSentimentSummary.day.between(first_day if first_day is not None else 0, last_day if last_day is not None else 2 ** 31))\
+        .group_by(UserSentimentSummary.object_user_id, UserSentimentSummary.subject_user_id)\
+        .add_columns(*[db.func.sum(getattr(UserSentimentSummary, total)) for total in TOTALS]).all()
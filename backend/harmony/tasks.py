@@ -1,15 +1,119 @@
-from harmony import celery
+from celery.signals import task_postrun, worker_process_init
+from harmony import celery, db, resources
 from harmony.analyzer import Analyzer
+from harmony.models import Channel
+
+
+# queues the tasks are routed to, each consumed by a worker pool suited to its work (see worker.py)
+DEFAULT_QUEUE = 'celery'  # short tasks (starting and stopping analysis, joining shards)
+IO_QUEUE = 'io'  # waiting on discord and the natural language api (many threads per worker)
+CPU_QUEUE = 'cpu'  # clustering (one process per core)
+COREF_QUEUE = 'coref'  # anything that needs the nlp pipeline (one process per core, with the pipeline loaded at startup)
+
+
+# load the resources of the worker's pool once per worker process instead of on the first task
+@worker_process_init.connect
+def warm_resources(**kwargs):
+    resources.warm()
+
+
+# thread pools run many tasks in a thread, so each task gets a fresh session
+@task_postrun.connect
+def remove_session(**kwargs):
+    db.session.remove()
+
+
+# starts the current stage of the channel by sending it to the queue of that stage
+# stages without work to do (0, 2 and finished analyses) are run right away
+@celery.task
+def start_analysis_task(channel_id, mode='stages'):
+    channel = Channel.query.get(channel_id)
+    stage = channel.stage if channel is not None else 0
+
+    # a channel without users gathers its messages alone first (see Analyzer.start_analysis)
+    if mode == 'pipeline' and stage == 1 and channel.users.count() > 0:
+        run_pipeline_task.delay(channel_id)
+    elif stage in STAGE_TASKS:
+        STAGE_TASKS[stage].delay(channel_id, mode)
+    else:
+        Analyzer(channel_id).start_analysis(mode)
+
+
+@celery.task
+def stop_analysis_task(channel_id, release=False):
+    Analyzer(channel_id).stop_analysis(release)
+
+
+# refreshes are small, but resolve the coreferences of the new messages
+@celery.task
+def refresh_analysis_task(channel_id):
+    Analyzer(channel_id).refresh_analysis()
+
+
+# stages 1, 3, 4 and 5 (see Analyzer.start_analysis), each a task of its own so it can be routed to its queue
+@celery.task
+def gather_messages_task(channel_id, mode='stages'):
+    Analyzer(channel_id).start_analysis(mode)
+
+
+@celery.task
+def cluster_messages_task(channel_id, mode='stages'):
+    Analyzer(channel_id).start_analysis(mode)
+
+
+@celery.task
+def resolve_coreferences_task(channel_id, mode='stages'):
+    Analyzer(channel_id).start_analysis(mode)
+
+
+@celery.task
+def analyze_sentiments_task(channel_id, mode='stages'):
+    Analyzer(channel_id).start_analysis(mode)
+
+
+# every stage at once (see Analyzer.run_pipeline), which needs the nlp pipeline
+@celery.task
+def run_pipeline_task(channel_id):
+    Analyzer(channel_id).start_analysis('pipeline')
+
+
+# shards of stages 3, 4 and 5 started in shards mode (see Analyzer.start_shards)
+@celery.task
+def cluster_shard_task(channel_id, shard, bounds):
+    return Analyzer(channel_id).run_shard(3, shard, bounds)
+
+
+@celery.task
+def coref_shard_task(channel_id, shard, bounds):
+    return Analyzer(channel_id).run_shard(4, shard, bounds)
 
 
 @celery.task
-def start_analysis_task(channel_id):
-    Analyzer(channel_id).start_analysis()
+def sentiment_shard_task(channel_id, shard, bounds):
+    return Analyzer(channel_id).run_shard(5, shard, bounds)
 
 
+# finishes a stage once all of its shards have run, with the result of each shard
 @celery.task
-def stop_analysis_task(channel_id):
-    Analyzer(channel_id).stop_analysis()
+def finish_shards_task(results, channel_id, stage):
+    Analyzer(channel_id).finish_shards(stage, results)
+
+
+STAGE_TASKS = {1: gather_messages_task, 3: cluster_messages_task, 4: resolve_coreferences_task, 5: analyze_sentiments_task}
+SHARD_TASKS = {3: cluster_shard_task, 4: coref_shard_task, 5: sentiment_shard_task}
+
+celery.conf.task_routes = {
+    gather_messages_task.name: {'queue': IO_QUEUE},
+    analyze_sentiments_task.name: {'queue': IO_QUEUE},
+    sentiment_shard_task.name: {'queue': IO_QUEUE},
+    cluster_messages_task.name: {'queue': CPU_QUEUE},
+    cluster_shard_task.name: {'queue': CPU_QUEUE},
+    resolve_coreferences_task.name: {'queue': COREF_QUEUE},
+    coref_shard_task.name: {'queue': COREF_QUEUE},
+    run_pipeline_task.name: {'queue': COREF_QUEUE},
+    refresh_analysis_task.name: {'queue': COREF_QUEUE},
+}
+celery.conf.task_default_queue = DEFAULT_QUEUE
 
 
 '''
@@ -19,7 +123,7 @@ starting analysis will start the stage the channel is currently at
 once analysis is done for the current stage, analysis will pause
 analysis for the next stage must be started again by calling start analysis again
 analysis can be stopped at any time with stop_analysis
-if analysis is stopped, the progress for the current stage will be reset and that stage will have to be restarted
+if analysis is stopped, the current stage keeps a checkpoint of its stored output and continues from it when started again
 progress can be gotten at any time using the progress route which will show the current stage and progress for the stage and whether its been completed or not
 the frontned will have auto option that automatically continues after it sees stage has been finished???
 
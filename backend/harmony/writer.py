@@ -0,0 +1,76 @@
+import os
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from harmony import checkpoints, db
+from harmony.models import Channel, Message, User, user_bridge_association
+
+
+BATCH_SIZE = int(os.getenv("WRITE_BATCH_SIZE", 1000))  # number of messages written per transaction
+
+
+# buffers the rows created while gathering messages and writes them in batches (one transaction per batch)
+class MessageWriter:
+    def __init__(self, channel_id, batch_size=BATCH_SIZE):
+        self.channel_id = channel_id
+        self.batch_size = batch_size
+        self.written = 0  # number of messages written to the database
+        self.last_message_id = None  # id of the newest message fetched, stored as the channel's high-water mark with the next batch
+        self.checkpoint = None  # checkpoint of stage 1, stored with the next batch
+
+        # rows waiting to be written
+        self.users = {}  # id -> user row
+        self.members = []
+        self.messages = []
+
+    # number of messages waiting to be written
+    def __len__(self):
+        return len(self.messages)
+
+    # adds a new user
+    def add_user(self, user_id, username):
+        self.users[user_id] = {'id': user_id, 'username': username}
+
+    # adds a user to the channel
+    def add_member(self, user_id):
+        self.members.append({'user_id': user_id, 'channel_id': self.channel_id})
+
+    # adds a prepared message (written once its page is done, see flush_full)
+    def add_message(self, message):
+        self.messages.append({'id': message['id'], 'channel_id': self.channel_id, 'user_id': message['author']['id'], 'content': message['content'], 'timestamp': message['timestamp']})
+
+    # writes the batch once it is full
+    # called between pages, so a batch always ends with a whole page and is stored with the checkpoint and high-water mark of that page
+    def flush_full(self):
+        if len(self.messages) >= self.batch_size:
+            self.flush()
+
+    # writes all buffered rows in a single transaction
+    def flush(self):
+        if not (self.users or self.members or self.messages or self.last_message_id or self.checkpoint):
+            return
+
+        # users must be written before the rows referencing them
+        # channels sharing users are gathered at the same time, so another writer may have stored the same users (and they are kept as stored)
+        if self.users:
+            db.session.execute(sqlite_insert(User).on_conflict_do_nothing(), list(self.users.values()))
+        if self.members:
+            db.session.execute(sqlite_insert(user_bridge_association).on_conflict_do_nothing(), self.members)
+        if self.messages:
+            db.session.bulk_insert_mappings(Message, self.messages)
+
+        self.written += len(self.messages)
+        if self.last_message_id is not None:
+            # written in the same transaction as the messages, so fetching can resume right after them
+            Channel.query.get(self.channel_id).last_message_id = self.last_message_id
+        if self.checkpoint is not None:
+            checkpoints.save(self.channel_id, 1, self.checkpoint)
+        db.session.commit()
+
+        self.discard()
+
+    # drops all buffered rows without writing them
+    def discard(self):
+        self.users = {}
+        self.members = []
+        self.messages = []
+        self.last_message_id = None
+        self.checkpoint = None
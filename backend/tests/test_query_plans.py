@@ -0,0 +1,11 @@
+# the hot queries of the analyzer, helpers and routes (and the lookups sqlite does to cascade deletes) must be answered with indexes
+# runs the code paths of benchmarks.query_plans on a scratch database (set up when it is imported, before the app)
+from benchmarks.query_plans import check_plans
+
+
+def test_no_full_table_scans():
+    results = check_plans()
+    scans = {' '.join(statement.split()): plan for statement, plan, full_scan in results if full_scan}
+
+    assert results
+    assert not scans, f"queries scanning a whole table: {scans}"
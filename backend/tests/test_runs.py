@@ -0,0 +1,93 @@
+# a run of the analysis claims its channel (running) until it ends, and a stopped or failed run must release it,
+# so the channel can be started again from the stage it was at
+import os
+import tempfile
+
+# must be set before the app is imported
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test_runs.db')}")
+os.environ.setdefault("LANGUAGE_CLIENT", "fake")
+os.environ.setdefault("PROGRESS_STORE", "memory")
+
+import pytest
+from harmony import app, db, progress
+from harmony.analyzer import Analyzer
+from harmony.models import Channel
+
+
+CHANNEL_ID = '100'
+
+
+@pytest.fixture
+def channel():
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        db.session.add(Channel(id=CHANNEL_ID, running=False, stage=3, progress=0, limit=0))
+        db.session.commit()
+        yield
+        progress.get_store().request_stop(CHANNEL_ID, False)
+        db.session.remove()
+
+
+# fails the stage run by the analyzer
+def fail(*args, **kwargs):
+    raise RuntimeError("stage failed")
+
+
+def state():
+    db.session.expire_all()
+    channel = Channel.query.get(CHANNEL_ID)
+    return channel.stage, channel.running, progress.get_store().stop_requested(CHANNEL_ID)
+
+
+def test_failed_run_releases_channel(channel, monkeypatch):
+    with monkeypatch.context() as patch:
+        patch.setattr(Analyzer, 'create_clusters', fail)
+        with pytest.raises(RuntimeError):
+            Analyzer(CHANNEL_ID).start_analysis()
+
+    # the stage is not advanced, and runs again once started
+    assert state() == (3, False, False)
+    Analyzer(CHANNEL_ID).start_analysis()
+    assert state() == (4, False, False)
+
+
+def test_failed_refresh_releases_channel(channel, monkeypatch):
+    channel = Channel.query.get(CHANNEL_ID)
+    channel.stage = 6
+    channel.last_message_id = '1'
+    db.session.commit()
+
+    monkeypatch.setattr(Analyzer, 'get_new_messages', fail)
+    with pytest.raises(RuntimeError):
+        Analyzer(CHANNEL_ID).refresh_analysis()
+
+    assert state() == (6, False, False)
+
+
+def test_failed_shards_release_channel(channel):
+    # the shards of a stage run while the channel is claimed by the run that started them
+    channel = Channel.query.get(CHANNEL_ID)
+    channel.running = True
+    db.session.commit()
+
+    with pytest.raises(KeyError):
+        Analyzer(CHANNEL_ID).finish_shards(3, [{'done': 0}])
+
+    assert state() == (3, False, False)
+
+
+def test_stopped_run_keeps_channel_until_released(channel):
+    channel = Channel.query.get(CHANNEL_ID)
+    channel.running = True
+    db.session.commit()
+
+    # another run cannot start while the stopped one still writes
+    Analyzer(CHANNEL_ID).stop_analysis()
+    assert state() == (3, True, True)
+    Analyzer(CHANNEL_ID).start_analysis()
+    assert state() == (3, True, True)
+
+    # the stopped run withdraws the request when it releases the channel
+    Analyzer(CHANNEL_ID).release()
+    assert state() == (3, False, False)
@@ -0,0 +1,78 @@
+# starts a celery worker for the tasks of one kind of work, with the pool, concurrency and limits suited to it
+# tasks are routed to the queues in harmony.tasks
+# usage: python worker.py io|cpu|coref|all [other celery worker options]
+import os
+import sys
+
+
+CORES = os.cpu_count() or 1
+
+# pool, number of tasks run at once, tasks reserved per slot (prefetch multiplier), max memory of a process before it is replaced (KiB, prefork only),
+# resources loaded when a process starts (prefork only, threads load them on first use) and queues consumed by each kind of worker
+POOLS = {
+    # waiting on the network, so many threads share a process
+    'io': {
+        'pool': 'threads',
+        'concurrency': int(os.getenv("IO_CONCURRENCY", 32)),
+        'prefetch': int(os.getenv("IO_PREFETCH", 1)),
+        'max_memory': None,
+        'warm': '',
+        'queues': 'io,celery',
+    },
+    # numpy clustering, one process per core
+    'cpu': {
+        'pool': 'prefork',
+        'concurrency': int(os.getenv("CPU_CONCURRENCY", CORES)),
+        'prefetch': int(os.getenv("CPU_PREFETCH", 1)),
+        'max_memory': int(os.getenv("CPU_MAX_MEMORY", 2 * 1024 * 1024)),
+        'warm': '',
+        'queues': 'cpu',
+    },
+    # spacy and neuralcoref, one process per core with the pipeline loaded (about 1GB each)
+    'coref': {
+        'pool': 'prefork',
+        'concurrency': int(os.getenv("COREF_CONCURRENCY", CORES)),
+        'prefetch': int(os.getenv("COREF_PREFETCH", 1)),
+        'max_memory': int(os.getenv("COREF_MAX_MEMORY", 3 * 1024 * 1024)),
+        'warm': 'nlp',
+        'queues': 'coref',
+    },
+    # every queue in a single prefork pool (development, and the baseline of benchmarks.bench_queues)
+    'all': {
+        'pool': 'prefork',
+        'concurrency': int(os.getenv("ALL_CONCURRENCY", CORES)),
+        'prefetch': 4,
+        'max_memory': None,
+        'warm': 'nlp,language_client',
+        'queues': 'celery,io,cpu,coref',
+    },
+}
+
+
+# returns the arguments of celery worker for the pool called name
+def worker_args(name):
+    pool = POOLS[name]
+    args = ['worker', '-n', f'{name}@%h', '-Q', pool['queues'], '-P', pool['pool'], '-c', str(pool['concurrency']), '--prefetch-multiplier', str(pool['prefetch']), '-l', 'INFO']
+    if pool['max_memory'] is not None:
+        args += ['--max-memory-per-child', str(pool['max_memory'])]
+
+    return args
+
+
+def main():
+    if len(sys.argv) < 2 or sys.argv[1] not in POOLS:
+        sys.exit(f"usage: python worker.py {'|'.join(POOLS)} [other celery worker options]")
+
+    name = sys.argv[1]
+
+    # must be set before the app is imported
+    os.environ.setdefault("WARM_RESOURCES", POOLS[name]['warm'])
+    if POOLS[name]['pool'] == 'threads':
+        os.environ.setdefault("FETCH_TASKS", str(POOLS[name]['concurrency']))  # the threads share the discord session of the process
+    from harmony import celery
+
+    celery.worker_main(worker_args(name) + sys.argv[2:])
+
+
+if __name__ == '__main__':
+    main()